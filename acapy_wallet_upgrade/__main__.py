@@ -5,13 +5,43 @@ import asyncio
 import json
 import logging
 import sys
-from typing import Dict, Optional
+from typing import Dict, Optional, Sequence
 from urllib.parse import urlparse
 
+from askar_tools.key_methods import KEY_METHODS
+from askar_tools.pg_pool import POOLS
+
+from .batching import AdaptiveBatchSizer, BatchSizer
 from .error import UpgradeError
-from .pg_connection import PgConnection
-from .sqlite_connection import SqliteConnection
-from .strategies import DbpwStrategy, MwstAsProfilesStrategy, MwstAsStoresStrategy
+from .throttle import Throttle
+
+
+def open_db(uri: str, *pg_args, read_only: bool = False):
+    """Create the connection for a database URI, importing only its driver."""
+    scheme = urlparse(uri).scheme
+    if scheme == "sqlite":
+        from .sqlite_connection import SqliteConnection
+
+        return SqliteConnection(uri, read_only)
+    elif scheme == "postgres":
+        from .pg_connection import PgConnection
+
+        return PgConnection(uri, *pg_args, read_only=read_only)
+    raise ValueError("Unexpected DB URI scheme")
+
+
+def open_target_db(uri: str, *pg_args):
+    """Create the connection for a new database to hold the Askar store."""
+    scheme = urlparse(uri).scheme
+    if scheme == "sqlite":
+        from .sqlite_connection import SqliteStoreConnection
+
+        return SqliteStoreConnection(uri)
+    elif scheme == "postgres":
+        from .pg_mwst_connection import PgMWSTConnection
+
+        return PgMWSTConnection(uri, *pg_args)
+    raise ValueError("Unexpected DB URI scheme")
 
 
 def config():
@@ -30,6 +60,25 @@ def config():
         required=True,
         help=("Specify URI of database to be migrated."),
     )
+    parser.add_argument(
+        "--target-uri",
+        help=(
+            "dbpw only. Specify URI of a new database to migrate the wallet into, "
+            "instead of migrating it in place. The database being migrated is "
+            "only read from."
+        ),
+    )
+    parser.add_argument(
+        "--online",
+        choices=["copy", "finish"],
+        help=(
+            "dbpw with --target-uri only. Migrate in two phases to keep the agent "
+            "running for most of the migration. The copy phase migrates the wallet "
+            "while the agent runs, recording changed items with triggers on the "
+            "database being migrated. The finish phase, run once the agent is "
+            "stopped, migrates the changed items again and completes the store."
+        ),
+    )
     parser.add_argument(
         "--wallet-name",
         type=str,
@@ -79,7 +128,26 @@ def config():
         help=(
             "Specify a file containing mapping of wallet_name to wallet_key "
             "for all wallets to be migrated in the MultiWalletSingleTable "
-            "as stores (mwst-as-stores) strategy."
+            "as stores (mwst-as-stores) strategy. An entry may also be an object "
+            'with the "key" and its "key_derivation_method".'
+        ),
+    )
+    parser.add_argument(
+        "--wallet-key-derivation-method",
+        choices=list(KEY_METHODS),
+        default="ARGON2I_MOD",
+        help=(
+            "Specify the key derivation method of --wallet-key, and of the "
+            "--wallet-keys entries not giving their own. Default is 'ARGON2I_MOD'."
+        ),
+    )
+    parser.add_argument(
+        "--base-wallet-key-derivation-method",
+        choices=list(KEY_METHODS),
+        default="ARGON2I_MOD",
+        help=(
+            "Specify the key derivation method of --base-wallet-key. Sub-wallets "
+            "use the method recorded in their settings. Default is 'ARGON2I_MOD'."
         ),
     )
     parser.add_argument(
@@ -88,6 +156,241 @@ def config():
         default=50,
         help=("Specify number of items to process in each batch."),
     )
+    parser.add_argument(
+        "--adaptive-batch-size",
+        action="store_true",
+        help=(
+            "Tune the batch size at runtime toward the target batch byte size "
+            "and latency, starting from --batch-size and staying within "
+            "--min-batch-size and --max-batch-size."
+        ),
+    )
+    parser.add_argument(
+        "--min-batch-size",
+        type=int,
+        default=10,
+        help=("Specify the smallest batch size used with --adaptive-batch-size."),
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=5000,
+        help=("Specify the largest batch size used with --adaptive-batch-size."),
+    )
+    parser.add_argument(
+        "--target-batch-bytes",
+        type=int,
+        default=4 * 1024 * 1024,
+        help=("Specify the target size in bytes of each batch."),
+    )
+    parser.add_argument(
+        "--target-batch-latency",
+        type=float,
+        default=1.0,
+        help=("Specify the target time in seconds to process each batch."),
+    )
+    parser.add_argument(
+        "--batch-max-bytes",
+        type=int,
+        default=32 * 1024 * 1024,
+        help=(
+            "Specify the most bytes of items read into each batch, however many "
+            "items that is. Items are read through a cursor until the batch size "
+            "or this limit is reached. Use 0 for no limit."
+        ),
+    )
+    parser.add_argument(
+        "--max-rows-per-second",
+        type=float,
+        default=0,
+        help=(
+            "Specify the most items migrated per second, across all workers. "
+            "Items are counted as they are read. Use 0 for no limit."
+        ),
+    )
+    parser.add_argument(
+        "--max-bytes-per-second",
+        type=float,
+        default=0,
+        help=(
+            "Specify the most bytes of items migrated per second, across all "
+            "workers, as read from the source. Use 0 for no limit."
+        ),
+    )
+    parser.add_argument(
+        "--max-statements",
+        type=int,
+        default=0,
+        help=(
+            "Specify the most batch reads and writes run at once, across all "
+            "workers. Use 0 for no limit."
+        ),
+    )
+    parser.add_argument(
+        "--throttle-file",
+        help=(
+            "Read the throttle limits from this JSON file whenever it changes or "
+            "the process receives SIGHUP, overriding the limits given as options."
+        ),
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=10,
+        help=(
+            "Specify the maximum number of connections pooled per Postgres database."
+        ),
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help=(
+            "Postgres only. Create the new item tables without secondary indexes "
+            "and build the indexes after all items have been loaded."
+        ),
+    )
+    parser.add_argument(
+        "--unlogged",
+        action="store_true",
+        help=(
+            "Postgres only. Create the new item tables UNLOGGED while items are "
+            "loaded and switch them to LOGGED afterwards. Loaded items are lost "
+            "if the server crashes before the switch, so it requires --target-uri "
+            "or --copy-staging, which leave the source items in place."
+        ),
+    )
+    parser.add_argument(
+        "--index-workers",
+        type=int,
+        default=4,
+        help=(
+            "Specify the parallel maintenance workers used to build deferred indexes."
+        ),
+    )
+    parser.add_argument(
+        "--copy-staging",
+        action="store_true",
+        help=(
+            "mwst-as-stores only. Copy the raw items of each wallet into a "
+            "staging table of its new database with a binary COPY stream before "
+            "converting them. Items are then left in place in the source database."
+        ),
+    )
+    parser.add_argument(
+        "--single-scan",
+        action="store_true",
+        help=(
+            "mwst-as-stores only. Migrate all wallets in one scan of the source "
+            "items, routing each item to the store of its wallet. Holds a "
+            "connection to each new database for the whole migration."
+        ),
+    )
+    parser.add_argument(
+        "--source-indexes",
+        choices=["ask", "create", "skip"],
+        default="ask",
+        help=(
+            "MWST strategies only. Check the source database for indexes the "
+            "migration queries need, and ask before building missing ones, build "
+            "them without asking, or skip the check. Built indexes are dropped "
+            "after the migration."
+        ),
+    )
+    parser.add_argument(
+        "--crypto-cache-size",
+        type=int,
+        default=4096,
+        help=(
+            "Number of decrypted and encrypted categories, tag names and tag "
+            "values to reuse for each wallet. Use 0 to disable the caches."
+        ),
+    )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=0,
+        help=(
+            "Commit the conversion of each category to Askar records every N "
+            "records instead of in one transaction per category. Use 0 for one "
+            "transaction."
+        ),
+    )
+    parser.add_argument(
+        "--sub-wallet-workers",
+        type=int,
+        default=1,
+        help=(
+            "mwst-as-profiles only. Specify the number of sub-wallets migrated "
+            "concurrently, starting as the base wallet migration finds them."
+        ),
+    )
+    parser.add_argument(
+        "--wallet-workers",
+        type=int,
+        default=1,
+        help=(
+            "mwst-as-stores only. Specify the number of wallets migrated "
+            "concurrently, largest first. Not used with --single-scan."
+        ),
+    )
+    parser.add_argument(
+        "--preflight-workers",
+        type=int,
+        default=4,
+        help=(
+            "mwst-as-stores only. Specify the number of wallet keys checked "
+            "concurrently before the migration starts. Each check uses 256 MiB "
+            "of memory for a second."
+        ),
+    )
+    parser.add_argument(
+        "--run-report",
+        help=(
+            "mwst-as-profiles and mwst-as-stores only. Write the expected and "
+            "actual duration of each wallet migration to this file as JSON."
+        ),
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help=(
+            "Estimate the time and disk space needed by the upgrade without "
+            "modifying the database. Wallet statistics are read for every wallet; "
+            "a sample is timed for the largest wallet a key was given for."
+        ),
+    )
+    parser.add_argument(
+        "--estimate-sample-size",
+        type=int,
+        default=200,
+        help=("Specify the number of items timed by --estimate."),
+    )
+    parser.add_argument(
+        "--estimate-concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help=("Specify the concurrent wallet migrations projected by --estimate."),
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help=(
+            "Verify migrated Askar stores against a snapshot of the Indy database "
+            "taken before the migration, given with --source-uri. Records are "
+            "compared by per-category counts and digests."
+        ),
+    )
+    parser.add_argument(
+        "--source-uri",
+        type=str,
+        help=("Specify the URI of the Indy database snapshot used by --verify."),
+    )
+    parser.add_argument(
+        "--verify-workers",
+        type=int,
+        help=("Specify the worker processes used by --verify. Default is CPU count."),
+    )
     parser.add_argument(
         "--allow-missing-wallet",
         action="store_true",
@@ -118,6 +421,14 @@ def config():
     )
     args, _ = parser.parse_known_args(sys.argv[1:])
 
+    if args.target_uri:
+        if args.strategy != "dbpw":
+            raise ValueError("Target URI only valid for dbpw strategy")
+        if urlparse(args.target_uri).scheme not in ("sqlite", "postgres"):
+            raise ValueError("Target URI scheme must be one of: sqlite, postgres")
+    if args.online and not args.target_uri:
+        raise ValueError("Online migration requires a target URI")
+
     if args.strategy == "dbpw":
         if not args.wallet_name:
             raise ValueError("Wallet name required for dbpw strategy")
@@ -133,6 +444,8 @@ def config():
     if args.strategy == "mwst-as-stores":
         if not args.wallet_keys and not args.wallet_keys_file:
             raise ValueError("Wallet keys required for mwst-as-stores strategy")
+        if args.single_scan and args.copy_staging:
+            raise ValueError("Choose one of --single-scan and --copy-staging")
 
     parsed = urlparse(args.uri)
     if parsed.scheme not in ("sqlite", "postgres"):
@@ -141,36 +454,162 @@ def config():
     return args
 
 
-async def main(
+def build_strategy(
     strategy: str,
     uri: str,
+    target_uri: Optional[str] = None,
+    online: Optional[str] = None,
     wallet_name: Optional[str] = None,
     wallet_key: Optional[str] = None,
     base_wallet_name: Optional[str] = None,
     base_wallet_key: Optional[str] = None,
     wallet_keys: Optional[Dict[str, str]] = None,
     wallet_keys_file: Optional[str] = None,
+    wallet_key_derivation_method: str = "ARGON2I_MOD",
+    base_wallet_key_derivation_method: str = "ARGON2I_MOD",
     batch_size: int = 50,
+    adaptive_batch_size: Optional[bool] = False,
+    min_batch_size: int = 10,
+    max_batch_size: int = 5000,
+    target_batch_bytes: int = 4 * 1024 * 1024,
+    target_batch_latency: float = 1.0,
+    batch_max_bytes: int = 32 * 1024 * 1024,
+    max_rows_per_second: float = 0,
+    max_bytes_per_second: float = 0,
+    max_statements: int = 0,
+    throttle_file: Optional[str] = None,
+    defer_indexes: Optional[bool] = False,
+    unlogged: Optional[bool] = False,
+    index_workers: int = 4,
+    copy_staging: Optional[bool] = False,
+    single_scan: Optional[bool] = False,
+    source_indexes: str = "ask",
+    sub_wallet_workers: int = 1,
+    wallet_workers: int = 1,
+    preflight_workers: int = 4,
+    run_report: Optional[str] = None,
+    commit_every: int = 0,
+    crypto_cache_size: int = 4096,
+    estimate: Optional[bool] = False,
+    estimate_sample_size: int = 200,
+    estimate_concurrency: Sequence[int] = (1, 2, 4, 8),
+    verify: Optional[bool] = False,
+    source_uri: Optional[str] = None,
+    verify_workers: Optional[int] = None,
     allow_missing_wallet: Optional[bool] = False,
     delete_indy_wallets: Optional[bool] = False,
     skip_confirmation: Optional[bool] = False,
 ):
-    logging.basicConfig(level=logging.WARN)
+    """Create the strategy to run for the command line options.
+
+    Must be called with an event loop running, which the throttle watches
+    for SIGHUP. Postgres connections are taken from the shared `POOLS`.
+    """
     parsed = urlparse(uri)
 
-    if strategy == "dbpw":
-        if parsed.scheme == "sqlite":
-            conn = SqliteConnection(uri)
-        elif parsed.scheme == "postgres":
-            conn = PgConnection(uri)
+    # Other migrations delete each source item once it is loaded, so a crash
+    # would lose items from both sides
+    if unlogged and not (target_uri or (strategy == "mwst-as-stores" and copy_staging)):
+        raise ValueError("--unlogged requires --target-uri or --copy-staging")
+
+    throttle = Throttle(
+        max_rows_per_second, max_bytes_per_second, max_statements, throttle_file
+    )
+    throttle.watch_signal()
+    if adaptive_batch_size:
+        batch_size = AdaptiveBatchSizer(
+            batch_size,
+            min_batch_size,
+            max_batch_size,
+            target_batch_bytes,
+            target_batch_latency,
+            batch_max_bytes or None,
+            throttle,
+        )
+    else:
+        batch_size = BatchSizer(batch_size, batch_max_bytes or None, throttle)
+
+    if estimate:
+        from .estimate import Estimator
+        from .strategies import split_wallet_keys
+
+        conn = open_db(uri)
+        if wallet_keys_file:
+            with open(wallet_keys_file, "r") as wkf:
+                wallet_keys = json.load(wkf)
+        keys, key_methods = split_wallet_keys(
+            wallet_keys or {}, wallet_key_derivation_method
+        )
+        if base_wallet_name and base_wallet_key:
+            keys[base_wallet_name] = base_wallet_key
+            key_methods[base_wallet_name] = base_wallet_key_derivation_method
+        if wallet_key:
+            # A database per wallet has a single wallet without an id
+            keys[None] = wallet_key
+            key_methods[None] = wallet_key_derivation_method
+            if wallet_name:
+                keys[wallet_name] = wallet_key
+                key_methods[wallet_name] = wallet_key_derivation_method
+
+        strategy_inst = Estimator(
+            conn,
+            keys,
+            batch_size,
+            estimate_sample_size,
+            estimate_concurrency,
+            key_methods,
+        )
+
+    elif verify:
+        if not source_uri:
+            raise ValueError("Source URI of the Indy snapshot required to verify")
+        from .verify import Verifier
+
+        source = open_db(source_uri)
+        if wallet_keys_file:
+            with open(wallet_keys_file, "r") as wkf:
+                wallet_keys = json.load(wkf)
+
+        strategy_inst = Verifier(
+            source,
+            strategy,
+            uri,
+            batch_size,
+            wallet_key,
+            base_wallet_name,
+            base_wallet_key,
+            wallet_keys,
+            verify_workers,
+            wallet_key_derivation_method,
+            base_wallet_key_derivation_method,
+        )
+
+    elif strategy == "dbpw":
+        from .strategies import DbpwStrategy
+
+        if target_uri:
+            # Online migrations add and remove triggers on the source
+            conn = open_db(uri, read_only=not online)
+            target = open_target_db(target_uri, defer_indexes, unlogged, index_workers)
         else:
-            raise ValueError("Unexpected DB URI scheme")
+            conn = open_db(uri, defer_indexes, unlogged, index_workers)
+            target = None
         if not wallet_name:
             raise ValueError("Wallet name required for dbpw strategy")
         if not wallet_key:
             raise ValueError("Wallet key required for dbpw strategy")
 
-        strategy_inst = DbpwStrategy(conn, wallet_name, wallet_key, batch_size)
+        strategy_inst = DbpwStrategy(
+            conn,
+            wallet_name,
+            wallet_key,
+            batch_size,
+            commit_every or None,
+            crypto_cache_size,
+            target,
+            online,
+            wallet_key_derivation_method,
+        )
 
     elif strategy == "mwst-as-profiles":
         if parsed.scheme != "postgres":
@@ -180,6 +619,7 @@ async def main(
             raise ValueError("Base wallet name required for mwst-as-profiles strategy")
         if not base_wallet_key:
             raise ValueError("Base wallet key required for mwst-as-profiles strategy")
+        from .strategies import MwstAsProfilesStrategy
 
         strategy_inst = MwstAsProfilesStrategy(
             uri,
@@ -188,6 +628,15 @@ async def main(
             batch_size,
             delete_indy_wallets,
             skip_confirmation,
+            defer_indexes,
+            unlogged,
+            index_workers,
+            sub_wallet_workers,
+            source_indexes,
+            commit_every or None,
+            crypto_cache_size,
+            run_report,
+            base_wallet_key_derivation_method,
         )
 
     elif strategy == "mwst-as-stores":
@@ -199,6 +648,7 @@ async def main(
 
         if not wallet_keys:
             raise ValueError("Wallet keys required for mwst-as-stores strategy")
+        from .strategies import MwstAsStoresStrategy
 
         strategy_inst = MwstAsStoresStrategy(
             uri,
@@ -207,12 +657,35 @@ async def main(
             allow_missing_wallet,
             delete_indy_wallets,
             skip_confirmation,
+            defer_indexes,
+            unlogged,
+            index_workers,
+            copy_staging,
+            single_scan,
+            source_indexes,
+            commit_every or None,
+            crypto_cache_size,
+            wallet_workers,
+            run_report,
+            preflight_workers,
+            wallet_key_derivation_method,
         )
 
     else:
         raise UpgradeError("Invalid strategy")
 
-    await strategy_inst.run()
+    return strategy_inst
+
+
+async def main(strategy: str, uri: str, pool_size: int = 10, **options):
+    """Run the strategy for the command line options, then close the pools."""
+    logging.basicConfig(level=logging.WARN)
+    POOLS.configure(pool_size)
+    strategy_inst = build_strategy(strategy, uri, **options)
+    try:
+        await strategy_inst.run()
+    finally:
+        await POOLS.close_all()
 
 
 def entrypoint():
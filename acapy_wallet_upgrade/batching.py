@@ -0,0 +1,151 @@
+"""Batch sizing for the migration loops."""
+
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+from .throttle import Throttle
+
+
+class BatchSizer:
+    """Fixed batch size, with an optional hard limit on the bytes in a batch.
+
+    The `throttle` paces the rows read through the sizer and is shared with
+    its forks, so its limits hold across all of the migration loops.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        max_bytes: Optional[int] = None,
+        throttle: Optional[Throttle] = None,
+    ):
+        """Initialize a BatchSizer instance."""
+        self.size = size
+        self.max_bytes = max_bytes
+        self.throttle = throttle or Throttle()
+        # Largest row in the last batch, to size the reads of the next one
+        self._row_bytes = 0
+
+    async def collect(self, fetch: Callable[[int], Awaitable[Sequence]]) -> List:
+        """Read the rows of one batch from a cursor.
+
+        `fetch(n)` returns up to `n` more rows. Reading stops at `size` rows or
+        once `max_bytes` is reached. Rows are requested in chunks that fit the
+        remaining budget at the size of the largest row seen, so a batch only
+        goes over budget by a row larger than those before it.
+        """
+        rows: List = []
+        nbytes = 0
+        largest = 0
+        while len(rows) < self.size:
+            want = self.size - len(rows)
+            if self.max_bytes:
+                row_bytes = largest or self._row_bytes
+                # With no row size to go by, read a single row to measure
+                fits = (self.max_bytes - nbytes) // row_bytes if row_bytes else 1
+                want = min(want, max(1, fits))
+            async with self.throttle.statement():
+                chunk = await fetch(want)
+            chunk_bytes = 0
+            for row in chunk:
+                size = row_size(row)
+                chunk_bytes += size
+                largest = max(largest, size)
+            nbytes += chunk_bytes
+            await self.throttle.pace(len(chunk), chunk_bytes)
+            rows.extend(chunk)
+            if len(chunk) < want or (self.max_bytes and nbytes >= self.max_bytes):
+                break
+        self._row_bytes = largest
+        return rows
+
+    def observe(self, count: int, nbytes: int, elapsed: float):
+        """Record a completed batch of `count` items and `nbytes` bytes."""
+
+    def fork(self) -> "BatchSizer":
+        """Return a sizer with the same settings for an independent loop."""
+        return BatchSizer(self.size, self.max_bytes, self.throttle)
+
+    def report(self) -> Optional[str]:
+        """Summarize the batch sizes used, if they changed at runtime."""
+        return None
+
+
+class AdaptiveBatchSizer(BatchSizer):
+    """Batch size tuned at runtime toward a target byte size and latency.
+
+    Per-item byte size and processing time are tracked as moving averages, and
+    the next batch is sized to the smaller of the two targets. Growth is
+    limited to doubling per batch so that a run of small items cannot jump
+    straight to the maximum.
+    """
+
+    SMOOTHING = 0.3
+
+    def __init__(
+        self,
+        initial: int = 50,
+        min_size: int = 10,
+        max_size: int = 5000,
+        target_bytes: int = 4 * 1024 * 1024,
+        target_latency: float = 1.0,
+        max_bytes: Optional[int] = None,
+        throttle: Optional[Throttle] = None,
+    ):
+        """Initialize an AdaptiveBatchSizer instance."""
+        if not 0 < min_size <= max_size:
+            raise ValueError("Batch size bounds must satisfy 0 < min <= max")
+        super().__init__(min(max(initial, min_size), max_size), max_bytes, throttle)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.sizes: List[int] = []
+        self._item_bytes: Optional[float] = None
+        self._item_time: Optional[float] = None
+
+    def _smooth(self, previous: Optional[float], sample: float) -> float:
+        if previous is None:
+            return sample
+        return previous + self.SMOOTHING * (sample - previous)
+
+    def observe(self, count: int, nbytes: int, elapsed: float):
+        """Record a completed batch and pick the size of the next one."""
+        if count <= 0:
+            return
+        self.sizes.append(count)
+        self._item_bytes = self._smooth(self._item_bytes, nbytes / count)
+        self._item_time = self._smooth(self._item_time, elapsed / count)
+
+        ideal = float(self.max_size)
+        if self._item_bytes > 0:
+            ideal = min(ideal, self.target_bytes / self._item_bytes)
+        if self._item_time > 0:
+            ideal = min(ideal, self.target_latency / self._item_time)
+        self.size = int(max(self.min_size, min(ideal, self.size * 2, self.max_size)))
+
+    def fork(self) -> "AdaptiveBatchSizer":
+        """Return a sizer with the same settings for an independent loop."""
+        return AdaptiveBatchSizer(
+            self.size,
+            self.min_size,
+            self.max_size,
+            self.target_bytes,
+            self.target_latency,
+            self.max_bytes,
+            self.throttle,
+        )
+
+    def report(self) -> Optional[str]:
+        """Summarize the batch sizes used."""
+        if not self.sizes:
+            return None
+        return (
+            f"Adaptive batch size: {len(self.sizes)} batches, "
+            f"min {min(self.sizes)}, max {max(self.sizes)}, "
+            f"mean {sum(self.sizes) // len(self.sizes)}, next {self.size}"
+        )
+
+
+def row_size(row: Sequence) -> int:
+    """Approximate the size in bytes of a fetched row."""
+    return sum(len(col) for col in row if isinstance(col, (bytes, str)))
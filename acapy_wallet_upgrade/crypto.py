@@ -0,0 +1,349 @@
+"""Batched ChaCha20-Poly1305 primitives used by the item transform path."""
+
+import base64
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import nacl.bindings
+from nacl.exceptions import CryptoError
+
+from .records import IndyItem
+
+# Optional and undeclared; the PyNaCl bindings are used without it
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+except ImportError:
+    ChaCha20Poly1305 = None
+    InvalidTag = None
+
+# Constants
+CHACHAPOLY_KEY_LEN = 32
+CHACHAPOLY_NONCE_LEN = 12
+CHACHAPOLY_TAG_LEN = 16
+ENCRYPTED_KEY_LEN = CHACHAPOLY_NONCE_LEN + CHACHAPOLY_KEY_LEN + CHACHAPOLY_TAG_LEN
+
+# Default number of searchable ciphertexts kept by each CryptoContext
+DEFAULT_CACHE_SIZE = 4096
+# Longer messages, such as unique tag values, are not worth caching
+MAX_CACHED_LEN = 256
+
+# (nonce, data, key)
+AeadJob = Tuple[bytes, bytes, bytes]
+# (message, HMAC key name, encryption key name)
+SearchableField = Tuple[bytes, str, str]
+# (encoded ciphertext, key name, decoder for the ciphertext)
+EncodedField = Tuple[Union[bytes, str], str, Callable[[Union[bytes, str]], bytes]]
+
+
+def split_tags(tags: Optional[str]) -> List[List[str]]:
+    """Split an Indy tags column into hex encoded name and value pairs."""
+    if not tags:
+        return []
+    return [tag.split(":") for tag in tags.split(",")]
+
+
+def split_merged(enc_value: bytes) -> Tuple[memoryview, memoryview]:
+    """Split a nonce-prefixed ciphertext without copying either part."""
+    view = memoryview(enc_value)
+    return view[:CHACHAPOLY_NONCE_LEN], view[CHACHAPOLY_NONCE_LEN:]
+
+
+def _native_cipher(ciphers: Mapping, key: bytes):
+    cipher = ciphers.get(key)
+    if cipher is None:
+        cipher = ChaCha20Poly1305(key)
+        # A read-only mapping is consulted but not extended
+        if isinstance(ciphers, dict):
+            ciphers[key] = cipher
+    return cipher
+
+
+def _decrypt_batch_native(jobs: Iterable[AeadJob], ciphers: Mapping) -> List[bytes]:
+    try:
+        return [
+            _native_cipher(ciphers, key).decrypt(nonce, ciphertext, None)
+            for nonce, ciphertext, key in jobs
+        ]
+    except InvalidTag as err:
+        raise CryptoError("Decryption failed. Ciphertext failed verification") from err
+
+
+def _encrypt_batch_native(jobs: Iterable[AeadJob], ciphers: Mapping) -> List[bytes]:
+    return [
+        _native_cipher(ciphers, key).encrypt(nonce, message, None)
+        for nonce, message, key in jobs
+    ]
+
+
+def _decrypt_batch_nacl(jobs: Iterable[AeadJob], ciphers: Mapping) -> List[bytes]:
+    decrypt = nacl.bindings.crypto_aead_chacha20poly1305_ietf_decrypt
+    # The nacl bindings only accept bytes, so views must be copied here
+    return [
+        decrypt(bytes(ciphertext), None, bytes(nonce), key)
+        for nonce, ciphertext, key in jobs
+    ]
+
+
+def _encrypt_batch_nacl(jobs: Iterable[AeadJob], ciphers: Mapping) -> List[bytes]:
+    encrypt = nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt
+    return [
+        encrypt(bytes(message), None, bytes(nonce), key) for nonce, message, key in jobs
+    ]
+
+
+if ChaCha20Poly1305 is not None:
+    _decrypt_batch, _encrypt_batch = _decrypt_batch_native, _encrypt_batch_native
+else:
+    _decrypt_batch, _encrypt_batch = _decrypt_batch_nacl, _encrypt_batch_nacl
+
+
+def decrypt_batch(
+    jobs: Iterable[AeadJob], ciphers: Optional[Mapping] = None
+) -> List[bytes]:
+    """Decrypt a sequence of (nonce, ciphertext, key) jobs.
+
+    Cipher instances are reused for jobs sharing a key when the `cryptography`
+    package is available; `ciphers` may supply a longer-lived cache of them,
+    which is only extended if it is a dict.
+    Raises `CryptoError` if any ciphertext fails verification.
+    """
+    return _decrypt_batch(jobs, {} if ciphers is None else ciphers)
+
+
+def encrypt_batch(
+    jobs: Iterable[AeadJob], ciphers: Optional[Mapping] = None
+) -> List[bytes]:
+    """Encrypt a sequence of (nonce, message, key) jobs.
+
+    The returned ciphertexts do not include the nonce.
+    """
+    return _encrypt_batch(jobs, {} if ciphers is None else ciphers)
+
+
+def decrypt_merged_batch(
+    values: Sequence[Tuple[bytes, bytes]], ciphers: Optional[Mapping] = None
+) -> List[bytes]:
+    """Decrypt a sequence of (nonce-prefixed ciphertext, key) pairs."""
+    return decrypt_batch(
+        ((*split_merged(enc_value), key) for enc_value, key in values), ciphers
+    )
+
+
+def encrypt_merged_batch(
+    jobs: Sequence[AeadJob], ciphers: Optional[Mapping] = None
+) -> List[bytes]:
+    """Encrypt (nonce, message, key) jobs, returning nonce-prefixed ciphertexts."""
+    return [
+        bytes(nonce) + ciphertext
+        for (nonce, _, _), ciphertext in zip(jobs, encrypt_batch(jobs, ciphers))
+    ]
+
+
+def encrypt_merged(message: bytes, key: bytes) -> bytes:
+    """Encrypt a message with a random nonce, returning it nonce-prefixed."""
+    return encrypt_merged_batch([(os.urandom(CHACHAPOLY_NONCE_LEN), message, key)])[0]
+
+
+def decrypt_merged(enc_value: bytes, key: bytes) -> bytes:
+    """Decrypt a nonce-prefixed ciphertext."""
+    return decrypt_merged_batch([(enc_value, key)])[0]
+
+
+class CryptoContext:
+    """Key material for one wallet or profile, with its derived crypto state.
+
+    Keyed HMAC states are computed once per key and copied for each use, and
+    AEAD cipher instances are kept for the lifetime of the context.
+
+    Searchable fields are encrypted with a nonce derived from the message, so
+    their ciphertexts only depend on the message and key. The most recently
+    used `cache_size` of them are kept, keyed by key name and message. In the
+    other direction, plaintexts are kept keyed by key name and the ciphertext
+    as read from the database, before it is decoded.
+    """
+
+    def __init__(self, keys: Dict[str, bytes], cache_size: int = 0):
+        """Initialize a CryptoContext instance."""
+        self.keys = keys
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache: OrderedDict[Tuple[str, Union[bytes, str]], bytes] = OrderedDict()
+        self._hmacs: Dict[str, hmac.HMAC] = {}
+        ciphers = {}
+        if ChaCha20Poly1305 is not None:
+            for key in keys.values():
+                if isinstance(key, bytes) and len(key) == CHACHAPOLY_KEY_LEN:
+                    _native_cipher(ciphers, key)
+        # Read-only, so that per-item keys do not grow the shared map
+        self._ciphers = MappingProxyType(ciphers)
+
+    def __getitem__(self, name: str) -> bytes:
+        return self.keys[name]
+
+    def hmac(self, name: str) -> hmac.HMAC:
+        """Return a new HMAC-SHA256 state keyed with the named key."""
+        base = self._hmacs.get(name)
+        if base is None:
+            base = self._hmacs[name] = hmac.HMAC(
+                self.keys[name], digestmod=hashlib.sha256
+            )
+        return base.copy()
+
+    def nonce(self, message: bytes, hmac_name: Optional[str] = None) -> bytes:
+        """Derive a searchable nonce from the message, or a random one."""
+        if not hmac_name:
+            return os.urandom(CHACHAPOLY_NONCE_LEN)
+        hasher = self.hmac(hmac_name)
+        hasher.update(message)
+        return hasher.digest()[:CHACHAPOLY_NONCE_LEN]
+
+    def value_key(self, category: bytes, name: bytes, hmac_name: str) -> bytes:
+        """Derive the Askar value encryption key for an item."""
+        hasher = self.hmac(hmac_name)
+        hasher.update(len(category).to_bytes(4, "big"))
+        hasher.update(category)
+        hasher.update(len(name).to_bytes(4, "big"))
+        hasher.update(name)
+        return hasher.digest()
+
+    def decrypt(self, jobs: Sequence[Tuple[bytes, bytes]]) -> List[bytes]:
+        """Decrypt (nonce-prefixed ciphertext, key) pairs."""
+        return decrypt_merged_batch(jobs, self._ciphers)
+
+    def encrypt(self, jobs: Sequence[AeadJob]) -> List[bytes]:
+        """Encrypt (nonce, message, key) jobs to nonce-prefixed ciphertexts."""
+        return encrypt_merged_batch(jobs, self._ciphers)
+
+    def _cached(self, key_name: str, message: Union[bytes, str]) -> Optional[bytes]:
+        if not self.cache_size or len(message) > MAX_CACHED_LEN:
+            return None
+        result = self._cache.get((key_name, message))
+        if result is None:
+            self.cache_misses += 1
+        else:
+            self._cache.move_to_end((key_name, message))
+            self.cache_hits += 1
+        return result
+
+    def _remember(self, key_name: str, message: Union[bytes, str], result: bytes):
+        if self.cache_size and len(message) <= MAX_CACHED_LEN:
+            self._cache[(key_name, message)] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def encrypt_searchable(
+        self, fields: Sequence[SearchableField], jobs: Sequence[AeadJob] = ()
+    ) -> List[bytes]:
+        """Encrypt searchable fields and then further jobs in one batch.
+
+        Returns the nonce-prefixed ciphertexts of the fields followed by those
+        of the jobs. Field ciphertexts are taken from the cache when present.
+        """
+        results = []
+        missed = []
+        new_jobs = []
+        for message, hmac_name, key_name in fields:
+            enc = self._cached(key_name, message)
+            if enc is None:
+                missed.append(len(results))
+                new_jobs.append(
+                    (self.nonce(message, hmac_name), message, self.keys[key_name])
+                )
+            results.append(enc)
+        new_jobs.extend(jobs)
+
+        enc_jobs = iter(self.encrypt(new_jobs))
+        for pos, enc in zip(missed, enc_jobs):
+            message, _, key_name = fields[pos]
+            self._remember(key_name, message, enc)
+            results[pos] = enc
+        results.extend(enc_jobs)
+        return results
+
+    def decrypt_searchable(
+        self, fields: Sequence[EncodedField], jobs: Sequence[Tuple[bytes, bytes]] = ()
+    ) -> List[bytes]:
+        """Decrypt encoded searchable fields and then further jobs in one batch.
+
+        Fields found in the cache are neither decoded nor decrypted. Returns
+        the plaintexts of the fields followed by those of the jobs.
+        """
+        results = []
+        missed = []
+        new_jobs = []
+        for raw, key_name, decode in fields:
+            plain = self._cached(key_name, raw)
+            if plain is None:
+                missed.append(len(results))
+                new_jobs.append((decode(raw), self.keys[key_name]))
+            results.append(plain)
+        new_jobs.extend(jobs)
+
+        plain_jobs = iter(self.decrypt(new_jobs))
+        for pos, plain in zip(missed, plain_jobs):
+            raw, key_name, _ = fields[pos]
+            self._remember(key_name, raw, plain)
+            results[pos] = plain
+        results.extend(plain_jobs)
+        return results
+
+    def decrypt_item(self, row: tuple, b64: bool = False) -> IndyItem:
+        """Decrypt an Indy item row read with its aggregated tags."""
+        row_id, row_type, row_name, row_value, row_key, tags_enc, tags_plain = row
+        tags_enc = split_tags(tags_enc)
+        tags_plain = split_tags(tags_plain)
+
+        # Types and tag names repeat across items, so they are decrypted
+        # through the cache; everything but the value is decrypted in a
+        # single batch
+        fields = [(row_type, "type", base64.b64decode if b64 else bytes)]
+        for tag_name, tag_value in tags_enc:
+            fields.append((tag_name, "tag_name", bytes.fromhex))
+            fields.append((tag_value, "tag_value", bytes.fromhex))
+        for tag_name, _ in tags_plain:
+            fields.append((tag_name, "tag_name", bytes.fromhex))
+        plain = self.decrypt_searchable(
+            fields,
+            [
+                (base64.b64decode(row_name) if b64 else row_name, self.keys["name"]),
+                (row_key, self.keys["value"]),
+            ],
+        )
+
+        tags = []
+        pos = 1
+        for _ in tags_enc:
+            tags.append((0, plain[pos], plain[pos + 1]))
+            pos += 2
+        for _, tag_value in tags_plain:
+            tags.append((1, plain[pos], bytes.fromhex(tag_value)))
+            pos += 1
+        name, value_key = plain[pos], plain[pos + 1]
+        value = self.decrypt([(row_value, value_key)])[0] if row_value else None
+        return IndyItem(row_id, plain[0], name, value, tags)
+
+    def cache_report(self) -> Optional[str]:
+        """Summarize the use of the searchable field cache."""
+        lookups = self.cache_hits + self.cache_misses
+        if not lookups:
+            return None
+        return (
+            f"{self.cache_hits} hits, {self.cache_misses} misses "
+            f"({self.cache_hits / lookups:.0%} hit rate)"
+        )
@@ -1,5 +1,18 @@
 from abc import ABC, abstractmethod
-from typing import AsyncIterator, Optional, Sequence, Tuple, Union
+from typing import AsyncIterator, List, Optional, Sequence, Tuple, Union
+
+from .batching import BatchSizer
+from .records import AskarItem, WalletStats
+
+# Changelog of the Indy items changed during an online migration
+CHANGES_TABLE = "upgrade_changes"
+
+# Indy tables whose changes are recorded, with the column holding the item id
+CHANGE_TABLES = (
+    ("items", "id"),
+    ("tags_encrypted", "item_id"),
+    ("tags_plaintext", "item_id"),
+)
 
 
 class DbConnection(ABC):
@@ -31,6 +44,30 @@ class DbConnection(ABC):
     async def close(self):
         """Release the connection."""
 
+    @abstractmethod
+    async def wallet_stats(self) -> List[WalletStats]:
+        """Collect item and tag statistics for each Indy wallet, read-only."""
+
+    @abstractmethod
+    async def disk_usage(self) -> int:
+        """Size in bytes used on disk by the Indy wallet tables."""
+
+    @abstractmethod
+    async def time_insert(self, items: Sequence[AskarItem]) -> float:
+        """Time inserting items into scratch tables that are discarded after."""
+
+    @abstractmethod
+    async def capture_changes(self):
+        """Record the ids of the Indy items changed from now on."""
+
+    @abstractmethod
+    async def changed_item_ids(self, after: int, limit: int) -> List[int]:
+        """Fetch recorded ids of changed items in order, starting after an id."""
+
+    @abstractmethod
+    async def drop_change_capture(self):
+        """Stop recording changes and drop the recorded ids."""
+
 
 class Wallet(ABC):
     """Abstract wallet.
@@ -38,6 +75,9 @@ class Wallet(ABC):
     Represents a single wallet in an Indy SDK DB.
     """
 
+    # Whether item types and names are stored base64 encoded
+    NAMES_B64 = False
+
     @abstractmethod
     async def insert_profile(self, name: str, key: bytes):
         """Insert the initial profile."""
@@ -47,9 +87,78 @@ class Wallet(ABC):
         """Fetch metadata value from the database."""
 
     @abstractmethod
-    def fetch_pending_items(self, batch_size: int) -> AsyncIterator[Sequence[Tuple]]:
-        """Fetch un-updated items."""
+    def fetch_pending_items(
+        self, batcher: BatchSizer
+    ) -> AsyncIterator[Sequence[Tuple]]:
+        """Fetch un-updated items.
+
+        The batch size is read from the batcher before each fetch.
+        """
+
+    @abstractmethod
+    def scan_items(self, batcher: BatchSizer) -> AsyncIterator[Sequence[Tuple]]:
+        """Fetch all items in id order, without modifying them."""
 
     @abstractmethod
-    async def update_items(self, items):
+    async def fetch_items(self, ids: Sequence[int]) -> Sequence[Tuple]:
+        """Fetch the items with the given ids that still exist, in id order."""
+
+    @abstractmethod
+    async def insert_items(self, items: Sequence[AskarItem]):
+        """Insert converted items, leaving the source items in place."""
+
+    @abstractmethod
+    async def remove_items(self, ids: Sequence[int]):
+        """Remove converted items by id, with their tags."""
+
+    @abstractmethod
+    async def update_items(self, items: Sequence[AskarItem]):
         """Update items in the database."""
+
+
+class OutOfPlaceWallet(Wallet):
+    """A wallet read from one database and migrated into the store of another.
+
+    Items are read from the source in id order without being modified, so the
+    source can be opened read-only and is left intact by the migration.
+    """
+
+    def __init__(self, source: Wallet, target: Wallet):
+        """Initialize an OutOfPlaceWallet instance."""
+        self.source = source
+        self.target = target
+        self.NAMES_B64 = source.NAMES_B64
+
+    async def insert_profile(self, name: str, key: bytes):
+        """Insert the initial profile into the target."""
+        return await self.target.insert_profile(name, key)
+
+    async def get_metadata(self) -> Union[str, bytes]:
+        """Fetch metadata value from the source."""
+        return await self.source.get_metadata()
+
+    def fetch_pending_items(
+        self, batcher: BatchSizer
+    ) -> AsyncIterator[Sequence[Tuple]]:
+        """Fetch all source items; none are removed once migrated."""
+        return self.source.scan_items(batcher)
+
+    def scan_items(self, batcher: BatchSizer) -> AsyncIterator[Sequence[Tuple]]:
+        """Fetch all source items in id order."""
+        return self.source.scan_items(batcher)
+
+    async def fetch_items(self, ids: Sequence[int]) -> Sequence[Tuple]:
+        """Fetch source items by id."""
+        return await self.source.fetch_items(ids)
+
+    async def insert_items(self, items: Sequence[AskarItem]):
+        """Insert converted items into the target."""
+        await self.target.insert_items(items)
+
+    async def remove_items(self, ids: Sequence[int]):
+        """Remove converted items from the target."""
+        await self.target.remove_items(ids)
+
+    async def update_items(self, items: Sequence[AskarItem]):
+        """Insert converted items into the target."""
+        await self.target.insert_items(items)
@@ -0,0 +1,246 @@
+"""Dry-run cost estimates for an upgrade.
+
+The estimate reads statistics from the Indy wallet tables and times a sample
+batch through the same decrypt and encrypt path as the upgrade. The sample is
+only inserted into scratch tables that are rolled back, so nothing is modified.
+"""
+
+import base64
+import time
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+from .batching import BatchSizer, row_size
+from .db_connection import DbConnection
+from .records import AskarItem, WalletStats
+from .schedule import format_bytes, format_seconds, makespan
+from .strategies import DEFAULT_KEY_METHOD, PASSTHROUGH_CATEGORIES, Strategy
+
+# Categories rewritten again by the Askar conversion pass
+CONVERTED_PREFIX = "Indy::"
+
+# Strategies that apply to each kind of source database
+STRATEGIES = {
+    "sqlite": ("dbpw",),
+    "pgsql": ("dbpw",),
+    "pgsql_mwst": ("mwst-as-profiles", "mwst-as-stores"),
+}
+
+
+class SampleTiming(NamedTuple):
+    """Costs measured on a sample batch of items."""
+
+    items: int
+    key_seconds: float
+    read_seconds: float
+    transform_seconds: float
+    write_seconds: float
+    in_bytes: int
+    out_bytes: int
+    # Share of items in categories converted again by the Askar pass
+    converted: float
+
+    @property
+    def cpu_per_item(self) -> float:
+        return self.transform_seconds / self.items
+
+    @property
+    def io_per_item(self) -> float:
+        return (self.read_seconds + self.write_seconds) / self.items
+
+    @property
+    def growth(self) -> float:
+        return self.out_bytes / self.in_bytes if self.in_bytes else 1.0
+
+
+def askar_item_size(item: AskarItem) -> int:
+    """Size in bytes of the encrypted fields of an item."""
+    return (
+        len(item.category)
+        + len(item.name)
+        + len(item.value)
+        + sum(len(name) + len(value) for _, name, value in item.tags)
+    )
+
+
+def project_seconds(
+    stats: Sequence[WalletStats], sample: SampleTiming, workers: int
+) -> float:
+    """Project the duration of an upgrade with concurrent wallet migrations."""
+    cpu = []
+    total = []
+    for wallet in stats:
+        items = wallet.items * (1 + sample.converted)
+        # The wallet key is derived once to decrypt and once to open the store
+        wallet_cpu = items * sample.cpu_per_item + 2 * sample.key_seconds
+        cpu.append(wallet_cpu)
+        total.append(wallet_cpu + items * sample.io_per_item)
+    # The crypto shares a single event loop, so it does not overlap
+    return max(sum(cpu), makespan(total, workers))
+
+
+class Estimator(Strategy):
+    """Estimate the cost of upgrading a database without modifying it."""
+
+    def __init__(
+        self,
+        conn: DbConnection,
+        wallet_keys: Dict[Optional[str], str],
+        batch_size: Union[int, BatchSizer],
+        sample_size: int = 200,
+        concurrency: Sequence[int] = (1, 2, 4, 8),
+        key_methods: Optional[Dict[Optional[str], str]] = None,
+    ):
+        super().__init__(batch_size)
+        self.conn = conn
+        self.wallet_keys = wallet_keys
+        self.key_methods = key_methods or {}
+        self.sample_size = sample_size
+        self.concurrency = concurrency
+
+    async def sample(
+        self, stats: WalletStats, wallet_key: str, key_method: str = DEFAULT_KEY_METHOD
+    ) -> Tuple[SampleTiming, Dict[str, int]]:
+        """Time a sample batch of a wallet and decrypt its category names."""
+        if self.conn.DB_TYPE == "sqlite":
+            wallet = self.conn.get_wallet("items")
+        else:
+            wallet = self.conn.get_wallet("items", stats.wallet_id)
+        b64 = wallet.NAMES_B64
+
+        start = time.perf_counter()
+        indy_key = await self.fetch_indy_key(wallet, wallet_key, key_method)
+        key_seconds = time.perf_counter() - start
+        indy_ctx = self.wallet_context(indy_key)
+        profile_ctx = self.profile_context(self.make_profile_key(indy_key))
+
+        start = time.perf_counter()
+        batches = wallet.fetch_pending_items(BatchSizer(self.sample_size))
+        try:
+            rows = await anext(batches, [])
+        finally:
+            await batches.aclose()
+        read_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        items = [
+            self.update_item(
+                self.rename_item(self.decrypt_item(row, indy_ctx, b64)), profile_ctx
+            )
+            for row in rows
+        ]
+        transform_seconds = time.perf_counter() - start
+        write_seconds = await self.conn.time_insert(items)
+
+        names = indy_ctx.decrypt(
+            [
+                (base64.b64decode(category) if b64 else category, indy_key["type"])
+                for category in stats.categories
+            ]
+        )
+        categories = {
+            name.decode(): count
+            for name, count in zip(names, stats.categories.values())
+        }
+        converted = sum(
+            count
+            for name, count in categories.items()
+            if name.startswith(CONVERTED_PREFIX)
+            and name.encode() not in PASSTHROUGH_CATEGORIES
+        )
+        timing = SampleTiming(
+            len(items),
+            key_seconds,
+            read_seconds,
+            transform_seconds,
+            write_seconds,
+            sum(map(row_size, rows)),
+            sum(map(askar_item_size, items)),
+            converted / stats.items,
+        )
+        return timing, categories
+
+    def report(
+        self,
+        kind: str,
+        stats: Sequence[WalletStats],
+        disk: int,
+        sample: Optional[SampleTiming],
+        sampled: Optional[WalletStats] = None,
+        categories: Optional[Dict[str, int]] = None,
+    ):
+        items = sum(wallet.items for wallet in stats)
+        source_bytes = sum(wallet.item_bytes + wallet.tag_bytes for wallet in stats)
+        print(
+            f"Source: {len(stats)} wallet(s), {items} items "
+            f"({format_bytes(sum(wallet.item_bytes for wallet in stats))}), "
+            f"{sum(wallet.tags for wallet in stats)} tags "
+            f"({format_bytes(sum(wallet.tag_bytes for wallet in stats))}), "
+            f"{format_bytes(disk)} on disk"
+        )
+        for wallet in sorted(stats, key=lambda wallet: -wallet.items)[:10]:
+            print(
+                f"  {wallet.wallet_id or 'wallet'}: {wallet.items} items, "
+                f"{wallet.tags} tags, {len(wallet.categories)} categories, "
+                f"{format_bytes(wallet.item_bytes + wallet.tag_bytes)}"
+            )
+        if not sample:
+            print(
+                "No wallet key given for a wallet with items; "
+                "provide one to time a sample and project the upgrade."
+            )
+            return
+
+        print(f"Categories of {sampled.wallet_id or 'wallet'}:")
+        for name, count in sorted(categories.items(), key=lambda c: -c[1]):
+            print(f"  {name}: {count}")
+
+        # Scale on-disk overhead such as indexes along with the data
+        overhead = disk / source_bytes if source_bytes else 1.0
+        new_disk = source_bytes * sample.growth * overhead
+        print(
+            f"Sample: {sample.items} items, key derivation "
+            f"{format_seconds(sample.key_seconds)}, "
+            f"{sample.cpu_per_item * 1000:.3f} ms/item crypto, "
+            f"{sample.io_per_item * 1000:.3f} ms/item database, "
+            f"{sample.converted:.0%} converted by the Askar pass"
+        )
+        for strategy in STRATEGIES[kind]:
+            print(f"Projected for {strategy}:")
+            for workers in self.concurrency if len(stats) > 1 else (1,):
+                seconds = project_seconds(stats, sample, workers)
+                print(f"  {workers} concurrent wallet(s): {format_seconds(seconds)}")
+            print(
+                f"  Disk: {format_bytes(new_disk)} new, "
+                f"{format_bytes(disk + new_disk)} peak with the source in place"
+            )
+            if strategy == "mwst-as-stores":
+                largest = max(wallet.item_bytes + wallet.tag_bytes for wallet in stats)
+                print(
+                    f"  With --copy-staging: up to "
+                    f"{format_bytes(largest * overhead)} more while a wallet is staged"
+                )
+
+    async def run(self):
+        """Print the estimate."""
+        await self.conn.connect()
+        try:
+            stats = await self.conn.wallet_stats()
+            disk = await self.conn.disk_usage()
+            kind = self.conn.DB_TYPE
+            if any(wallet.wallet_id is not None for wallet in stats):
+                kind = "pgsql_mwst"
+
+            sample = sampled = categories = None
+            # Sample the largest wallet a key was given for
+            for wallet in sorted(stats, key=lambda wallet: -wallet.items):
+                if wallet.items and wallet.wallet_id in self.wallet_keys:
+                    sampled = wallet
+                    sample, categories = await self.sample(
+                        wallet,
+                        self.wallet_keys[wallet.wallet_id],
+                        self.key_methods.get(wallet.wallet_id, DEFAULT_KEY_METHOD),
+                    )
+                    break
+            self.report(kind, stats, disk, sample, sampled, categories)
+        finally:
+            await self.conn.close()
@@ -1,11 +1,56 @@
 import base64
-from typing import Optional
+import time
+from typing import Dict, List, Optional, Sequence
 from urllib.parse import urlparse
 
 import asyncpg
+from askar_tools.pg_pool import POOLS
 
-from .db_connection import DbConnection, Wallet
+from .batching import BatchSizer
+from .db_connection import CHANGE_TABLES, CHANGES_TABLE, DbConnection, Wallet
 from .error import UpgradeError
+from .records import AskarItem, WalletStats
+
+ITEMS_INDEXES = """
+    CREATE UNIQUE INDEX IF NOT EXISTS ix_items_uniq ON items
+        (profile_id, kind, category, name);
+"""
+
+ITEMS_TAGS_INDEXES = """
+    CREATE INDEX IF NOT EXISTS ix_items_tags_item_id ON items_tags(item_id);
+    CREATE INDEX IF NOT EXISTS ix_items_tags_name_enc
+        ON items_tags(name, SUBSTR(value, 1, 12)) include (item_id)
+        WHERE plaintext=0;
+    CREATE INDEX IF NOT EXISTS ix_items_tags_name_plain
+        ON items_tags(name, value) include (item_id)
+        WHERE plaintext=1;
+"""
+
+# Item columns as read by the upgrade, with tags aggregated as hex name:value pairs
+ITEM_COLUMNS = """
+    SELECT i.id, i.type, i.name, i.value, i.key,
+    (SELECT string_agg(encode(te.name::bytea, 'hex') || ':' || encode(te.value::bytea, 'hex')::text, ',')
+        FROM tags_encrypted te WHERE te.item_id = i.id) AS tags_enc,
+    (SELECT string_agg(encode(tp.name::bytea, 'hex') || ':' || encode(tp.value::bytea, 'hex')::text, ',')
+        FROM tags_plaintext tp WHERE tp.item_id = i.id) AS tags_plain
+"""  # noqa
+
+# Trigger function recording the item id held by the column named by its argument
+CHANGE_FUNCTION = f"""
+    CREATE FUNCTION {CHANGES_TABLE}_record() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            INSERT INTO {CHANGES_TABLE} VALUES ((to_jsonb(OLD) ->> TG_ARGV[0])::bigint)
+            ON CONFLICT DO NOTHING;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            INSERT INTO {CHANGES_TABLE} VALUES ((to_jsonb(NEW) ->> TG_ARGV[0])::bigint)
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END $$;
+"""
 
 
 class PgConnection(DbConnection):
@@ -16,23 +61,68 @@ class PgConnection(DbConnection):
     def __init__(
         self,
         uri: str,
+        defer_indexes: bool = False,
+        unlogged: bool = False,
+        index_workers: int = 4,
+        read_only: bool = False,
     ):
-        """Initialize a PgConnection instance."""
+        """Initialize a PgConnection instance.
+
+        With `defer_indexes`, the secondary indexes of the new items tables are
+        built by `finish_upgrade` after all items are loaded, using up to
+        `index_workers` parallel maintenance workers. With `unlogged`, the
+        tables are created UNLOGGED and switched to LOGGED once loaded, which
+        is only safe when the source items are not deleted as they are loaded.
+        With `read_only`, the session only allows read-only transactions.
+        """
         self.uri = uri
         self.parsed_url = urlparse(uri)
+        self.defer_indexes = defer_indexes
+        self.unlogged = unlogged
+        self.index_workers = index_workers
+        self.read_only = read_only
         self._conn: asyncpg.Connection = None
 
+    @property
+    def table_prefix(self) -> str:
+        """The CREATE TABLE modifier for the new items tables."""
+        return "UNLOGGED " if self.unlogged else ""
+
+    def create_indexes(self, indexes: str) -> str:
+        """The index statements to run at table creation, unless deferred."""
+        return "" if self.defer_indexes else indexes
+
+    async def build_deferred_indexes(self):
+        """Make unlogged tables durable and build deferred indexes."""
+        if not (self.defer_indexes or self.unlogged):
+            return
+        async with self._conn.transaction():
+            if self.unlogged:
+                # Switched before the indexes exist, which SET LOGGED would
+                # otherwise rewrite into the WAL. items_tags references items,
+                # so items must be logged first
+                await self._conn.execute(
+                    """
+                    ALTER TABLE items SET LOGGED;
+                    ALTER TABLE items_tags SET LOGGED;
+                    """
+                )
+            if self.defer_indexes:
+                await self._conn.execute(
+                    "SET LOCAL max_parallel_maintenance_workers = "
+                    f"{int(self.index_workers)}"
+                )
+                await self._conn.execute(ITEMS_INDEXES + ITEMS_TAGS_INDEXES)
+
     async def connect(self):
         """Accessor for the connection pool instance."""
         if not self._conn:
-            parts = self.parsed_url
-            self._conn = await asyncpg.connect(
-                host=parts.hostname,
-                port=parts.port or 5432,
-                user=parts.username,
-                password=parts.password,
-                database=parts.path[1:],
-            )
+            self._conn = await POOLS.acquire(self.uri)
+            if self.read_only:
+                # Reset when the connection is released to the pool
+                await self._conn.execute(
+                    "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY"
+                )
 
     async def find_table(self, name: str) -> bool:
         """Check for existence of a table."""
@@ -96,9 +186,9 @@ class PgConnection(DbConnection):
         )
         await self._create_table(
             "items_old",
-            """
+            f"""
             ALTER TABLE items RENAME TO items_old;
-            CREATE TABLE items (
+            CREATE {self.table_prefix}TABLE items (
                 id BIGSERIAL,
                 profile_id BIGINT NOT NULL,
                 kind SMALLINT NOT NULL,
@@ -110,14 +200,13 @@ class PgConnection(DbConnection):
                 FOREIGN KEY (profile_id) REFERENCES profiles (id)
                     ON DELETE CASCADE ON UPDATE CASCADE
             );
-            CREATE UNIQUE INDEX ix_items_uniq ON items
-                (profile_id, kind, category, name);
+            {self.create_indexes(ITEMS_INDEXES)}
             """,
         )
         await self._create_table(
             "items_tags",
-            """
-            CREATE TABLE items_tags (
+            f"""
+            CREATE {self.table_prefix}TABLE items_tags (
                 id BIGSERIAL,
                 item_id BIGINT NOT NULL,
                 name BYTEA NOT NULL,
@@ -127,13 +216,7 @@ class PgConnection(DbConnection):
                 FOREIGN KEY (item_id) REFERENCES items (id)
                     ON DELETE CASCADE ON UPDATE CASCADE
             );
-            CREATE INDEX ix_items_tags_item_id ON items_tags(item_id);
-            CREATE INDEX ix_items_tags_name_enc
-                ON items_tags(name, SUBSTR(value, 1, 12)) include (item_id)
-                WHERE plaintext=0;
-            CREATE INDEX ix_items_tags_name_plain
-                ON items_tags(name, value) include (item_id)
-                WHERE plaintext=1;
+            {self.create_indexes(ITEMS_TAGS_INDEXES)}
             """,
         )
 
@@ -156,6 +239,7 @@ class PgConnection(DbConnection):
 
     async def finish_upgrade(self):
         """Complete the upgrade."""
+        await self.build_deferred_indexes()
 
         await self._conn.execute(
             """
@@ -172,26 +256,210 @@ class PgConnection(DbConnection):
     async def close(self):
         """Release the connection."""
         if self._conn:
-            await self._conn.close()
+            await POOLS.release(self._conn)
             self._conn = None
 
-    def get_wallet(self) -> "PgWallet":
-        return PgWallet(self._conn, self._conn, "items_old", None)
+    async def wallet_stats(self) -> List[WalletStats]:
+        """Collect item and tag statistics for each Indy wallet, read-only."""
+        mwst = await self._conn.fetchval(
+            """
+            SELECT EXISTS (
+               SELECT FROM information_schema.columns
+               WHERE  table_schema = 'public'
+               AND    table_name   = 'metadata'
+               AND    column_name  = 'wallet_id'
+            );
+            """
+        )
+        wallet_id = "wallet_id" if mwst else "NULL::text"
+        wallet_ids = (
+            [row[0] for row in await self._conn.fetch("SELECT wallet_id FROM metadata")]
+            if mwst
+            else [None]
+        )
+        items: Dict[Optional[str], List[int]] = {wid: [0, 0] for wid in wallet_ids}
+        tags: Dict[Optional[str], List[int]] = {wid: [0, 0] for wid in wallet_ids}
+        categories: Dict[Optional[str], Dict[bytes, int]] = {
+            wid: {} for wid in wallet_ids
+        }
+        for wid, category, count, size in await self._conn.fetch(
+            f"""
+            SELECT {wallet_id}, type, COUNT(*), SUM(octet_length(type)
+                + octet_length(name) + octet_length(value) + octet_length(key))::bigint
+            FROM items GROUP BY 1, 2
+            """
+        ):
+            totals = items.setdefault(wid, [0, 0])
+            totals[0] += count
+            totals[1] += size
+            categories.setdefault(wid, {})[category] = count
+        for wid, count, size in await self._conn.fetch(
+            f"""
+            SELECT wid, COUNT(*), SUM(size)::bigint
+            FROM (
+                SELECT {wallet_id} AS wid, octet_length(name) + octet_length(value)
+                    AS size FROM tags_encrypted
+                UNION ALL
+                SELECT {wallet_id} AS wid, octet_length(name) + octet_length(value)
+                    AS size FROM tags_plaintext
+            ) t GROUP BY 1
+            """
+        ):
+            tags[wid] = [count, size]
+        return [
+            WalletStats(wid, *items[wid], *tags.get(wid, (0, 0)), categories[wid])
+            for wid in items
+        ]
+
+    async def disk_usage(self) -> int:
+        """Size in bytes used on disk by the Indy wallet tables."""
+        return await self._conn.fetchval(
+            """
+            SELECT SUM(COALESCE(pg_total_relation_size(to_regclass(name)), 0))::bigint
+            FROM unnest(ARRAY['metadata', 'items', 'tags_encrypted', 'tags_plaintext'])
+                AS name
+            """
+        )
+
+    async def time_insert(self, items: Sequence[AskarItem]) -> float:
+        """Time inserting items into scratch tables that are discarded after."""
+        txn = self._conn.transaction()
+        await txn.start()
+        try:
+            await self._conn.execute(
+                """
+                CREATE TEMP TABLE estimate_items (
+                    id BIGSERIAL,
+                    profile_id BIGINT NOT NULL,
+                    kind SMALLINT NOT NULL,
+                    category BYTEA NOT NULL,
+                    name BYTEA NOT NULL,
+                    value BYTEA NOT NULL,
+                    expiry TIMESTAMP NULL,
+                    PRIMARY KEY(id)
+                );
+                CREATE UNIQUE INDEX ON estimate_items
+                    (profile_id, kind, category, name);
+                CREATE TEMP TABLE estimate_items_tags (
+                    id BIGSERIAL,
+                    item_id BIGINT NOT NULL,
+                    name BYTEA NOT NULL,
+                    value BYTEA NOT NULL,
+                    plaintext SMALLINT NOT NULL,
+                    PRIMARY KEY (id)
+                );
+                CREATE INDEX ON estimate_items_tags(item_id);
+                CREATE INDEX ON estimate_items_tags(name, SUBSTR(value, 1, 12))
+                    include (item_id) WHERE plaintext=0;
+                CREATE INDEX ON estimate_items_tags(name, value)
+                    include (item_id) WHERE plaintext=1;
+                """
+            )
+            start = time.perf_counter()
+            for item in items:
+                item_id = await self._conn.fetchval(
+                    """
+                    INSERT INTO estimate_items (profile_id, kind, category, name, value)
+                    VALUES (1, 2, $1, $2, $3) RETURNING id
+                    """,
+                    item.category,
+                    item.name,
+                    item.value,
+                )
+                if item.tags:
+                    await self._conn.executemany(
+                        """
+                        INSERT INTO estimate_items_tags (item_id, plaintext, name, value)
+                        VALUES ($1, $2, $3, $4)
+                        """,
+                        ((item_id, *tag) for tag in item.tags),
+                    )
+            return time.perf_counter() - start
+        finally:
+            await txn.rollback()
+
+    async def capture_changes(self):
+        """Record the ids of the Indy items changed from now on."""
+        async with self._conn.transaction():
+            await self.drop_change_capture()
+            await self._conn.execute(
+                f"""
+                CREATE TABLE {CHANGES_TABLE} (
+                    item_id BIGINT NOT NULL,
+                    PRIMARY KEY (item_id)
+                );
+                {CHANGE_FUNCTION}
+                """
+            )
+            for table, column in CHANGE_TABLES:
+                await self._conn.execute(
+                    f"""
+                    CREATE TRIGGER {CHANGES_TABLE}_{table}
+                    AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION {CHANGES_TABLE}_record('{column}')
+                    """
+                )
+
+    async def changed_item_ids(self, after: int, limit: int) -> List[int]:
+        """Fetch recorded ids of changed items in order, starting after an id."""
+        rows = await self._conn.fetch(
+            f"""
+            SELECT item_id FROM {CHANGES_TABLE} WHERE item_id > $1
+            ORDER BY item_id LIMIT $2
+            """,
+            after,
+            limit,
+        )
+        return [row[0] for row in rows]
+
+    async def drop_change_capture(self):
+        """Stop recording changes and drop the recorded ids."""
+        # Dropping the function drops the triggers calling it
+        await self._conn.execute(
+            f"""
+            DROP FUNCTION IF EXISTS {CHANGES_TABLE}_record() CASCADE;
+            DROP TABLE IF EXISTS {CHANGES_TABLE};
+            """
+        )
+
+    def get_wallet(
+        self, items_table: str = "items_old", wallet_id: Optional[str] = None
+    ) -> "PgWallet":
+        return PgWallet(self._conn, self._conn, items_table, wallet_id)
+
+    def get_store_wallet(
+        self, keep_ids: bool = False, replace: bool = False
+    ) -> "PgWallet":
+        """Get a wallet inserting converted items into the Askar store.
+
+        With `keep_ids`, items keep their source ids. With `replace`, they
+        also replace any item holding the same id or name, so they can be
+        migrated again.
+        """
+        return PgWallet(self._conn, self._conn, "items", None, keep_ids, replace)
 
 
 class PgWallet(Wallet):
+    NAMES_B64 = True
+
     def __init__(
         self,
         old_conn: asyncpg.Connection,
         new_conn: asyncpg.Connection,
         items_table: str,
         wallet_id: str,
+        keep_ids: bool = False,
+        replace: bool = False,
     ):
         self._old_conn = old_conn
         self._new_conn = new_conn
+        # Connection holding the items table, from which items are deleted
+        self._items_conn = old_conn
         self._items_table = items_table
         self._wallet_id = wallet_id
         self._profile_id = None
+        self._keep_ids = keep_ids or replace
+        self._replace = replace
 
     @property
     def profile_id(self):
@@ -233,57 +501,121 @@ class PgWallet(Wallet):
         else:
             raise Exception("Row not found")
 
-    async def fetch_pending_items(self, batch_size: int):
+    async def fetch_batch(self, batcher: BatchSizer, command: str, *args) -> List:
+        """Read a batch of rows through a cursor, within the batch byte budget."""
+        async with self._items_conn.transaction():
+            cursor = await self._items_conn.cursor(command, *args)
+            return await batcher.collect(cursor.fetch)
+
+    async def fetch_pending_items(self, batcher: BatchSizer):
         """Fetch un-updated items by wallet_id, if it exists."""
         while True:
-            command = """
-                    SELECT i.id, i.type, i.name, i.value, i.key,
-                    (SELECT string_agg(encode(te.name::bytea, 'hex') || ':' || encode(te.value::bytea, 'hex')::text, ',')
-                        FROM tags_encrypted te WHERE te.item_id = i.id) AS tags_enc,
-                    (SELECT string_agg(encode(tp.name::bytea, 'hex') || ':' || encode(tp.value::bytea, 'hex')::text, ',')
-                        FROM tags_plaintext tp WHERE tp.item_id = i.id) AS tags_plain
-                    """  # noqa
+            command = ITEM_COLUMNS
             if self._wallet_id:
                 command += (
                     f"FROM {self._items_table} i WHERE i.wallet_id = $2 LIMIT $1;"
                 )
-                rows = await self._old_conn.fetch(
+                rows = await self.fetch_batch(
+                    batcher,
                     command,
-                    batch_size,
+                    batcher.size,
                     self._wallet_id,
                 )
             else:
                 command += f"FROM {self._items_table} i LIMIT $1;"
-                rows = await self._old_conn.fetch(command, batch_size)
+                rows = await self.fetch_batch(batcher, command, batcher.size)
+            if not rows:
+                break
+            yield rows
+
+    async def scan_items(self, batcher: BatchSizer):
+        """Fetch all items in id order, without modifying them."""
+        last_id = 0
+        while True:
+            command = ITEM_COLUMNS + f"FROM {self._items_table} i WHERE i.id > $2 "
+            if self._wallet_id:
+                command += "AND i.wallet_id = $3 ORDER BY i.id LIMIT $1"
+                rows = await self.fetch_batch(
+                    batcher, command, batcher.size, last_id, self._wallet_id
+                )
+            else:
+                command += "ORDER BY i.id LIMIT $1"
+                rows = await self.fetch_batch(batcher, command, batcher.size, last_id)
             if not rows:
                 break
+            last_id = rows[-1][0]
             yield rows
 
-    async def update_items(self, items):
+    async def fetch_items(self, ids: Sequence[int]) -> List:
+        """Fetch the items with the given ids that still exist, in id order."""
+        return await self._items_conn.fetch(
+            ITEM_COLUMNS
+            + f"FROM {self._items_table} i WHERE i.id = ANY($1::bigint[]) ORDER BY i.id",
+            ids,
+        )
+
+    async def _insert_item(self, item: AskarItem):
+        if self._replace:
+            # Tags of the replaced item are removed by the foreign key cascade
+            await self._new_conn.execute("DELETE FROM items WHERE id = $1", item.id)
+            await self._new_conn.execute(
+                """
+                    DELETE FROM items
+                    WHERE profile_id = $1 AND kind = 2 AND category = $2 AND name = $3
+                """,
+                self._profile_id or 1,
+                item.category,
+                item.name,
+            )
+        if self._keep_ids:
+            item_id = await self._new_conn.fetchval(
+                """
+                    INSERT INTO items (id, profile_id, kind, category, name, value)
+                    VALUES ($1, $2, 2, $3, $4, $5) RETURNING id
+                """,
+                item.id,
+                self._profile_id or 1,
+                item.category,
+                item.name,
+                item.value,
+            )
+        else:
+            item_id = await self._new_conn.fetchval(
+                """
+                    INSERT INTO items (profile_id, kind, category, name, value)
+                    VALUES ($1, 2, $2, $3, $4) RETURNING id
+                """,
+                self._profile_id or 1,
+                item.category,
+                item.name,
+                item.value,
+            )
+        if item.tags:
+            await self._new_conn.executemany(
+                """
+                    INSERT INTO items_tags (item_id, plaintext, name, value)
+                    VALUES ($1, $2, $3, $4)
+                """,
+                ((item_id, *tag) for tag in item.tags),
+            )
+
+    async def insert_items(self, items: Sequence[AskarItem]):
+        """Insert converted items, leaving the source items in place."""
+        async with self._new_conn.transaction():
+            for item in items:
+                await self._insert_item(item)
+
+    async def remove_items(self, ids: Sequence[int]):
+        """Remove converted items by id, with their tags."""
+        await self._new_conn.execute(
+            "DELETE FROM items WHERE id = ANY($1::bigint[])", ids
+        )
+
+    async def update_items(self, items: Sequence[AskarItem]):
         """Update items in the database."""
-        del_ids = []
         for item in items:
-            del_ids = item["id"]
             async with self._new_conn.transaction():
-                ins = await self._new_conn.fetch(
-                    """
-                        INSERT INTO items (profile_id, kind, category, name, value)
-                        VALUES ($1, 2, $2, $3, $4) RETURNING id
-                    """,
-                    self._profile_id or 1,
-                    item["category"],
-                    item["name"],
-                    item["value"],
-                )
-                item_id = ins[0][0]
-                if item["tags"]:
-                    await self._new_conn.executemany(
-                        """
-                            INSERT INTO items_tags (item_id, plaintext, name, value)
-                            VALUES ($1, $2, $3, $4)
-                        """,
-                        ((item_id, *tag) for tag in item["tags"]),
-                    )
-                await self._old_conn.execute(
-                    f"DELETE FROM {self._items_table} WHERE id IN ($1)", del_ids
+                await self._insert_item(item)
+                await self._items_conn.execute(
+                    f"DELETE FROM {self._items_table} WHERE id IN ($1)", item.id
                 )
@@ -1,11 +1,75 @@
+import asyncio
 import base64
-from typing import Optional
+from typing import Dict, Optional, Sequence, Tuple
 
 from asyncpg import Connection
 import asyncpg
+from askar_tools.pg_pool import POOLS
 
-from .error import UpgradeError
-from .pg_connection import PgConnection, PgWallet
+from .batching import BatchSizer
+from .pg_connection import (
+    ITEM_COLUMNS,
+    ITEMS_INDEXES,
+    ITEMS_TAGS_INDEXES,
+    PgConnection,
+    PgWallet,
+)
+
+STAGING_TABLE = "items_staging"
+
+# Chunks of COPY data buffered between the source and target connections
+COPY_QUEUE_SIZE = 16
+
+
+async def scan_wallet_items(source: Connection, batcher: BatchSizer):
+    """Read the items of every wallet in id order, in a single pass.
+
+    Each row holds the item columns followed by the wallet_id of the item.
+    Rows may be deleted from the source while it is scanned.
+    """
+    last_id = 0
+    while True:
+        async with source.transaction():
+            cursor = await source.cursor(
+                f"""
+                {ITEM_COLUMNS}, i.wallet_id
+                FROM items i WHERE i.id > $2 ORDER BY i.id LIMIT $1
+                """,
+                batcher.size,
+                last_id,
+            )
+            rows = await batcher.collect(cursor.fetch)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield rows
+
+
+async def sample_wallets(
+    source: Connection, wallet_ids: Sequence[str]
+) -> Dict[str, Tuple[bytes, Optional[tuple]]]:
+    """Read the metadata and first item of each wallet, if it has any.
+
+    Wallets without a metadata row are left out.
+    """
+    rows = await source.fetch(
+        f"""
+        SELECT m.wallet_id, m.value, s.*
+        FROM metadata m LEFT JOIN LATERAL (
+            {ITEM_COLUMNS} FROM items i WHERE i.wallet_id = m.wallet_id
+            ORDER BY i.id LIMIT 1
+        ) s ON TRUE
+        WHERE m.wallet_id = ANY($1::text[])
+        """,
+        list(wallet_ids),
+    )
+    return {
+        row[0]: (
+            base64.b64decode(bytes.decode(row[1])),
+            tuple(row[2:]) if row[2] is not None else None,
+        )
+        for row in rows
+    }
 
 
 class PgMWSTConnection(PgConnection):
@@ -17,46 +81,28 @@ class PgMWSTConnection(PgConnection):
     async def connect(self):
         """Accessor for the connection pool instance."""
         if not self._conn:
-            self._conn = await self.connect_create_if_not_exists(self.parsed_url)
+            self._conn = await self.connect_create_if_not_exists()
 
-    async def connect_create_if_not_exists(self, parts):
+    async def connect_create_if_not_exists(self):
         try:
-            conn = await asyncpg.connect(
-                host=parts.hostname,
-                port=parts.port or 5432,
-                user=parts.username,
-                password=parts.password,
-                database=parts.path[1:],
-            )
+            conn = await POOLS.acquire(self.uri)
         except asyncpg.InvalidCatalogNameError:
             # Database does not exist, create it.
-            sys_conn = await asyncpg.connect(
-                host=parts.hostname,
-                port=parts.port or 5432,
-                user=parts.username,
-                password=parts.password,
-                database="template1",
-            )
-            await sys_conn.execute(
-                f'CREATE DATABASE "{parts.path[1:]}" OWNER "{parts.username}"'
-            )
-            await sys_conn.close()
+            parts = self.parsed_url
+            async with POOLS.admin_connection(self.uri) as sys_conn:
+                await sys_conn.execute(
+                    f'CREATE DATABASE "{parts.path[1:]}" OWNER "{parts.username}"'
+                )
 
             # Connect to the newly created database.
-            conn = await asyncpg.connect(
-                host=parts.hostname,
-                port=parts.port or 5432,
-                user=parts.username,
-                password=parts.password,
-                database=parts.path[1:],
-            )
+            conn = await POOLS.acquire(self.uri)
 
         return conn
 
     async def pre_upgrade(self):
         """Add new tables and columns."""
         await self._conn.execute(
-            """
+            f"""
             BEGIN TRANSACTION;
             CREATE TABLE config (
                 name TEXT NOT NULL,
@@ -71,7 +117,7 @@ class PgMWSTConnection(PgConnection):
                 PRIMARY KEY (id)
             );
             CREATE UNIQUE INDEX ix_profile_name ON profiles (name);
-            CREATE TABLE items (
+            CREATE {self.table_prefix}TABLE items (
                 id BIGSERIAL,
                 profile_id BIGINT NOT NULL,
                 kind SMALLINT NOT NULL,
@@ -83,9 +129,8 @@ class PgMWSTConnection(PgConnection):
                 FOREIGN KEY (profile_id) REFERENCES profiles (id)
                     ON DELETE CASCADE ON UPDATE CASCADE
             );
-            CREATE UNIQUE INDEX ix_items_uniq ON items
-                (profile_id, kind, category, name);
-            CREATE TABLE items_tags (
+            {self.create_indexes(ITEMS_INDEXES)}
+            CREATE {self.table_prefix}TABLE items_tags (
                 id BIGSERIAL,
                 item_id BIGINT NOT NULL,
                 name BYTEA NOT NULL,
@@ -95,25 +140,110 @@ class PgMWSTConnection(PgConnection):
                 FOREIGN KEY (item_id) REFERENCES items (id)
                     ON DELETE CASCADE ON UPDATE CASCADE
             );
-            CREATE INDEX ix_items_tags_item_id ON items_tags(item_id);
-            CREATE INDEX ix_items_tags_name_enc
-                ON items_tags(name, SUBSTR(value, 1, 12)) include (item_id)
-                WHERE plaintext=0;
-            CREATE INDEX ix_items_tags_name_plain
-                ON items_tags(name, value) include (item_id)
-                WHERE plaintext=1;
+            {self.create_indexes(ITEMS_TAGS_INDEXES)}
             COMMIT;
             """
         )
 
+    async def stage_items(self, source: Connection, wallet_id: str) -> int:
+        """Copy the raw items of a source wallet into the staging table.
+
+        The rows are streamed from a binary COPY on the source connection into
+        a binary COPY on this connection, without being decoded along the way.
+        Returns the number of rows staged.
+        """
+        await self._conn.execute(
+            f"""
+            DROP TABLE IF EXISTS {STAGING_TABLE};
+            CREATE UNLOGGED TABLE {STAGING_TABLE} (
+                id BIGINT NOT NULL,
+                type BYTEA NOT NULL,
+                name BYTEA NOT NULL,
+                value BYTEA NOT NULL,
+                key BYTEA NOT NULL,
+                tags_enc TEXT NULL,
+                tags_plain TEXT NULL,
+                PRIMARY KEY (id)
+            );
+            """
+        )
+        queue = asyncio.Queue(COPY_QUEUE_SIZE)
+
+        async def produce():
+            try:
+                await source.copy_from_query(
+                    f"""
+                    SELECT s.id::bigint, s.type::bytea, s.name::bytea,
+                        s.value::bytea, s.key::bytea, s.tags_enc, s.tags_plain
+                    FROM ({ITEM_COLUMNS} FROM items i WHERE i.wallet_id = $1) s
+                    """,
+                    wallet_id,
+                    output=queue.put,
+                    format="binary",
+                )
+            finally:
+                await queue.put(None)
+
+        async def chunks():
+            while (chunk := await queue.get()) is not None:
+                yield chunk
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            status = await self._conn.copy_to_table(
+                STAGING_TABLE, source=chunks(), format="binary"
+            )
+        except BaseException:
+            # A failed source COPY is the more useful error to report
+            if producer.done() and not producer.cancelled() and producer.exception():
+                raise producer.exception()
+            producer.cancel()
+            raise
+        await producer
+        return int(status.split()[-1])
+
     async def finish_upgrade(self):
         """Complete the upgrade."""
+        await self.build_deferred_indexes()
 
         await self._conn.execute(
-            """
+            f"""
+            DROP TABLE IF EXISTS {STAGING_TABLE};
             INSERT INTO config (name, value) VALUES ('version', 1);
+            -- Items inserted with their source ids leave the sequence behind
+            SELECT setval(pg_get_serial_sequence('items', 'id'), MAX(id)) FROM items;
             """
         )
 
     def get_wallet(self, old_conn: Connection, wallet_id: str) -> "PgWallet":
         return PgWallet(old_conn, self._conn, "items", wallet_id)
+
+    def get_staged_wallet(self, old_conn: Connection, wallet_id: str) -> "PgWallet":
+        return PgStagedWallet(old_conn, self._conn, wallet_id)
+
+
+class PgStagedWallet(PgWallet):
+    """A source wallet whose items were staged in the target database.
+
+    Metadata is still read from the source connection, while items are read
+    from and deleted in the staging table, leaving the source items in place.
+    """
+
+    def __init__(self, old_conn: Connection, new_conn: Connection, wallet_id: str):
+        super().__init__(old_conn, new_conn, STAGING_TABLE, wallet_id)
+        self._items_conn = new_conn
+
+    async def fetch_pending_items(self, batcher: BatchSizer):
+        """Fetch un-updated items from the staging table."""
+        while True:
+            rows = await self.fetch_batch(
+                batcher,
+                f"""
+                SELECT id, type, name, value, key, tags_enc, tags_plain
+                FROM {self._items_table} LIMIT $1
+                """,
+                batcher.size,
+            )
+            if not rows:
+                break
+            yield rows
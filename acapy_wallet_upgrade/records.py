@@ -0,0 +1,41 @@
+"""Record types passed between the wallet readers, the transform and the writers."""
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# (plaintext, name, value)
+Tag = Tuple[int, bytes, bytes]
+
+
+class IndyItem(NamedTuple):
+    """An item decrypted from an Indy SDK wallet."""
+
+    id: int
+    category: bytes
+    name: bytes
+    value: Optional[bytes]
+    tags: List[Tag]
+
+
+class AskarItem(NamedTuple):
+    """An item encrypted for insertion into an Askar store.
+
+    `id` is the id of the source row the item was produced from.
+    """
+
+    id: int
+    category: bytes
+    name: bytes
+    value: bytes
+    tags: List[Tag]
+
+
+class WalletStats(NamedTuple):
+    """Item and tag counts and sizes of one wallet in an Indy SDK database."""
+
+    wallet_id: Optional[str]
+    items: int
+    item_bytes: int
+    tags: int
+    tag_bytes: int
+    # Item counts by encrypted category
+    categories: Dict[bytes, int]
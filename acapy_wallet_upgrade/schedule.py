@@ -0,0 +1,192 @@
+"""Largest-first scheduling of wallet migrations on concurrent workers.
+
+Migrating wallets in the order they are listed or found can start the largest
+wallet last, leaving the other workers idle while it finishes. Each worker that
+becomes free instead takes the largest wallet waiting, sized by the bytes of
+its items and tags in the source database.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .records import WalletStats
+
+
+def makespan(durations: Sequence[float], workers: int) -> float:
+    """Time to run jobs on a number of workers, longest jobs first."""
+    lanes = [0.0] * max(1, min(workers, len(durations)))
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(lanes, lanes[0] + duration)
+    return max(lanes)
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m {seconds:02d}s"
+    return f"{minutes}m {seconds:02d}s"
+
+
+def wallet_cost(stats: Optional[WalletStats]) -> int:
+    """Bytes of items and tags read to migrate a wallet, 0 if unknown."""
+    return stats.item_bytes + stats.tag_bytes if stats else 0
+
+
+class WalletRun(NamedTuple):
+    """The migration of one wallet by a worker."""
+
+    wallet: str
+    items: int
+    cost: int
+    worker: int
+    # Seconds since the scheduler was created
+    started: float
+    seconds: float
+
+
+def fit_durations(runs: Sequence[WalletRun]) -> Tuple[float, float]:
+    """Fit the duration of a wallet migration as fixed plus per-byte seconds.
+
+    The fixed part covers the key derivations and store setup of each wallet.
+    """
+    if not runs:
+        return 0.0, 0.0
+    total_cost = sum(run.cost for run in runs)
+    total_seconds = sum(run.seconds for run in runs)
+    mean_cost = total_cost / len(runs)
+    mean_seconds = total_seconds / len(runs)
+    variance = sum((run.cost - mean_cost) ** 2 for run in runs)
+    if variance:
+        per_byte = (
+            sum((run.cost - mean_cost) * (run.seconds - mean_seconds) for run in runs)
+            / variance
+        )
+        fixed = mean_seconds - per_byte * mean_cost
+        if per_byte >= 0 and fixed >= 0:
+            return fixed, per_byte
+    if total_cost:
+        return 0.0, total_seconds / total_cost
+    return mean_seconds, 0.0
+
+
+class WalletScheduler:
+    """Hand out wallets to migration workers, largest first.
+
+    Wallets may be added while the workers run, as the `mwst-as-profiles`
+    strategy finds sub-wallets in the base wallet. The duration of each
+    migration is recorded for the run report.
+    """
+
+    def __init__(self, sizes: Dict[str, WalletStats], workers: int = 1):
+        """Initialize a WalletScheduler instance.
+
+        Args:
+            sizes: Statistics of the source wallets by wallet id, used to order
+                them. Wallets without statistics are migrated last.
+            workers: Number of workers taking wallets from the scheduler.
+        """
+        self.sizes = sizes
+        self.workers = workers
+        self.runs: List[WalletRun] = []
+        self.elapsed = 0.0
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._start = time.perf_counter()
+
+    def add(self, wallet: str, job: Any = None):
+        """Queue a wallet, with any data its migration needs."""
+        self._queue.put_nowait(
+            (0, -wallet_cost(self.sizes.get(wallet)), next(self._order), wallet, job)
+        )
+
+    def close(self):
+        """Let the workers stop once the queued wallets are migrated."""
+        for _ in range(self.workers):
+            self._queue.put_nowait((1, 0, next(self._order), None, None))
+
+    async def worker(self, number: int, migrate: Callable[[str, Any], Awaitable]):
+        """Migrate the largest queued wallet until the scheduler is closed."""
+        while True:
+            _, _, _, wallet, job = await self._queue.get()
+            if wallet is None:
+                break
+            start = time.perf_counter()
+            await migrate(wallet, job)
+            stats = self.sizes.get(wallet)
+            self.runs.append(
+                WalletRun(
+                    wallet,
+                    stats.items if stats else 0,
+                    wallet_cost(stats),
+                    number,
+                    start - self._start,
+                    time.perf_counter() - start,
+                )
+            )
+        self.elapsed = time.perf_counter() - self._start
+
+    def report(self, path: Optional[str] = None):
+        """Print the expected and actual duration of each wallet migration.
+
+        Expected durations are fitted to the sizes and durations of all the
+        migrated wallets, so wallets far from their expected duration stand
+        out. With a `path`, the report is also written there as JSON.
+        """
+        if not self.runs:
+            return
+        fixed, per_byte = fit_durations(self.runs)
+        expected = {run.wallet: fixed + per_byte * run.cost for run in self.runs}
+        print(
+            f"Migrated {len(self.runs)} wallet(s) with {self.workers} worker(s) in "
+            f"{format_seconds(self.elapsed)}, "
+            f"{format_seconds(makespan(list(expected.values()), self.workers))} "
+            "expected"
+        )
+        for run in sorted(self.runs, key=lambda run: run.started):
+            print(
+                f"  {run.wallet}: {run.items} items, {format_bytes(run.cost)}, "
+                f"worker {run.worker}, started at {format_seconds(run.started)}, "
+                f"took {format_seconds(run.seconds)}, "
+                f"expected {format_seconds(expected[run.wallet])}"
+            )
+        if path:
+            with open(path, "w") as report:
+                json.dump(
+                    {
+                        "workers": self.workers,
+                        "elapsed": self.elapsed,
+                        "fixed_seconds": fixed,
+                        "seconds_per_byte": per_byte,
+                        "wallets": [
+                            {**run._asdict(), "expected": expected[run.wallet]}
+                            for run in self.runs
+                        ],
+                    },
+                    report,
+                    indent=2,
+                )
@@ -0,0 +1,144 @@
+"""Indexes on a MultiWalletSingleTable source supporting the upgrade queries.
+
+The upgrade reads the items of each wallet by `wallet_id`, aggregates their
+tags by `item_id` and deletes each migrated item by `id`. Indy databases
+created without an index for one of these fall back to a sequential scan of
+the whole table for every batch or item. Missing indexes can be built before
+the upgrade and dropped once it is done.
+"""
+
+import json
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+from asyncpg import Connection
+
+from .pg_connection import ITEM_COLUMNS
+
+# Prefix of the indexes built by the upgrade, which are dropped afterwards
+INDEX_PREFIX = "ix_upgrade_"
+
+# Upgrade queries whose plans are reported: (label, query, example arguments)
+QUERIES: Sequence[Tuple[str, str, tuple]] = (
+    (
+        "Read the items of a wallet",
+        f"{ITEM_COLUMNS} FROM items i WHERE i.wallet_id = $1 LIMIT 50",
+        ("",),
+    ),
+    (
+        "Read all items in id order",
+        f"{ITEM_COLUMNS} FROM items i WHERE i.id > $1 ORDER BY i.id LIMIT 50",
+        (0,),
+    ),
+    ("Delete a migrated item", "DELETE FROM items WHERE id = $1", (0,)),
+)
+
+
+class SupportingIndex(NamedTuple):
+    """An index the upgrade queries benefit from."""
+
+    table: str
+    columns: Tuple[str, ...]
+    purpose: str
+
+    @property
+    def name(self) -> str:
+        return f"{INDEX_PREFIX}{self.table}_{'_'.join(self.columns)}"
+
+    def supported_by(self, index_columns: Sequence[str]) -> bool:
+        """Check whether an index with these leading columns serves as this one."""
+        return tuple(index_columns[: len(self.columns)]) == self.columns
+
+
+SUPPORTING_INDEXES = (
+    SupportingIndex("items", ("wallet_id",), "reading the items of a wallet"),
+    SupportingIndex("items", ("id",), "deleting migrated items by id"),
+    SupportingIndex("tags_encrypted", ("item_id",), "reading the tags of an item"),
+    SupportingIndex("tags_plaintext", ("item_id",), "reading the tags of an item"),
+)
+
+
+def plan_summary(plan: dict) -> str:
+    """Summarize an EXPLAIN plan as its nodes, outermost first, and total cost."""
+    nodes = []
+    pending = [plan]
+    while pending:
+        node = pending.pop(0)
+        desc = node["Node Type"]
+        if "Index Name" in node:
+            desc += f" using {node['Index Name']}"
+        elif "Relation Name" in node:
+            desc += f" on {node['Relation Name']}"
+        nodes.append(desc)
+        pending.extend(node.get("Plans", ()))
+    return f"{' > '.join(nodes)} (cost {plan['Total Cost']:.0f})"
+
+
+class SourceIndexes:
+    """Check for, build and drop the supporting indexes of a source database."""
+
+    def __init__(self, conn: Connection):
+        """Initialize a SourceIndexes instance."""
+        self._conn = conn
+        self.created: List[SupportingIndex] = []
+
+    async def missing(self) -> List[SupportingIndex]:
+        """List the supporting indexes without an equivalent on the source."""
+        rows = await self._conn.fetch(
+            """
+            SELECT c.relname AS table_name,
+                array_agg(a.attname ORDER BY k.n) AS columns
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+            WHERE c.relname = ANY($1::text[])
+                AND c.relnamespace = 'public'::regnamespace AND i.indisvalid
+            GROUP BY i.indexrelid, c.relname
+            """,
+            list({index.table for index in SUPPORTING_INDEXES}),
+        )
+        existing: Dict[str, List[List[str]]] = {}
+        for row in rows:
+            existing.setdefault(row["table_name"], []).append(row["columns"])
+        return [
+            index
+            for index in SUPPORTING_INDEXES
+            if not any(
+                index.supported_by(cols) for cols in existing.get(index.table, ())
+            )
+        ]
+
+    async def plans(self) -> Dict[str, str]:
+        """Summarize the current plans of the upgrade queries."""
+        plans = {}
+        for label, query, args in QUERIES:
+            explained = json.loads(
+                await self._conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+            )
+            plans[label] = plan_summary(explained[0]["Plan"])
+        return plans
+
+    async def create(self, indexes: Sequence[SupportingIndex]):
+        """Build indexes without blocking writes to the source tables."""
+        for index in indexes:
+            print(f"Building index {index.name} for {index.purpose}...")
+            try:
+                await self._conn.execute(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} "
+                    f"ON {index.table} ({', '.join(index.columns)})"
+                )
+            except Exception:
+                # A failed concurrent build leaves an invalid index behind
+                await self._conn.execute(f"DROP INDEX IF EXISTS {index.name}")
+                raise
+            self.created.append(index)
+        await self._conn.execute(
+            f"ANALYZE {', '.join(sorted({index.table for index in indexes}))}"
+        )
+
+    async def drop(self):
+        """Drop the indexes built by `create`."""
+        while self.created:
+            index = self.created.pop()
+            await self._conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+            print(f"Dropped index {index.name}")
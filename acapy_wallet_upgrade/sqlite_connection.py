@@ -1,9 +1,84 @@
-from typing import Optional
+import time
+from typing import Iterator, List, Optional, Sequence
 from urllib.parse import urlparse
+
 import aiosqlite
 
-from .db_connection import DbConnection, Wallet
+from .batching import BatchSizer
+from .db_connection import CHANGE_TABLES, CHANGES_TABLE, DbConnection, Wallet
 from .error import UpgradeError
+from .records import AskarItem, WalletStats
+
+# Tables and indexes of an Askar store
+STORE_TABLES = """
+    CREATE TABLE config (
+        name TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (name)
+    );
+
+    CREATE TABLE profiles (
+        id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        reference TEXT NULL,
+        profile_key BLOB NULL,
+        PRIMARY KEY (id)
+    );
+    CREATE UNIQUE INDEX ix_profile_name ON profiles (name);
+
+    CREATE TABLE items (
+        id INTEGER NOT NULL,
+        profile_id INTEGER NOT NULL,
+        kind INTEGER NOT NULL,
+        category BLOB NOT NULL,
+        name BLOB NOT NULL,
+        value BLOB NOT NULL,
+        expiry DATETIME NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY (profile_id) REFERENCES profiles (id)
+            ON DELETE CASCADE ON UPDATE CASCADE
+    );
+    CREATE UNIQUE INDEX ix_items_uniq ON items
+        (profile_id, kind, category, name);
+
+    CREATE TABLE items_tags (
+        id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        name BLOB NOT NULL,
+        value BLOB NOT NULL,
+        plaintext BOOLEAN NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY (item_id) REFERENCES items (id)
+            ON DELETE CASCADE ON UPDATE CASCADE
+    );
+    CREATE INDEX ix_items_tags_item_id ON items_tags (item_id);
+    CREATE INDEX ix_items_tags_name_enc ON items_tags
+        (name, SUBSTR(value, 1, 12)) WHERE plaintext=0;
+    CREATE INDEX ix_items_tags_name_plain ON items_tags
+        (name, value) WHERE plaintext=1;
+"""
+
+# Item columns as read by the upgrade, with tags aggregated as hex name:value pairs
+ITEM_COLUMNS = """
+    SELECT i.id, i.type, i.name, i.value, i.key,
+    (SELECT GROUP_CONCAT(HEX(te.name) || ':' || HEX(te.value))
+        FROM tags_encrypted te WHERE te.item_id = i.id) AS tags_enc,
+    (SELECT GROUP_CONCAT(HEX(tp.name) || ':' || HEX(tp.value))
+        FROM tags_plaintext tp WHERE tp.item_id = i.id) AS tags_plain
+"""
+
+# Host parameters allowed in a statement by SQLite builds before 3.32
+MAX_VARIABLES = 999
+
+# Rows of a changed Indy row whose item id is recorded, for each trigger event
+CHANGE_EVENTS = (("INSERT", ("NEW",)), ("UPDATE", ("OLD", "NEW")), ("DELETE", ("OLD",)))
+
+
+def id_chunks(ids: Sequence[int]) -> Iterator[Sequence[int]]:
+    """Split item ids into chunks that can each be bound to one statement."""
+    for start in range(0, len(ids), MAX_VARIABLES):
+        end = start + MAX_VARIABLES
+        yield ids[start:end]
 
 
 class SqliteConnection(DbConnection):
@@ -11,18 +86,24 @@ class SqliteConnection(DbConnection):
 
     DB_TYPE = "sqlite"
 
-    def __init__(self, uri: str):
+    def __init__(self, uri: str, read_only: bool = False):
         """Initialize a SqliteConnection instance."""
         self.uri = uri
         parsed = urlparse(uri)
         self._path = parsed.path
+        self.read_only = read_only
         self._conn: aiosqlite.Connection = None
         self._protocol: str = "sqlite"
 
     async def connect(self):
         """Accessor for the connection pool instance."""
         if not self._conn:
-            self._conn = await aiosqlite.connect(self._path)
+            if self.read_only:
+                self._conn = await aiosqlite.connect(
+                    f"file:{self._path}?mode=ro", uri=True
+                )
+            else:
+                self._conn = await aiosqlite.connect(self._path)
 
     async def find_table(self, name: str) -> bool:
         """Check for existence of a table."""
@@ -46,58 +127,12 @@ class SqliteConnection(DbConnection):
             return config
 
         await self._conn.executescript(
-            """
+            f"""
             BEGIN EXCLUSIVE TRANSACTION;
-
-            CREATE TABLE config (
-                name TEXT NOT NULL,
-                value TEXT,
-                PRIMARY KEY (name)
-            );
-
-            CREATE TABLE profiles (
-                id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                reference TEXT NULL,
-                profile_key BLOB NULL,
-                PRIMARY KEY (id)
-            );
-            CREATE UNIQUE INDEX ix_profile_name ON profiles (name);
-
             ALTER TABLE items RENAME TO items_old;
-            CREATE TABLE items (
-                id INTEGER NOT NULL,
-                profile_id INTEGER NOT NULL,
-                kind INTEGER NOT NULL,
-                category BLOB NOT NULL,
-                name BLOB NOT NULL,
-                value BLOB NOT NULL,
-                expiry DATETIME NULL,
-                PRIMARY KEY (id),
-                FOREIGN KEY (profile_id) REFERENCES profiles (id)
-                    ON DELETE CASCADE ON UPDATE CASCADE
-            );
-            CREATE UNIQUE INDEX ix_items_uniq ON items
-                (profile_id, kind, category, name);
-
-            CREATE TABLE items_tags (
-                id INTEGER NOT NULL,
-                item_id INTEGER NOT NULL,
-                name BLOB NOT NULL,
-                value BLOB NOT NULL,
-                plaintext BOOLEAN NOT NULL,
-                PRIMARY KEY (id),
-                FOREIGN KEY (item_id) REFERENCES items (id)
-                    ON DELETE CASCADE ON UPDATE CASCADE
-            );
-            CREATE INDEX ix_items_tags_item_id ON items_tags (item_id);
-            CREATE INDEX ix_items_tags_name_enc ON items_tags
-                (name, SUBSTR(value, 1, 12)) WHERE plaintext=0;
-            CREATE INDEX ix_items_tags_name_plain ON items_tags
-                (name, value) WHERE plaintext=1;
-
+            {STORE_TABLES}
             COMMIT;
-        """,
+            """
         )
 
     async def create_config(self, key: str, default_profile: Optional[str] = None):
@@ -135,13 +170,201 @@ class SqliteConnection(DbConnection):
             await self._conn.close()
             self._conn = None
 
-    def get_wallet(self) -> "SqliteWallet":
-        return SqliteWallet(self._conn)
+    async def wallet_stats(self) -> List[WalletStats]:
+        """Collect item and tag statistics for the Indy wallet, read-only."""
+        categories = {}
+        items = item_bytes = 0
+        stmt = await self._conn.execute(
+            """
+            SELECT type, COUNT(*), SUM(LENGTH(CAST(type AS BLOB))
+                + LENGTH(CAST(name AS BLOB)) + LENGTH(CAST(value AS BLOB))
+                + LENGTH(CAST(key AS BLOB)))
+            FROM items GROUP BY type
+            """
+        )
+        async for category, count, size in stmt:
+            categories[category] = count
+            items += count
+            item_bytes += size
+        stmt = await self._conn.execute(
+            """
+            SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (
+                SELECT LENGTH(CAST(name AS BLOB)) + LENGTH(CAST(value AS BLOB))
+                    AS size FROM tags_encrypted
+                UNION ALL
+                SELECT LENGTH(CAST(name AS BLOB)) + LENGTH(CAST(value AS BLOB))
+                    AS size FROM tags_plaintext
+            )
+            """
+        )
+        tags, tag_bytes = await stmt.fetchone()
+        return [WalletStats(None, items, item_bytes, tags, tag_bytes, categories)]
+
+    async def disk_usage(self) -> int:
+        """Size in bytes of the database file."""
+        page_count = await (await self._conn.execute("PRAGMA page_count")).fetchone()
+        page_size = await (await self._conn.execute("PRAGMA page_size")).fetchone()
+        return page_count[0] * page_size[0]
+
+    async def time_insert(self, items: Sequence[AskarItem]) -> float:
+        """Time inserting items into scratch tables that are discarded after."""
+        await self._conn.execute("SAVEPOINT estimate")
+        try:
+            await self._conn.execute(
+                """
+                CREATE TEMP TABLE estimate_items (
+                    id INTEGER NOT NULL,
+                    profile_id INTEGER NOT NULL,
+                    kind INTEGER NOT NULL,
+                    category BLOB NOT NULL,
+                    name BLOB NOT NULL,
+                    value BLOB NOT NULL,
+                    expiry DATETIME NULL,
+                    PRIMARY KEY (id)
+                )
+                """
+            )
+            await self._conn.execute(
+                """
+                CREATE UNIQUE INDEX temp.ix_estimate_items_uniq ON estimate_items
+                    (profile_id, kind, category, name)
+                """
+            )
+            await self._conn.execute(
+                """
+                CREATE TEMP TABLE estimate_items_tags (
+                    id INTEGER NOT NULL,
+                    item_id INTEGER NOT NULL,
+                    name BLOB NOT NULL,
+                    value BLOB NOT NULL,
+                    plaintext BOOLEAN NOT NULL,
+                    PRIMARY KEY (id)
+                )
+                """
+            )
+            for index in (
+                "ix_estimate_items_tags_item_id ON estimate_items_tags (item_id)",
+                "ix_estimate_items_tags_name_enc ON estimate_items_tags "
+                "(name, SUBSTR(value, 1, 12)) WHERE plaintext=0",
+                "ix_estimate_items_tags_name_plain ON estimate_items_tags "
+                "(name, value) WHERE plaintext=1",
+            ):
+                await self._conn.execute(f"CREATE INDEX temp.{index}")
+            start = time.perf_counter()
+            for item in items:
+                ins = await self._conn.execute(
+                    """
+                    INSERT INTO estimate_items (profile_id, kind, category, name, value)
+                    VALUES (1, 2, ?1, ?2, ?3)
+                    """,
+                    (item.category, item.name, item.value),
+                )
+                if item.tags:
+                    await self._conn.executemany(
+                        """
+                        INSERT INTO estimate_items_tags (item_id, plaintext, name, value)
+                        VALUES (?1, ?2, ?3, ?4)
+                        """,
+                        ((ins.lastrowid, *tag) for tag in item.tags),
+                    )
+            return time.perf_counter() - start
+        finally:
+            await self._conn.execute("ROLLBACK TO estimate")
+            await self._conn.execute("RELEASE estimate")
+
+    async def capture_changes(self):
+        """Record the ids of the Indy items changed from now on."""
+        await self.drop_change_capture()
+        statements = [
+            f"CREATE TABLE {CHANGES_TABLE} (item_id INTEGER NOT NULL, "
+            "PRIMARY KEY (item_id));"
+        ]
+        for table, column in CHANGE_TABLES:
+            for event, rows in CHANGE_EVENTS:
+                record = " ".join(
+                    f"INSERT OR IGNORE INTO {CHANGES_TABLE} VALUES ({row}.{column});"
+                    for row in rows
+                )
+                statements.append(
+                    f"CREATE TRIGGER {CHANGES_TABLE}_{table}_{event.lower()} "
+                    f"AFTER {event} ON {table} BEGIN {record} END;"
+                )
+        await self._conn.executescript(
+            "BEGIN EXCLUSIVE TRANSACTION; {} COMMIT;".format(" ".join(statements))
+        )
+
+    async def changed_item_ids(self, after: int, limit: int) -> List[int]:
+        """Fetch recorded ids of changed items in order, starting after an id."""
+        stmt = await self._conn.execute(
+            f"""
+            SELECT item_id FROM {CHANGES_TABLE} WHERE item_id > ?1
+            ORDER BY item_id LIMIT ?2
+            """,
+            (after, limit),
+        )
+        return [row[0] for row in await stmt.fetchall()]
+
+    async def drop_change_capture(self):
+        """Stop recording changes and drop the recorded ids."""
+        statements = [
+            f"DROP TRIGGER IF EXISTS {CHANGES_TABLE}_{table}_{event.lower()};"
+            for table, _ in CHANGE_TABLES
+            for event, _ in CHANGE_EVENTS
+        ]
+        await self._conn.executescript(
+            "BEGIN EXCLUSIVE TRANSACTION; {} DROP TABLE IF EXISTS {}; COMMIT;".format(
+                " ".join(statements), CHANGES_TABLE
+            )
+        )
+
+    def get_wallet(self, items_table: str = "items_old") -> "SqliteWallet":
+        return SqliteWallet(self._conn, items_table)
+
+    def get_store_wallet(
+        self, keep_ids: bool = False, replace: bool = False
+    ) -> "SqliteWallet":
+        """Get a wallet inserting converted items into the Askar store.
+
+        With `keep_ids`, items keep their source ids. With `replace`, they
+        also replace any item holding the same id or name, so they can be
+        migrated again.
+        """
+        return SqliteWallet(self._conn, "items", keep_ids, replace)
+
+
+class SqliteStoreConnection(SqliteConnection):
+    """Sqlite connection to a new database holding only an Askar store."""
+
+    async def pre_upgrade(self):
+        """Create the store tables."""
+        await self._conn.executescript(
+            f"""
+            BEGIN EXCLUSIVE TRANSACTION;
+            {STORE_TABLES}
+            COMMIT;
+            """
+        )
+
+    async def finish_upgrade(self):
+        """Complete the upgrade."""
+        await self._conn.execute(
+            "INSERT INTO config (name, value) VALUES ('version', '1')"
+        )
+        await self._conn.commit()
 
 
 class SqliteWallet(Wallet):
-    def __init__(self, conn: aiosqlite.Connection):
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        items_table: str = "items_old",
+        keep_ids: bool = False,
+        replace: bool = False,
+    ):
         self._conn = conn
+        self._items_table = items_table
+        self._keep_ids = keep_ids or replace
+        self._replace = replace
 
     async def insert_profile(self, name: str, key: bytes):
         """Insert the initial profile."""
@@ -161,49 +384,114 @@ class SqliteWallet(Wallet):
 
         return found
 
-    async def fetch_pending_items(self, batch_size: int):
+    async def fetch_pending_items(self, batcher: BatchSizer):
         """Fetch un-updated items."""
         while True:
             stmt = await self._conn.execute(
-                """
-                SELECT i.id, i.type, i.name, i.value, i.key,
-                (SELECT GROUP_CONCAT(HEX(te.name) || ':' || HEX(te.value))
-                    FROM tags_encrypted te WHERE te.item_id = i.id) AS tags_enc,
-                (SELECT GROUP_CONCAT(HEX(tp.name) || ':' || HEX(tp.value))
-                    FROM tags_plaintext tp WHERE tp.item_id = i.id) AS tags_plain
-                FROM items_old i LIMIT ?1
+                f"{ITEM_COLUMNS} FROM {self._items_table} i LIMIT ?1",
+                (batcher.size,),
+            )
+            rows = await batcher.collect(stmt.fetchmany)
+            await stmt.close()
+            if not rows:
+                break
+            yield rows
+
+    async def scan_items(self, batcher: BatchSizer):
+        """Fetch all items in id order, without modifying them."""
+        last_id = 0
+        while True:
+            stmt = await self._conn.execute(
+                f"""
+                {ITEM_COLUMNS}
+                FROM {self._items_table} i WHERE i.id > ?1 ORDER BY i.id LIMIT ?2
                 """,
-                (batch_size,),
+                (last_id, batcher.size),
             )
-            rows = await stmt.fetchall()
+            rows = await batcher.collect(stmt.fetchmany)
+            await stmt.close()
             if not rows:
                 break
+            last_id = rows[-1][0]
             yield rows
 
-    async def update_items(self, items):
-        """Update items in the database."""
-        del_ids = []
-        for item in items:
-            del_ids.append(item["id"])
-            ins = await self._conn.execute(
-                """
-                INSERT INTO items (profile_id, kind, category, name, value)
-                VALUES (1, 2, ?1, ?2, ?3)
+    async def fetch_items(self, ids: Sequence[int]):
+        """Fetch the items with the given ids that still exist, in id order."""
+        ids = sorted(ids)
+        rows = []
+        for chunk in id_chunks(ids):
+            stmt = await self._conn.execute(
+                f"""
+                {ITEM_COLUMNS}
+                FROM {self._items_table} i WHERE i.id IN ({",".join("?" * len(chunk))})
+                ORDER BY i.id
                 """,
-                (item["category"], item["name"], item["value"]),
+                chunk,
             )
+            rows.extend(await stmt.fetchall())
+        return rows
+
+    async def _delete_items(self, condition: str, args: Sequence):
+        # Foreign keys are not enforced on this connection, so tags are not
+        # removed along with their items
+        await self._conn.execute(
+            "DELETE FROM items_tags WHERE item_id IN "
+            f"(SELECT id FROM items WHERE {condition})",
+            args,
+        )
+        await self._conn.execute(f"DELETE FROM items WHERE {condition}", args)
+
+    async def _insert_items(self, items: Sequence[AskarItem]):
+        for item in items:
+            if self._replace:
+                await self._delete_items(
+                    "id = ?1 OR (profile_id = 1 AND kind = 2 "
+                    "AND category = ?2 AND name = ?3)",
+                    (item.id, item.category, item.name),
+                )
+            if self._keep_ids:
+                ins = await self._conn.execute(
+                    """
+                    INSERT INTO items (id, profile_id, kind, category, name, value)
+                    VALUES (?1, 1, 2, ?2, ?3, ?4)
+                    """,
+                    (item.id, item.category, item.name, item.value),
+                )
+            else:
+                ins = await self._conn.execute(
+                    """
+                    INSERT INTO items (profile_id, kind, category, name, value)
+                    VALUES (1, 2, ?1, ?2, ?3)
+                    """,
+                    (item.category, item.name, item.value),
+                )
             item_id = ins.lastrowid
-            if item["tags"]:
+            if item.tags:
                 await self._conn.executemany(
                     """
                     INSERT INTO items_tags (item_id, plaintext, name, value)
                     VALUES (?1, ?2, ?3, ?4)
                     """,
-                    ((item_id, *tag) for tag in item["tags"]),
+                    ((item_id, *tag) for tag in item.tags),
                 )
+
+    async def insert_items(self, items: Sequence[AskarItem]):
+        """Insert converted items, leaving the source items in place."""
+        await self._insert_items(items)
+        await self._conn.commit()
+
+    async def remove_items(self, ids: Sequence[int]):
+        """Remove converted items by id, with their tags."""
+        for chunk in id_chunks(ids):
+            await self._delete_items(f"id IN ({','.join('?' * len(chunk))})", chunk)
+        await self._conn.commit()
+
+    async def update_items(self, items: Sequence[AskarItem]):
+        """Update items in the database."""
+        await self._insert_items(items)
         await self._conn.execute(
-            "DELETE FROM items_old WHERE id IN ({})".format(
-                ",".join([str(del_id) for del_id in del_ids])
+            "DELETE FROM {} WHERE id IN ({})".format(
+                self._items_table, ",".join([str(item.id) for item in items])
             )
         )
         await self._conn.commit()
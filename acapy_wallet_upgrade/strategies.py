@@ -1,37 +1,120 @@
+import asyncio
 import base64
 import contextlib
 import hashlib
-import hmac
 import json
 import logging
-import os
 import re
 import sys
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, Union, cast
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 from urllib.parse import urlparse
 
-import asyncpg
 import base58
 import cbor2
 import msgpack
 import nacl.pwhash
 from aries_askar import Key, Session, Store
+from askar_tools.key_methods import KEY_METHODS
 from nacl.exceptions import CryptoError
 
-from .db_connection import DbConnection, Wallet
+from .batching import BatchSizer, row_size
+from .crypto import (
+    CHACHAPOLY_KEY_LEN,
+    DEFAULT_CACHE_SIZE,
+    CryptoContext,
+    decrypt_merged,
+    encrypt_merged,
+)
+from .db_connection import CHANGES_TABLE, DbConnection, OutOfPlaceWallet, Wallet
 from .error import DecryptionFailedError, MissingWalletError, UpgradeError
-from .pg_connection import PgConnection, PgWallet
-from .pg_mwst_connection import PgMWSTConnection
-from .sqlite_connection import SqliteConnection
+from .records import AskarItem, IndyItem, WalletStats
+from .schedule import WalletScheduler
+
+if TYPE_CHECKING:
+    # The Postgres backends import asyncpg, so they are only loaded when used
+    from .pg_connection import PgWallet
+    from .pg_mwst_connection import PgMWSTConnection
+    from .source_indexes import SourceIndexes
 
 LOGGER = logging.getLogger(__name__)
 
-# Constants
-CHACHAPOLY_KEY_LEN = 32
-CHACHAPOLY_NONCE_LEN = 12
-CHACHAPOLY_TAG_LEN = 16
-ENCRYPTED_KEY_LEN = CHACHAPOLY_NONCE_LEN + CHACHAPOLY_KEY_LEN + CHACHAPOLY_TAG_LEN
+# Categories the Askar conversion pass would only rename, keeping the value and
+# dropping any tags. Items in them get their Askar category as they are migrated.
+PASSTHROUGH_CATEGORIES = {
+    b"Indy::Schema": b"schema",
+    b"Indy::RevocationRegistryDefinition": b"revocation_reg_def",
+    b"Indy::RevocationRegistryDefinitionPrivate": b"revocation_reg_def_private",
+    b"Indy::RevocationRegistry": b"revocation_reg",
+    b"Indy::RevocationRegistryInfo": b"revocation_reg_info",
+}
+
+# Argon2i limits of the Indy key derivation methods; RAW keys are used as given
+ARGON2I_LIMITS = {
+    "ARGON2I_INT": (
+        nacl.pwhash.argon2i.OPSLIMIT_INTERACTIVE,
+        nacl.pwhash.argon2i.MEMLIMIT_INTERACTIVE,
+    ),
+    "ARGON2I_MOD": (
+        nacl.pwhash.argon2i.OPSLIMIT_MODERATE,
+        nacl.pwhash.argon2i.MEMLIMIT_MODERATE,
+    ),
+}
+DEFAULT_KEY_METHOD = "ARGON2I_MOD"
+
+
+def check_key_method(key_method: str) -> str:
+    if key_method not in KEY_METHODS:
+        raise UpgradeError(
+            f"Unknown key derivation method {key_method}, "
+            f"expected one of: {', '.join(KEY_METHODS)}"
+        )
+    return key_method
+
+
+def split_wallet_keys(
+    entries: Dict[str, Union[str, dict]], key_method: str = DEFAULT_KEY_METHOD
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Split wallet keys entries into the keys and key derivation methods.
+
+    Each entry is either the wallet key, derived with `key_method`, or an
+    object with the `key` and its `key_derivation_method`.
+    """
+    keys = {}
+    methods = {}
+    for name, entry in entries.items():
+        if isinstance(entry, dict):
+            if "key" not in entry:
+                raise UpgradeError(f"No key given for wallet {name}")
+            keys[name] = entry["key"]
+            methods[name] = check_key_method(
+                entry.get("key_derivation_method", key_method)
+            )
+        else:
+            keys[name] = entry
+            methods[name] = check_key_method(key_method)
+    return keys, methods
+
+
+def store_key_reference(key_method: str, salt: Optional[bytes]) -> str:
+    """The Askar store key reference matching an Indy key derivation method."""
+    if key_method == "RAW":
+        return "raw"
+    # kdf:argon2i:int or kdf:argon2i:mod
+    level = KEY_METHODS[key_method].rsplit(":", 1)[1]
+    return f"kdf:argon2i:13:{level}?salt={salt.hex()}"
 
 
 class Progress:
@@ -74,120 +157,203 @@ class Progress:
             print(f"{self.message} {self.count}")
 
 
-class Strategy(ABC):
-    """Base class for upgrade strategies."""
+async def gather_or_cancel(*aws: Awaitable):
+    """Run awaitables concurrently, cancelling the rest if one fails."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
-    def __init__(self, batch_size: int):
-        self.batch_size = batch_size
 
-    def encrypt_merged(
-        self, message: bytes, my_key: bytes, hmac_key: bytes = None
-    ) -> bytes:
-        if hmac_key:
-            nonce = hmac.HMAC(hmac_key, message, digestmod=hashlib.sha256).digest()[
-                :CHACHAPOLY_NONCE_LEN
-            ]
-        else:
-            nonce = os.urandom(CHACHAPOLY_NONCE_LEN)
+class ChunkedTransaction:
+    """A store transaction committed every `commit_every` converted records.
 
-        ciphertext = nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt(
-            message, None, nonce, my_key
-        )
+    Stands in for the transaction of a conversion pass. Each record is removed
+    from its Indy category in the transaction that inserts its replacement,
+    so a commit only ever holds whole records. A pass stopped between commits
+    converts the records left in the Indy category when it is run again.
+    """
+
+    def __init__(self, store: Store, commit_every: Optional[int] = None):
+        self.store = store
+        self.commit_every = commit_every
+        self.pending = 0
+        self._session: Optional[Session] = None
+
+    async def __aenter__(self) -> "ChunkedTransaction":
+        self._session = await self.store.transaction()
+        return self
+
+    async def __aexit__(self, *exc):
+        # A no-op once committed; otherwise the open chunk is rolled back
+        await self._session.close()
+
+    async def checkpoint(self, count: int):
+        """Count converted records, committing once enough are pending."""
+        self.pending += count
+        if self.commit_every and self.pending >= self.commit_every:
+            await self._session.commit()
+            self._session = await self.store.transaction()
+            self.pending = 0
 
-        return nonce + ciphertext
+    async def fetch(self, category: str, name: str):
+        return await self._session.fetch(category, name)
 
-    def encrypt_value(
-        self, category: bytes, name: bytes, value: bytes, hmac_key: bytes
-    ) -> bytes:
-        hasher = hmac.HMAC(hmac_key, digestmod=hashlib.sha256)
-        hasher.update(len(category).to_bytes(4, "big"))
-        hasher.update(category)
-        hasher.update(len(name).to_bytes(4, "big"))
-        hasher.update(name)
-        value_key = hasher.digest()
-        return self.encrypt_merged(value, value_key)
+    async def fetch_all(self, category: str, limit: Optional[int] = None):
+        return await self._session.fetch_all(category, limit=limit)
+
+    async def insert(self, category: str, name: str, **kwargs):
+        await self._session.insert(category, name, **kwargs)
+
+    async def insert_key(self, name: str, key: Key, **kwargs):
+        await self._session.insert_key(name, key, **kwargs)
+
+    async def remove(self, category: str, name: str):
+        await self._session.remove(category, name)
+
+    async def commit(self):
+        await self._session.commit()
+
+
+class Strategy(ABC):
+    """Base class for upgrade strategies."""
+
+    def __init__(
+        self,
+        batch_size: Union[int, BatchSizer],
+        commit_every: Optional[int] = None,
+        crypto_cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        if not isinstance(batch_size, BatchSizer):
+            batch_size = BatchSizer(batch_size)
+        self.batcher = batch_size
+        self.convert_batcher = batch_size.fork()
+        self.throttle = batch_size.throttle
+        self.commit_every = commit_every
+        self.crypto_cache_size = crypto_cache_size
+        # Unlocked wallet keys, by a digest of the metadata and wallet key
+        self.unlocked_keys: Dict[bytes, dict] = {}
+
+    def wallet_context(self, indy_key: dict) -> CryptoContext:
+        """Create the crypto context items are decrypted with for a wallet."""
+        return CryptoContext(indy_key, self.crypto_cache_size)
+
+    def profile_context(self, profile_key: dict) -> CryptoContext:
+        """Create the crypto context items are encrypted with for a profile."""
+        return CryptoContext(profile_key, self.crypto_cache_size)
+
+    @property
+    def batch_size(self) -> int:
+        return self.batcher.size
+
+    def report_batch_sizes(self, batcher: BatchSizer):
+        for summary in (batcher.report(), batcher.throttle.report()):
+            if summary:
+                print(summary)
+
+    def report_caches(
+        self, indy_key: CryptoContext, profile_key: CryptoContext, prefix: str = ""
+    ):
+        for label, context in (("Decryption", indy_key), ("Encryption", profile_key)):
+            summary = context.cache_report()
+            if summary:
+                print(f"{prefix}{label} cache: {summary}")
 
     def decrypt_merged(self, enc_value: bytes, key: bytes, b64: bool = False) -> bytes:
         if b64:
             enc_value = base64.b64decode(enc_value)
-
-        nonce, ciphertext = (
-            enc_value[:CHACHAPOLY_NONCE_LEN],
-            enc_value[CHACHAPOLY_NONCE_LEN:],
-        )
-        return nacl.bindings.crypto_aead_chacha20poly1305_ietf_decrypt(
-            ciphertext, None, nonce, key
+        return decrypt_merged(enc_value, key)
+
+    def decrypt_item(
+        self, row: tuple, keys: CryptoContext, b64: bool = False
+    ) -> IndyItem:
+        return keys.decrypt_item(row, b64)
+
+    def rename_item(self, item: IndyItem) -> IndyItem:
+        """Move an item in a pass-through category to its Askar category."""
+        category = PASSTHROUGH_CATEGORIES.get(item.category)
+        if category:
+            return item._replace(category=category, tags=[])
+        return item
+
+    def update_item(self, item: IndyItem, key: CryptoContext) -> AskarItem:
+        value_key = key.value_key(item.category, item.name, "ihk")
+        fields = [(item.category, "ihk", "ick")]
+        for plain, k, v in item.tags:
+            fields.append((k, "thk", "tnk"))
+            if not plain:
+                fields.append((v, "thk", "tvk"))
+        # Item names are unique, so they are encrypted without the cache
+        enc = key.encrypt_searchable(
+            fields,
+            [
+                (key.nonce(item.name, "ihk"), item.name, key["ink"]),
+                (key.nonce(item.value), item.value, value_key),
+            ],
         )
 
-    def decrypt_tags(self, tags: str, name_key: bytes, value_key: Optional[bytes] = None):
-        for tag in tags.split(","):
-            tag_name, tag_value = map(bytes.fromhex, tag.split(":"))
-            name = self.decrypt_merged(tag_name, name_key)
-            value = self.decrypt_merged(tag_value, value_key) if value_key else tag_value
-            yield name, value
-
-    def decrypt_item(self, row: tuple, keys: dict, b64: bool = False):
-        row_id, row_type, row_name, row_value, row_key, tags_enc, tags_plain = row
-        value_key = self.decrypt_merged(row_key, keys["value"])
-        value = self.decrypt_merged(row_value, value_key) if row_value else None
-        tags = [
-            (0, k, v)
-            for k, v in (
-                self.decrypt_tags(tags_enc, keys["tag_name"], keys["tag_value"])
-                if tags_enc
-                else ()
-            )
-        ]
-        for k, v in self.decrypt_tags(tags_plain, keys["tag_name"]) if tags_plain else ():
-            tags.append((1, k, v))
-        return {
-            "id": row_id,
-            "type": self.decrypt_merged(row_type, keys["type"], b64),
-            "name": self.decrypt_merged(row_name, keys["name"], b64),
-            "value": value,
-            "tags": tags,
-        }
-
-    def update_item(self, item: dict, key: dict) -> dict:
         tags = []
-        for plain, k, v in item["tags"]:
-            if not plain:
-                v = self.encrypt_merged(v, key["tvk"], key["thk"])
-            k = self.encrypt_merged(k, key["tnk"], key["thk"])
-            tags.append((plain, k, v))
-
-        ret_val = {
-            "id": item["id"],
-            "category": self.encrypt_merged(item["type"], key["ick"], key["ihk"]),
-            "name": self.encrypt_merged(item["name"], key["ink"], key["ihk"]),
-            "value": self.encrypt_value(
-                item["type"], item["name"], item["value"], key["ihk"]
-            ),
-            "tags": tags,
-        }
+        pos = 1
+        for plain, k, v in item.tags:
+            if plain:
+                tags.append((plain, enc[pos], v))
+                pos += 1
+            else:
+                tags.append((plain, enc[pos], enc[pos + 1]))
+                pos += 2
+
+        return AskarItem(item.id, enc[0], enc[pos], enc[pos + 1], tags)
 
-        return ret_val
+    async def write_items(
+        self, write: Callable[[List[AskarItem]], Awaitable], items: List[AskarItem]
+    ):
+        """Write a batch of migrated items within the statement limit.
+
+        The items were paced by the throttle as they were read, so they are
+        not charged to the rate limits again.
+        """
+        async with self.throttle.statement():
+            await write(items)
 
     async def update_items(
         self,
         wallet: Wallet,
-        indy_key: dict,
-        profile_key: dict,
+        indy_key: CryptoContext,
+        profile_key: CryptoContext,
+        on_item: Optional[Callable[[IndyItem], None]] = None,
+        batcher: Optional[BatchSizer] = None,
     ):
-        progress = Progress("Migrating items...", interval=self.batch_size)
+        """Migrate the items of a wallet.
+
+        Concurrent migrations each pass their own `batcher`, so that one does
+        not size the batches of another.
+        """
+        batcher = batcher or self.batcher
+        progress = Progress("Migrating items...", interval=batcher.size)
         decrypted_at_least_one = False
         try:
-            async for rows in wallet.fetch_pending_items(self.batch_size):
+            start = time.perf_counter()
+            async for rows in wallet.fetch_pending_items(batcher):
                 upd = []
                 for row in rows:
-                    result = self.decrypt_item(
-                        row, indy_key, b64=isinstance(wallet, PgWallet)
-                    )
+                    result = self.decrypt_item(row, indy_key, b64=wallet.NAMES_B64)
                     decrypted_at_least_one = True
-                    upd.append(self.update_item(result, profile_key))
-                await wallet.update_items(upd)
+                    if on_item:
+                        on_item(result)
+                    upd.append(self.update_item(self.rename_item(result), profile_key))
+                await self.write_items(wallet.update_items, upd)
+                batcher.observe(
+                    len(rows), sum(map(row_size, rows)), time.perf_counter() - start
+                )
                 progress.update(len(upd))
+                start = time.perf_counter()
             progress.report()
+            self.report_batch_sizes(batcher)
+            self.report_caches(indy_key, profile_key)
         except CryptoError as err:
             if decrypted_at_least_one:
                 raise UpgradeError(
@@ -196,20 +362,56 @@ class Strategy(ABC):
             else:
                 raise DecryptionFailedError("Could not decrypt any items from wallet")
 
-    async def fetch_indy_key(self, wallet: Wallet, wallet_key: str) -> dict:
-        metadata_json = await wallet.get_metadata()
+    async def fetch_indy_key(
+        self, wallet: Wallet, wallet_key: str, key_method: str = DEFAULT_KEY_METHOD
+    ) -> dict:
+        return await self.unlock_indy_key(
+            await wallet.get_metadata(), wallet_key, key_method
+        )
+
+    async def unlock_indy_key(
+        self,
+        metadata_json: Union[str, bytes],
+        wallet_key: str,
+        key_method: str = DEFAULT_KEY_METHOD,
+        executor: Optional[Executor] = None,
+    ) -> dict:
+        """Derive the master key of a wallet and decrypt its keys.
+
+        Keys already unlocked by a preflight check are reused.
+        """
+        digest = hashlib.sha256(
+            json.dumps(
+                [metadata_json, wallet_key, key_method], default=bytes.hex
+            ).encode()
+        ).digest()
+        if digest in self.unlocked_keys:
+            return self.unlocked_keys[digest]
+
         metadata = json.loads(metadata_json)
         keys_enc = bytes(metadata["keys"])
-        salt = bytes(metadata["master_key_salt"])
-
-        salt = salt[:16]
-        master_key = nacl.pwhash.argon2i.kdf(
-            CHACHAPOLY_KEY_LEN,
-            wallet_key.encode("ascii"),
-            salt,
-            nacl.pwhash.argon2i.OPSLIMIT_MODERATE,
-            nacl.pwhash.argon2i.MEMLIMIT_MODERATE,
-        )
+
+        if check_key_method(key_method) == "RAW":
+            # Raw keys have no salt, the wallet key is the base58 master key
+            salt = None
+            try:
+                master_key = base58.b58decode(wallet_key)
+            except ValueError:
+                master_key = b""
+            if len(master_key) != CHACHAPOLY_KEY_LEN:
+                raise CryptoError("Raw wallet key is not a base58 encoded 32 byte key")
+        else:
+            salt = bytes(metadata["master_key_salt"])[:16]
+            # Derived in a thread so other wallets can be migrated meanwhile;
+            # PyNaCl releases the GIL while deriving
+            master_key = await asyncio.get_running_loop().run_in_executor(
+                executor,
+                nacl.pwhash.argon2i.kdf,
+                CHACHAPOLY_KEY_LEN,
+                wallet_key.encode("ascii"),
+                salt,
+                *ARGON2I_LIMITS[key_method],
+            )
 
         keys_mpk = self.decrypt_merged(keys_enc, master_key)
         keys_lst = msgpack.unpackb(keys_mpk)
@@ -229,20 +431,37 @@ class Strategy(ABC):
         )
         keys["master"] = master_key
         keys["salt"] = salt
+        keys["store_key"] = store_key_reference(key_method, salt)
+        self.unlocked_keys[digest] = keys
         return keys
 
-    async def batched_fetch_all(self, txn: Session, category: str):
+    def conversion_transaction(self, store: Store) -> ChunkedTransaction:
+        return ChunkedTransaction(store, self.commit_every)
+
+    async def batched_fetch_all(
+        self, txn: ChunkedTransaction, batcher: Optional[BatchSizer], category: str
+    ):
+        batcher = batcher or self.convert_batcher
         while True:
-            items = await txn.fetch_all(category, limit=self.batch_size)
+            start = time.perf_counter()
+            async with self.throttle.statement():
+                items = await txn.fetch_all(category, limit=batcher.size)
             if not items:
                 break
+            await self.throttle.pace(len(items), sum(len(row.value) for row in items))
             for row in items:
                 yield row
+            batcher.observe(
+                len(items),
+                sum(len(row.value) for row in items),
+                time.perf_counter() - start,
+            )
+            await txn.checkpoint(len(items))
 
-    async def update_keys(self, store: Store):
+    async def update_keys(self, store: Store, batcher: Optional[BatchSizer] = None):
         progress = Progress("Updating keys...", interval=self.batch_size)
-        async with store.transaction() as txn:
-            async for row in self.batched_fetch_all(txn, "Indy::Key"):
+        async with self.conversion_transaction(store) as txn:
+            async for row in self.batched_fetch_all(txn, batcher, "Indy::Key"):
                 await txn.remove("Indy::Key", row.name)
                 meta = await txn.fetch("Indy::KeyMetadata", row.name)
                 if meta:
@@ -255,10 +474,12 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_master_keys(self, store: Store):
+    async def update_master_keys(
+        self, store: Store, batcher: Optional[BatchSizer] = None
+    ):
         progress = Progress("Updating master secret(s)...", interval=self.batch_size)
-        async with store.transaction() as txn:
-            async for row in self.batched_fetch_all(txn, "Indy::MasterSecret"):
+        async with self.conversion_transaction(store) as txn:
+            async for row in self.batched_fetch_all(txn, batcher, "Indy::MasterSecret"):
                 if progress.count > 0:
                     raise Exception("Encountered multiple master secrets")
                 await txn.remove("Indy::MasterSecret", row.name)
@@ -267,10 +488,10 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_dids(self, store: Store):
+    async def update_dids(self, store: Store, batcher: Optional[BatchSizer] = None):
         progress = Progress("Updating DIDs...", interval=self.batch_size)
-        async with store.transaction() as txn:
-            async for row in self.batched_fetch_all(txn, "Indy::Did"):
+        async with self.conversion_transaction(store) as txn:
+            async for row in self.batched_fetch_all(txn, batcher, "Indy::Did"):
                 await txn.remove("Indy::Did", row.name)
                 info = json.loads(row.value)
                 meta = await txn.fetch("Indy::DidMetadata", row.name)
@@ -293,10 +514,10 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_schemas(self, store: Store):
+    async def update_schemas(self, store: Store, batcher: Optional[BatchSizer] = None):
         progress = Progress("Updating stored schemas...", interval=self.batch_size)
-        async with store.transaction() as txn:
-            async for row in self.batched_fetch_all(txn, "Indy::Schema"):
+        async with self.conversion_transaction(store) as txn:
+            async for row in self.batched_fetch_all(txn, batcher, "Indy::Schema"):
                 await txn.remove("Indy::Schema", row.name)
                 await txn.insert(
                     "schema",
@@ -307,12 +528,16 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_cred_defs(self, store: Store):
+    async def update_cred_defs(
+        self, store: Store, batcher: Optional[BatchSizer] = None
+    ):
         progress = Progress(
             "Updating stored credential definitions...", interval=self.batch_size
         )
-        async with store.transaction() as txn:
-            async for row in self.batched_fetch_all(txn, "Indy::CredentialDefinition"):
+        async with self.conversion_transaction(store) as txn:
+            async for row in self.batched_fetch_all(
+                txn, batcher, "Indy::CredentialDefinition"
+            ):
                 await txn.remove("Indy::CredentialDefinition", row.name)
                 sid = await txn.fetch("Indy::SchemaId", row.name)
                 if not sid:
@@ -352,14 +577,17 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_rev_reg_defs(self, store: Store):
+    async def update_rev_reg_defs(
+        self, store: Store, batcher: Optional[BatchSizer] = None
+    ):
         progress = Progress(
             "Updating stored revocation registry definitions...",
             interval=self.batch_size,
         )
-        async with store.transaction() as txn:
+        async with self.conversion_transaction(store) as txn:
             async for row in self.batched_fetch_all(
                 txn,
+                batcher,
                 "Indy::RevocationRegistryDefinition",
             ):
                 await txn.remove("Indy::RevocationRegistryDefinition", row.name)
@@ -368,13 +596,15 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_rev_reg_keys(self, store: Store):
+    async def update_rev_reg_keys(
+        self, store: Store, batcher: Optional[BatchSizer] = None
+    ):
         progress = Progress(
             "Updating stored revocation registry keys...", interval=self.batch_size
         )
-        async with store.transaction() as txn:
+        async with self.conversion_transaction(store) as txn:
             async for row in self.batched_fetch_all(
-                txn, "Indy::RevocationRegistryDefinitionPrivate"
+                txn, batcher, "Indy::RevocationRegistryDefinitionPrivate"
             ):
                 await txn.remove("Indy::RevocationRegistryDefinitionPrivate", row.name)
                 await txn.insert("revocation_reg_def_private", row.name, value=row.value)
@@ -382,13 +612,16 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_rev_reg_states(self, store: Store):
+    async def update_rev_reg_states(
+        self, store: Store, batcher: Optional[BatchSizer] = None
+    ):
         progress = Progress(
             "Updating stored revocation registry states...", interval=self.batch_size
         )
-        async with store.transaction() as txn:
+        async with self.conversion_transaction(store) as txn:
             async for row in self.batched_fetch_all(
                 txn,
+                batcher,
                 "Indy::RevocationRegistry",
             ):
                 await txn.remove("Indy::RevocationRegistry", row.name)
@@ -397,13 +630,16 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_rev_reg_info(self, store: Store):
+    async def update_rev_reg_info(
+        self, store: Store, batcher: Optional[BatchSizer] = None
+    ):
         progress = Progress(
             "Updating stored revocation registry info...", interval=self.batch_size
         )
-        async with store.transaction() as txn:
+        async with self.conversion_transaction(store) as txn:
             async for row in self.batched_fetch_all(
                 txn,
+                batcher,
                 "Indy::RevocationRegistryInfo",
             ):
                 await txn.remove("Indy::RevocationRegistryInfo", row.name)
@@ -412,10 +648,10 @@ class Strategy(ABC):
             await txn.commit()
         progress.report()
 
-    async def update_creds(self, store: Store):
+    async def update_creds(self, store: Store, batcher: Optional[BatchSizer] = None):
         progress = Progress("Updating stored credentials...", interval=self.batch_size)
-        async with store.transaction() as txn:
-            async for row in self.batched_fetch_all(txn, "Indy::Credential"):
+        async with self.conversion_transaction(store) as txn:
+            async for row in self.batched_fetch_all(txn, batcher, "Indy::Credential"):
                 await txn.remove("Indy::Credential", row.name)
                 cred_data = row.value_json
                 tags = self._credential_tags(cred_data)
@@ -429,20 +665,23 @@ class Strategy(ABC):
         uri: str,
         wallet_key: str,
         profile: str = None,
+        batcher: Optional[BatchSizer] = None,
     ):
+        batcher = batcher or self.convert_batcher
         print("Opening wallet with Askar...")
         store = await Store.open(uri, pass_key=wallet_key, profile=profile)
 
-        await self.update_keys(store)
-        await self.update_master_keys(store)
-        await self.update_dids(store)
-        await self.update_schemas(store)
-        await self.update_cred_defs(store)
-        await self.update_rev_reg_defs(store)
-        await self.update_rev_reg_keys(store)
-        await self.update_rev_reg_states(store)
-        await self.update_rev_reg_info(store)
-        await self.update_creds(store)
+        await self.update_keys(store, batcher)
+        await self.update_master_keys(store, batcher)
+        await self.update_dids(store, batcher)
+        await self.update_schemas(store, batcher)
+        await self.update_cred_defs(store, batcher)
+        await self.update_rev_reg_defs(store, batcher)
+        await self.update_rev_reg_keys(store, batcher)
+        await self.update_rev_reg_states(store, batcher)
+        await self.update_rev_reg_info(store, batcher)
+        await self.update_creds(store, batcher)
+        self.report_batch_sizes(batcher)
 
         print("Closing wallet")
         await store.close()
@@ -473,11 +712,10 @@ class Strategy(ABC):
         return tags
 
     async def create_config(self, conn: DbConnection, name: str, indy_key: dict):
-        pass_key = "kdf:argon2i:13:mod?salt=" + indy_key["salt"].hex()
-        await conn.create_config(default_profile=name, key=pass_key)
+        await conn.create_config(default_profile=name, key=indy_key["store_key"])
 
-    async def init_profile(self, wallet: Wallet, name: str, indy_key: dict) -> dict:
-        profile_key = {
+    def make_profile_key(self, indy_key: dict) -> dict:
+        return {
             "ver": "1",
             "ick": indy_key["type"],
             "ink": indy_key["name"],
@@ -487,7 +725,10 @@ class Strategy(ABC):
             "thk": indy_key["tag_hmac"],
         }
 
-        enc_pk = self.encrypt_merged(cbor2.dumps(profile_key), indy_key["master"])
+    async def init_profile(self, wallet: Wallet, name: str, indy_key: dict) -> dict:
+        profile_key = self.make_profile_key(indy_key)
+
+        enc_pk = encrypt_merged(cbor2.dumps(profile_key), indy_key["master"])
         await wallet.insert_profile(name, enc_pk)
         return profile_key
 
@@ -495,19 +736,61 @@ class Strategy(ABC):
         wallet_id_records = await conn.fetch("""SELECT wallet_id FROM metadata""")
         return [wallet_id[0] for wallet_id in wallet_id_records]
 
+    async def wallet_sizes(self) -> Dict[str, WalletStats]:
+        """Read the item and tag statistics of each source wallet, by wallet id."""
+        from .pg_connection import PgConnection
+
+        conn = PgConnection(self.uri)
+        await conn.connect()
+        try:
+            return {stats.wallet_id: stats for stats in await conn.wallet_stats()}
+        finally:
+            await conn.close()
+
     async def delete_wallets_database(self):
+        from askar_tools.pg_pool import POOLS
+
         parts = urlparse(self.uri)
-        sys_conn = await asyncpg.connect(
-            host=parts.hostname,
-            port=parts.port or 5432,
-            user=parts.username,
-            password=parts.password,
-            database="template1",
-        )
-        await sys_conn.execute(f"DROP DATABASE {parts.path[1:]}")
-        await sys_conn.close()
+        # Pooled connections to the database would block dropping it
+        await POOLS.close(self.uri)
+        async with POOLS.admin_connection(self.uri) as sys_conn:
+            await sys_conn.execute(f"DROP DATABASE {parts.path[1:]}")
         print("Indy wallets database deleted.")
 
+    async def prepare_source_indexes(self, source) -> Optional["SourceIndexes"]:
+        """Report missing source indexes, building them if allowed.
+
+        Returns the built indexes, to be dropped once the migration is done.
+        """
+        if self.source_indexes == "skip":
+            return None
+        from .source_indexes import SourceIndexes
+
+        indexes = SourceIndexes(source)
+        missing = await indexes.missing()
+        if not missing:
+            return None
+        for index in missing:
+            print(
+                f"The source has no index on {index.table} "
+                f"({', '.join(index.columns)}) for {index.purpose}"
+            )
+        before = await indexes.plans()
+        build = self.source_indexes == "create"
+        if not build and sys.stdout.isatty():
+            response = input("Would you like to build the missing indexes? Y/N ")
+            build = response in ["Y", "y", "yes", "Yes"]
+        if not build:
+            for label, plan in before.items():
+                print(f"{label}: {plan}")
+            return None
+
+        await indexes.create(missing)
+        after = await indexes.plans()
+        for label, plan in before.items():
+            print(f"{label}:\n  before: {plan}\n  after:  {after[label]}")
+        return indexes
+
     async def determine_wallet_deletion(self):
         if self.delete_indy_wallets:
             if self.skip_confirmation:
@@ -531,36 +814,146 @@ class Strategy(ABC):
 
 
 class DbpwStrategy(Strategy):
-    """Database per wallet upgrade strategy."""
+    """Database per wallet upgrade strategy.
+
+    With a `target` connection, the store is created in that new database and
+    the Indy database of `conn` is only read from.
+
+    An `online` migration to a target runs in two phases. The "copy" phase
+    migrates the wallet while the agent is running, after adding triggers
+    recording the ids of changed items to the Indy database. The "finish"
+    phase, once the agent is stopped, migrates the changed items again,
+    completes the store and removes the triggers.
+    """
 
     def __init__(
         self,
-        conn: Union[SqliteConnection, PgConnection],
+        conn: DbConnection,
         wallet_name: str,
         wallet_key: str,
-        batch_size: int,
+        batch_size: Union[int, BatchSizer],
+        commit_every: Optional[int] = None,
+        crypto_cache_size: int = DEFAULT_CACHE_SIZE,
+        target: Optional[DbConnection] = None,
+        online: Optional[str] = None,
+        key_method: str = DEFAULT_KEY_METHOD,
     ):
-        super().__init__(batch_size)
+        super().__init__(batch_size, commit_every, crypto_cache_size)
         self.conn = conn
         self.wallet_name = wallet_name
         self.wallet_key = wallet_key
+        self.key_method = check_key_method(key_method)
+        self.target = target
+        self.online = online
+        if online and not target:
+            raise ValueError("Online migrations need a target database")
+        if online not in (None, "copy", "finish"):
+            raise ValueError("Online migration phase must be one of: copy, finish")
+
+    async def changed_item_ids(self):
+        """Iterate over batches of the recorded ids of changed items."""
+        last_id = 0
+        while ids := await self.conn.changed_item_ids(last_id, self.batch_size):
+            yield ids
+            last_id = ids[-1]
+
+    async def replay_changes(self):
+        """Migrate the items changed since the copy phase and complete the store."""
+        await self.conn.connect()
+        await self.target.connect()
+        try:
+            if not await self.conn.find_table(CHANGES_TABLE):
+                raise UpgradeError(
+                    "No recorded changes found: run the copy phase first"
+                )
+            if not await self.target.find_table("config"):
+                raise UpgradeError("Target database holds no copied store")
+            wallet = OutOfPlaceWallet(
+                self.conn.get_wallet("items"),
+                self.target.get_store_wallet(replace=True),
+            )
+            indy_key = await self.fetch_indy_key(
+                wallet, self.wallet_key, self.key_method
+            )
+            indy_ctx = self.wallet_context(indy_key)
+            profile_ctx = self.profile_context(self.make_profile_key(indy_key))
+
+            # Stale copies are all removed first, as a changed item may have
+            # taken the name of another one
+            async for ids in self.changed_item_ids():
+                await wallet.remove_items(ids)
+            progress = Progress("Migrating changed items...", interval=self.batch_size)
+            async for ids in self.changed_item_ids():
+                async with self.throttle.statement():
+                    rows = await wallet.fetch_items(ids)
+                await self.throttle.pace(len(rows), sum(map(row_size, rows)))
+                upd = []
+                for row in rows:
+                    item = self.decrypt_item(row, indy_ctx, b64=wallet.NAMES_B64)
+                    upd.append(self.update_item(self.rename_item(item), profile_ctx))
+                await self.write_items(wallet.insert_items, upd)
+                progress.update(len(upd))
+            progress.report()
+
+            await self.target.finish_upgrade()
+            await self.conn.drop_change_capture()
+        finally:
+            await self.conn.close()
+            await self.target.close()
+
+        await self.convert_items_to_askar(self.target.uri, self.wallet_key)
 
     async def run(self):
         """Perform the upgrade."""
+        if self.online == "finish":
+            await self.replay_changes()
+            return
+
         await self.conn.connect()
-        wallet = self.conn.get_wallet()
+        store_conn = self.target or self.conn
 
         try:
-            await self.conn.pre_upgrade()
-            indy_key = await self.fetch_indy_key(wallet, self.wallet_key)
-            await self.create_config(self.conn, self.wallet_name, indy_key)
+            if self.target:
+                await self.target.connect()
+                if not await self.conn.find_table("metadata"):
+                    raise UpgradeError(
+                        "No metadata table found: not an Indy wallet database"
+                    )
+                if await self.target.find_table("config"):
+                    raise UpgradeError("Target database already holds an Askar store")
+                if self.online:
+                    # Installed before reading, so no change goes unrecorded
+                    await self.conn.capture_changes()
+                wallet = OutOfPlaceWallet(
+                    self.conn.get_wallet("items"),
+                    # Replayed changes find the copied items by their source ids
+                    self.target.get_store_wallet(keep_ids=bool(self.online)),
+                )
+            else:
+                wallet = self.conn.get_wallet()
+            await store_conn.pre_upgrade()
+            indy_key = await self.fetch_indy_key(
+                wallet, self.wallet_key, self.key_method
+            )
+            await self.create_config(store_conn, self.wallet_name, indy_key)
             profile_key = await self.init_profile(wallet, self.wallet_name, indy_key)
-            await self.update_items(wallet, indy_key, profile_key)
-            await self.conn.finish_upgrade()
+            await self.update_items(
+                wallet, self.wallet_context(indy_key), self.profile_context(profile_key)
+            )
+            if not self.online:
+                await store_conn.finish_upgrade()
         finally:
             await self.conn.close()
+            if self.target:
+                await self.target.close()
 
-        await self.convert_items_to_askar(self.conn.uri, self.wallet_key)
+        if self.online:
+            print(
+                "Wallet copied, changes are being recorded. "
+                "Stop the agent, then run the finish phase."
+            )
+        else:
+            await self.convert_items_to_askar(store_conn.uri, self.wallet_key)
 
 
 class MwstAsProfilesStrategy(Strategy):
@@ -571,61 +964,88 @@ class MwstAsProfilesStrategy(Strategy):
         uri: str,
         base_wallet_name: str,
         base_wallet_key: str,
-        batch_size: int,
+        batch_size: Union[int, BatchSizer],
         delete_indy_wallets: Optional[bool] = False,
         skip_confirmation: Optional[bool] = False,
+        defer_indexes: bool = False,
+        unlogged: bool = False,
+        index_workers: int = 4,
+        sub_wallet_workers: int = 1,
+        source_indexes: str = "skip",
+        commit_every: Optional[int] = None,
+        crypto_cache_size: int = DEFAULT_CACHE_SIZE,
+        run_report: Optional[str] = None,
+        base_key_method: str = DEFAULT_KEY_METHOD,
     ):
-        super().__init__(batch_size)
+        super().__init__(batch_size, commit_every, crypto_cache_size)
         self.uri = uri
         self.base_wallet_name = base_wallet_name
         self.base_wallet_key = base_wallet_key
+        self.base_key_method = check_key_method(base_key_method)
         self.delete_indy_wallets = delete_indy_wallets
         self.skip_confirmation = skip_confirmation
+        self.defer_indexes = defer_indexes
+        self.unlogged = unlogged
+        self.index_workers = index_workers
+        self.sub_wallet_workers = sub_wallet_workers
+        self.source_indexes = source_indexes
+        self.run_report = run_report
+
+    def create_new_db_connection(self, wallet_name: str) -> "PgMWSTConnection":
+        from .pg_mwst_connection import PgMWSTConnection
+
+        parsed = urlparse(self.uri)
+        new_conn_uri = f"{parsed.scheme}://{parsed.netloc}/{wallet_name}"
+        return PgMWSTConnection(
+            new_conn_uri, self.defer_indexes, self.unlogged, self.index_workers
+        )
 
     async def init_profile(
         self, wallet: Wallet, name: str, base_indy_key: dict, indy_key: dict
     ) -> dict:
-        profile_key = {
-            "ver": "1",
-            "ick": indy_key["type"],
-            "ink": indy_key["name"],
-            "ihk": indy_key["item_hmac"],
-            "tnk": indy_key["tag_name"],
-            "tvk": indy_key["tag_value"],
-            "thk": indy_key["tag_hmac"],
-        }
+        profile_key = self.make_profile_key(indy_key)
 
-        enc_pk = self.encrypt_merged(cbor2.dumps(profile_key), base_indy_key["master"])
+        enc_pk = encrypt_merged(cbor2.dumps(profile_key), base_indy_key["master"])
         await wallet.insert_profile(name, enc_pk)
         return profile_key
 
     async def migrate_one_profile(
         self,
-        wallet: PgWallet,
+        wallet: "PgWallet",
         base_indy_key: dict,
         wallet_id: str,
         wallet_key: str,
+        key_method: str = DEFAULT_KEY_METHOD,
+        on_item: Optional[Callable[[IndyItem], None]] = None,
+        batcher: Optional[BatchSizer] = None,
     ):
         """Migrate one wallet."""
-        indy_key = await self.fetch_indy_key(wallet, wallet_key)
+        indy_key = await self.fetch_indy_key(wallet, wallet_key, key_method)
         profile_key = await self.init_profile(wallet, wallet_id, base_indy_key, indy_key)
-        await self.update_items(wallet, indy_key, profile_key)
+        await self.update_items(
+            wallet,
+            self.wallet_context(indy_key),
+            self.profile_context(profile_key),
+            on_item,
+            batcher,
+        )
 
-    async def get_wallet_info(self, uri: str):
-        store = await Store.open(
-            uri, profile=self.base_wallet_name, pass_key=self.base_wallet_key
+    def sub_wallet_info(self, item: IndyItem) -> Optional[Tuple[str, str, str, str]]:
+        """Get the name, id, key and key derivation method of the sub-wallet
+        a base wallet item records.
+        """
+        if item.category != b"wallet_record":
+            return None
+        settings = json.loads(item.value)["settings"]
+        return (
+            settings["wallet.name"],
+            item.name.decode(),
+            settings["wallet.key"],
+            settings.get("wallet.key_derivation_method") or DEFAULT_KEY_METHOD,
         )
-        async for record in store.scan("wallet_record"):
-            settings = record.value_json["settings"]
-            yield (
-                settings["wallet.name"],
-                cast(str, record.name),
-                settings["wallet.key"],
-            )
 
     async def create_sub_config(self, conn: DbConnection, indy_key: dict):
-        pass_key = "kdf:argon2i:13:mod?salt=" + indy_key["salt"].hex()
-        await conn.create_config(key=pass_key)
+        await conn.create_config(key=indy_key["store_key"])
 
     async def check_for_leftover_wallets(self, old_conn, migrated_wallets):
         retrieved_wallets = await self.retrieve_wallet_ids(old_conn)
@@ -641,6 +1061,44 @@ class MwstAsProfilesStrategy(Strategy):
                 )
                 self.delete_indy_wallets = False
 
+    async def migrate_sub_wallets(
+        self,
+        base_indy_key: dict,
+        scheduler: WalletScheduler,
+        migrated: Dict[str, str],
+        number: int = 0,
+    ):
+        """Migrate sub-wallets as the base wallet migration finds their records.
+
+        Each worker holds its own connections and batch sizer, leaving those
+        of the base wallet migration free, and takes the largest sub-wallet
+        found so far.
+        """
+        from askar_tools.pg_pool import POOLS
+
+        batcher = self.batcher.fork()
+        conn = self.create_new_db_connection("multitenant_sub_wallet")
+        source = await POOLS.acquire(self.uri)
+
+        async def migrate(wallet_name: str, info: Tuple[str, str, str, str]):
+            _, wallet_id, wallet_key, key_method = info
+            await self.migrate_one_profile(
+                conn.get_wallet(source, wallet_name),
+                base_indy_key,
+                wallet_id,
+                wallet_key,
+                key_method,
+                batcher=batcher,
+            )
+            migrated[wallet_name] = wallet_id
+
+        try:
+            await conn.connect()
+            await scheduler.worker(number, migrate)
+        finally:
+            await POOLS.release(source)
+            await conn.close()
+
     async def run(self):
         """Perform the upgrade.
 
@@ -651,27 +1109,33 @@ class MwstAsProfilesStrategy(Strategy):
 
         After Base wallet is migrated, it can be finalized.
 
-        Wallet info of subwallets read from base wallet post migration.
+        Sub wallets are migrated by `sub_wallet_workers` workers as soon as
+        their wallet records are decrypted from the base wallet, overlapping
+        with the rest of the base wallet migration and its conversion. Free
+        workers take the largest sub wallet found so far.
         """
-        source = await asyncpg.connect(self.uri)
-        parsed = urlparse(self.uri)
+        from askar_tools.pg_pool import POOLS
 
-        base_conn = PgMWSTConnection(
-            f"{parsed.scheme}://{parsed.netloc}/{self.base_wallet_name}"
-        )
-        await base_conn.connect()
-        sub_conn = PgMWSTConnection(
-            f"{parsed.scheme}://{parsed.netloc}/multitenant_sub_wallet"
-        )
-        await sub_conn.connect()
+        base_conn = self.create_new_db_connection(self.base_wallet_name)
+        sub_conn = self.create_new_db_connection("multitenant_sub_wallet")
+        source_indexes = None
 
+        # Migrated sub wallet names and their profile names
+        migrated: Dict[str, str] = {}
+        source = await POOLS.acquire(self.uri)
         try:
+            source_indexes = await self.prepare_source_indexes(source)
+            scheduler = WalletScheduler(
+                await self.wallet_sizes(), self.sub_wallet_workers
+            )
+            await base_conn.connect()
+            await sub_conn.connect()
             await base_conn.pre_upgrade()
             await sub_conn.pre_upgrade()
             base_wallet = base_conn.get_wallet(source, self.base_wallet_name)
 
             base_indy_key: dict = await self.fetch_indy_key(
-                base_wallet, self.base_wallet_key
+                base_wallet, self.base_wallet_key, self.base_key_method
             )
             await self.create_config(base_conn, self.base_wallet_name, base_indy_key)
 
@@ -680,40 +1144,47 @@ class MwstAsProfilesStrategy(Strategy):
             await self.create_config(sub_conn, "default", base_indy_key)
             await super().init_profile(default_wallet, "default", base_indy_key)
 
-            await self.migrate_one_profile(
-                base_wallet,
-                base_indy_key,
-                self.base_wallet_name,
-                self.base_wallet_key,
-            )
-            await base_conn.finish_upgrade()
-            await base_conn.close()
-            await self.convert_items_to_askar(
-                base_conn.uri,
-                self.base_wallet_key,
-            )
-            # Track migrated wallets
-            migrated_wallets = [self.base_wallet_name]
+            def dispatch(item: IndyItem):
+                info = self.sub_wallet_info(item)
+                if info:
+                    scheduler.add(info[0], info)
 
-            wallet_ids = []
-            async for wallet_name, wallet_id, wallet_key in self.get_wallet_info(
-                base_conn.uri
-            ):
-                wallet_ids.append(wallet_id)
-                wallet = sub_conn.get_wallet(source, wallet_name)
+            async def migrate_base_wallet():
                 await self.migrate_one_profile(
-                    wallet, base_indy_key, wallet_id, wallet_key
+                    base_wallet,
+                    base_indy_key,
+                    self.base_wallet_name,
+                    self.base_wallet_key,
+                    self.base_key_method,
+                    dispatch,
                 )
-                migrated_wallets.append(wallet_name)
-            await self.check_for_leftover_wallets(source, migrated_wallets)
+                await base_conn.finish_upgrade()
+                await base_conn.close()
+                # All sub wallets are found; let the workers finish
+                scheduler.close()
+                await self.convert_items_to_askar(base_conn.uri, self.base_wallet_key)
+
+            await gather_or_cancel(
+                migrate_base_wallet(),
+                *(
+                    self.migrate_sub_wallets(base_indy_key, scheduler, migrated, number)
+                    for number in range(self.sub_wallet_workers)
+                ),
+            )
+            scheduler.report(self.run_report)
+            await self.check_for_leftover_wallets(
+                source, [self.base_wallet_name, *migrated]
+            )
 
             await sub_conn.finish_upgrade()
         finally:
-            await source.close()
+            if source_indexes:
+                await source_indexes.drop()
+            await POOLS.release(source)
             await base_conn.close()
             await sub_conn.close()
 
-        for wallet_id in wallet_ids:
+        for wallet_id in migrated.values():
             await self.convert_items_to_askar(
                 sub_conn.uri, self.base_wallet_key, wallet_id
             )
@@ -721,28 +1192,69 @@ class MwstAsProfilesStrategy(Strategy):
 
 
 class MwstAsStoresStrategy(Strategy):
-    """MultiWalletSingleTable as separate Askar stores upgrade strategy."""
+    """MultiWalletSingleTable as separate Askar stores upgrade strategy.
+
+    Each of the `wallet_keys` is either the wallet key, derived with
+    `key_method`, or an object with the `key` and its `key_derivation_method`.
+    """
 
     def __init__(
         self,
         uri: str,
-        wallet_keys: Dict[str, str],
-        batch_size: int,
+        wallet_keys: Dict[str, Union[str, dict]],
+        batch_size: Union[int, BatchSizer],
         allow_missing_wallet: Optional[bool] = False,
         delete_indy_wallets: Optional[bool] = False,
         skip_confirmation: Optional[bool] = False,
+        defer_indexes: bool = False,
+        unlogged: bool = False,
+        index_workers: int = 4,
+        copy_staging: bool = False,
+        single_scan: bool = False,
+        source_indexes: str = "skip",
+        commit_every: Optional[int] = None,
+        crypto_cache_size: int = DEFAULT_CACHE_SIZE,
+        wallet_workers: int = 1,
+        run_report: Optional[str] = None,
+        preflight_workers: int = 4,
+        key_method: str = DEFAULT_KEY_METHOD,
     ):
-        super().__init__(batch_size)
+        super().__init__(batch_size, commit_every, crypto_cache_size)
         self.uri = uri
-        self.wallet_keys = wallet_keys
+        self.wallet_keys, self.key_methods = split_wallet_keys(wallet_keys, key_method)
         self.allow_missing_wallet = allow_missing_wallet
         self.delete_indy_wallets = delete_indy_wallets
         self.skip_confirmation = skip_confirmation
+        self.defer_indexes = defer_indexes
+        self.unlogged = unlogged
+        self.index_workers = index_workers
+        self.copy_staging = copy_staging
+        self.single_scan = single_scan
+        self.source_indexes = source_indexes
+        self.wallet_workers = wallet_workers
+        self.run_report = run_report
+        self.preflight_workers = preflight_workers
+        if copy_staging and single_scan:
+            raise ValueError("Single scan migrations cannot stage wallet items")
+
+    def create_new_db_connection(self, wallet_name: str) -> "PgMWSTConnection":
+        from .pg_mwst_connection import PgMWSTConnection
 
-    def create_new_db_connection(self, wallet_name: str):
         parsed = urlparse(self.uri)
         new_conn_uri = f"{parsed.scheme}://{parsed.netloc}/{wallet_name}"
-        return PgMWSTConnection(new_conn_uri)
+        return PgMWSTConnection(
+            new_conn_uri, self.defer_indexes, self.unlogged, self.index_workers
+        )
+
+    async def get_source_wallet(
+        self, source, new_db_conn: "PgMWSTConnection", wallet_name: str
+    ) -> "PgWallet":
+        """Get the source wallet, staging its items in the new database if enabled."""
+        if not self.copy_staging:
+            return new_db_conn.get_wallet(source, wallet_name)
+        staged = await new_db_conn.stage_items(source, wallet_name)
+        print(f"Staged {staged} items in {wallet_name}")
+        return new_db_conn.get_staged_wallet(source, wallet_name)
 
     async def check_wallet_alignment(self, conn, wallet_keys):
         """Verify that the wallet names passed in align with
@@ -770,36 +1282,220 @@ class MwstAsStoresStrategy(Strategy):
         else:
             await self.check_wallet_alignment(conn, wallet_keys)
 
-    async def run(self):
-        """Perform the upgrade."""
+    async def check_wallet_keys(self, source):
+        """Check the key of every wallet before anything is written.
 
-        # Connect to original database
-        source = await asyncpg.connect(self.uri)
-        await self.check_missing_wallet_flag(
-            source, self.wallet_keys, self.allow_missing_wallet
+        The master keys are derived on `preflight_workers` threads, as each
+        ARGON2I_MOD derivation takes a second and 256 MiB. Each key must decrypt
+        the keys and the first item of its wallet. All wallets with a bad key
+        are reported at once.
+        """
+        from .pg_mwst_connection import sample_wallets
+
+        samples = await sample_wallets(source, list(self.wallet_keys))
+        failed = {}
+
+        async def check(wallet_name: str, wallet_key: str):
+            metadata, row = samples[wallet_name]
+            try:
+                indy_key = await self.unlock_indy_key(
+                    metadata, wallet_key, self.key_methods[wallet_name], executor
+                )
+                if row:
+                    self.decrypt_item(row, self.wallet_context(indy_key), b64=True)
+            except CryptoError:
+                failed[wallet_name] = "wallet key does not decrypt the wallet"
+
+        print(f"Checking the keys of {len(self.wallet_keys)} wallet(s)...")
+        with ThreadPoolExecutor(self.preflight_workers) as executor:
+            await asyncio.gather(
+                *(
+                    check(wallet_name, wallet_key)
+                    for wallet_name, wallet_key in self.wallet_keys.items()
+                    if wallet_name in samples
+                )
+            )
+        for wallet_name in self.wallet_keys:
+            if wallet_name not in samples:
+                failed[wallet_name] = "no wallet metadata found"
+        if failed:
+            for wallet_name, reason in failed.items():
+                print(f"  {wallet_name}: {reason}")
+            raise DecryptionFailedError(
+                f"Bad wallet keys for {len(failed)} wallet(s): {', '.join(failed)}"
+            )
+
+    async def prepare_wallet(
+        self, source, new_db_conn: "PgMWSTConnection", wallet_name: str, wallet_key: str
+    ) -> Tuple["PgWallet", CryptoContext, CryptoContext]:
+        """Create the store of a wallet, returning its source wallet and keys."""
+        await new_db_conn.pre_upgrade()
+        wallet = await self.get_source_wallet(source, new_db_conn, wallet_name)
+        indy_key = await self.fetch_indy_key(
+            wallet, wallet_key, self.key_methods[wallet_name]
         )
+        await self.create_config(new_db_conn, wallet_name, indy_key)
+        profile_key = await self.init_profile(wallet, wallet_name, indy_key)
+        return wallet, self.wallet_context(indy_key), self.profile_context(profile_key)
 
-        for wallet_name, wallet_key in self.wallet_keys.items():
-            # Connect to new database
-            new_db_conn: PgMWSTConnection = self.create_new_db_connection(wallet_name)
-            await new_db_conn.connect()
+    async def route_items(
+        self,
+        source,
+        routes: Dict[str, Tuple["PgWallet", CryptoContext, CryptoContext]],
+    ):
+        """Migrate the items of all wallets in one scan of the source.
+
+        Each item is decrypted and written with the keys and store of its
+        wallet. Items of wallets without a route are left in place.
+        """
+        from .pg_mwst_connection import scan_wallet_items
+
+        progress = Progress("Migrating items...", interval=self.batch_size)
+        decrypted = set()
+        start = time.perf_counter()
+        async for rows in scan_wallet_items(source, self.batcher):
+            upd: Dict[str, List[AskarItem]] = {}
+            for row in rows:
+                wallet_name = row[-1]
+                if wallet_name not in routes:
+                    continue
+                wallet, indy_key, profile_key = routes[wallet_name]
+                try:
+                    result = self.decrypt_item(row[:-1], indy_key, b64=wallet.NAMES_B64)
+                except CryptoError as err:
+                    if wallet_name in decrypted:
+                        raise UpgradeError(
+                            f"Failed to decrypt an item of wallet {wallet_name} after "
+                            "successfully decrypting others"
+                        ) from err
+                    raise DecryptionFailedError(
+                        f"Could not decrypt any items from wallet {wallet_name}; "
+                        "bad wallet key given?"
+                    ) from err
+                decrypted.add(wallet_name)
+                upd.setdefault(wallet_name, []).append(
+                    self.update_item(self.rename_item(result), profile_key)
+                )
+            for wallet_name, items in upd.items():
+                await self.write_items(routes[wallet_name][0].update_items, items)
+            self.batcher.observe(
+                len(rows), sum(map(row_size, rows)), time.perf_counter() - start
+            )
+            progress.update(sum(map(len, upd.values())))
+            start = time.perf_counter()
+        progress.report()
+        self.report_batch_sizes(self.batcher)
+        for wallet_name, (_, indy_key, profile_key) in routes.items():
+            self.report_caches(indy_key, profile_key, f"{wallet_name}: ")
+
+    async def migrate_wallet(
+        self,
+        source,
+        wallet_name: str,
+        wallet_key: str,
+        batcher: Optional[BatchSizer] = None,
+        convert_batcher: Optional[BatchSizer] = None,
+    ):
+        """Migrate one wallet into its new database."""
+        new_db_conn = self.create_new_db_connection(wallet_name)
+        await new_db_conn.connect()
+
+        try:
+            wallet, indy_key, profile_key = await self.prepare_wallet(
+                source, new_db_conn, wallet_name, wallet_key
+            )
+            await self.update_items(wallet, indy_key, profile_key, batcher=batcher)
+            await new_db_conn.finish_upgrade()
+        except UpgradeError as err:
+            raise UpgradeError(
+                f"Failed to upgrade wallet {wallet_name}; bad wallet key given?"
+            ) from err
+        finally:
+            await new_db_conn.close()
+
+        await self.convert_items_to_askar(
+            new_db_conn.uri, wallet_key, batcher=convert_batcher
+        )
+
+    async def run_per_wallet(self):
+        """Migrate the wallets on `wallet_workers` workers, largest first.
+
+        Each worker holds its own connection to the source database and its
+        own batch sizers.
+        """
+        from askar_tools.pg_pool import POOLS
 
-            wallet = new_db_conn.get_wallet(source, wallet_name)
+        scheduler = WalletScheduler(await self.wallet_sizes(), self.wallet_workers)
+        for wallet_name, wallet_key in self.wallet_keys.items():
+            scheduler.add(wallet_name, wallet_key)
+        scheduler.close()
+
+        async def worker(number: int):
+            source = await POOLS.acquire(self.uri)
+            migrate = partial(
+                self.migrate_wallet,
+                source,
+                batcher=self.batcher.fork(),
+                convert_batcher=self.convert_batcher.fork(),
+            )
             try:
-                await new_db_conn.pre_upgrade()
-                indy_key = await self.fetch_indy_key(wallet, wallet_key)
-                await self.create_config(new_db_conn, wallet_name, indy_key)
-                profile_key = await self.init_profile(wallet, wallet_name, indy_key)
-                await self.update_items(wallet, indy_key, profile_key)
-                await new_db_conn.finish_upgrade()
-            except UpgradeError as err:
-                raise UpgradeError(
-                    f"Failed to upgrade wallet {wallet_name}; bad wallet key given?"
-                ) from err
+                await scheduler.worker(number, migrate)
             finally:
+                await POOLS.release(source)
+
+        await gather_or_cancel(
+            *(worker(number) for number in range(self.wallet_workers))
+        )
+        scheduler.report(self.run_report)
+
+    async def run_single_scan(self, source):
+        """Migrate all wallets at once, reading the source items a single time."""
+        new_db_conns = {}
+        routes = {}
+        try:
+            for wallet_name, wallet_key in self.wallet_keys.items():
+                new_db_conn = self.create_new_db_connection(wallet_name)
+                await new_db_conn.connect()
+                new_db_conns[wallet_name] = new_db_conn
+                try:
+                    routes[wallet_name] = await self.prepare_wallet(
+                        source, new_db_conn, wallet_name, wallet_key
+                    )
+                except UpgradeError as err:
+                    raise UpgradeError(
+                        f"Failed to upgrade wallet {wallet_name}; bad wallet key given?"
+                    ) from err
+            await self.route_items(source, routes)
+            for new_db_conn in new_db_conns.values():
+                await new_db_conn.finish_upgrade()
+        finally:
+            for new_db_conn in new_db_conns.values():
                 await new_db_conn.close()
 
-            await self.convert_items_to_askar(new_db_conn.uri, wallet_key)
+        for wallet_name, wallet_key in self.wallet_keys.items():
+            await self.convert_items_to_askar(new_db_conns[wallet_name].uri, wallet_key)
+
+    async def run(self):
+        """Perform the upgrade."""
+
+        from askar_tools.pg_pool import POOLS
+
+        # Connect to original database
+        source = await POOLS.acquire(self.uri)
+        source_indexes = None
+        try:
+            await self.check_missing_wallet_flag(
+                source, self.wallet_keys, self.allow_missing_wallet
+            )
+            await self.check_wallet_keys(source)
+            source_indexes = await self.prepare_source_indexes(source)
+            if self.single_scan:
+                await self.run_single_scan(source)
+            else:
+                await self.run_per_wallet()
+        finally:
+            if source_indexes:
+                await source_indexes.drop()
+            await POOLS.release(source)
 
-        await source.close()
         await self.determine_wallet_deletion()
@@ -0,0 +1,93 @@
+import pytest
+
+from acapy_wallet_upgrade.batching import AdaptiveBatchSizer, BatchSizer, row_size
+
+
+def test_fixed_batch_size():
+    batcher = BatchSizer(50)
+    batcher.observe(50, 10_000_000, 100.0)
+    assert batcher.size == 50
+    assert batcher.report() is None
+    assert batcher.fork().size == 50
+
+
+def test_adaptive_grows_for_small_items():
+    batcher = AdaptiveBatchSizer(50, 10, 1000, target_bytes=1_000_000)
+    for _ in range(10):
+        batcher.observe(batcher.size, batcher.size * 100, 0.001)
+    assert batcher.size == 1000
+    # Growth is limited to doubling per batch
+    assert batcher.sizes[:3] == [50, 100, 200]
+
+
+def test_adaptive_shrinks_for_large_items():
+    batcher = AdaptiveBatchSizer(50, 10, 1000, target_bytes=1_000_000)
+    for _ in range(10):
+        batcher.observe(batcher.size, batcher.size * 1_000_000, 0.001)
+    assert batcher.size == 10
+
+
+def test_adaptive_targets_latency():
+    batcher = AdaptiveBatchSizer(50, 1, 1000, target_latency=0.5)
+    for _ in range(20):
+        batcher.observe(batcher.size, 0, batcher.size * 0.01)
+    assert batcher.size == 50
+    assert "batches" in batcher.report()
+
+
+def test_adaptive_bounds():
+    with pytest.raises(ValueError):
+        AdaptiveBatchSizer(50, 100, 10)
+    assert AdaptiveBatchSizer(5000, 10, 100).size == 100
+
+
+def test_row_size():
+    assert row_size((1, b"abc", None, "de")) == 5
+
+
+def rows_reader(sizes):
+    rows = [(b"x" * size,) for size in sizes]
+    requests = []
+
+    async def fetch(count):
+        requests.append(count)
+        chunk = rows[:count]
+        del rows[:count]
+        return chunk
+
+    return fetch, requests
+
+
+@pytest.mark.asyncio
+async def test_collect_stops_at_byte_budget():
+    batcher = BatchSizer(50, max_bytes=1000)
+    fetch, requests = rows_reader([100] * 30)
+    batch = await batcher.collect(fetch)
+    assert len(batch) == 10
+    # One row is read to measure, then the rest that fit the budget
+    assert requests == [1, 9]
+
+    # The next batch is sized from the rows of the last one
+    batch = await batcher.collect(fetch)
+    assert len(batch) == 10
+    assert requests[2:] == [10]
+
+
+@pytest.mark.asyncio
+async def test_collect_after_large_row():
+    batcher = BatchSizer(50, max_bytes=1000)
+    fetch, requests = rows_reader([100, 5000] + [100] * 40)
+    # The large row is only seen once read, so that batch goes over budget
+    assert len(await batcher.collect(fetch)) == 10
+    # The next batch starts with a read sized for the large row
+    assert len(await batcher.collect(fetch)) == 10
+    assert requests[2:] == [1, 9]
+
+
+@pytest.mark.asyncio
+async def test_collect_without_budget():
+    fetch, requests = rows_reader([10_000] * 60)
+    batch = await BatchSizer(50).collect(fetch)
+    assert len(batch) == 50
+    assert requests == [50]
+    assert BatchSizer(50, 1000).fork().max_bytes == 1000
@@ -0,0 +1,32 @@
+import pytest
+from aries_askar import Store
+
+from acapy_wallet_upgrade.strategies import ChunkedTransaction, DbpwStrategy
+
+
+@pytest.mark.asyncio
+async def test_chunked_conversion_resumes(tmp_path):
+    store = await Store.provision(
+        f"sqlite://{tmp_path / 'wallet.db'}", "raw", Store.generate_raw_key()
+    )
+    async with store.session() as session:
+        for i in range(5):
+            await session.insert("Indy::Schema", f"S:{i}", b"{}")
+
+    # Interrupted after three records, with commits every two
+    with pytest.raises(RuntimeError):
+        async with ChunkedTransaction(store, 2) as txn:
+            for i in range(3):
+                await txn.remove("Indy::Schema", f"S:{i}")
+                await txn.insert("schema", f"S:{i}", value=b"{}")
+                await txn.checkpoint(1)
+            raise RuntimeError()
+    async with store.session() as session:
+        assert await session.count("schema") == 2
+        assert await session.count("Indy::Schema") == 3
+
+    await DbpwStrategy(None, "wallet", "key", 2, commit_every=2).update_schemas(store)
+    async with store.session() as session:
+        assert await session.count("schema") == 5
+        assert await session.count("Indy::Schema") == 0
+    await store.close()
@@ -0,0 +1,236 @@
+import json
+import os
+
+import base58
+import msgpack
+import nacl.bindings
+import nacl.pwhash
+import pytest
+from nacl.exceptions import CryptoError
+
+from acapy_wallet_upgrade import crypto
+from acapy_wallet_upgrade.error import UpgradeError
+from acapy_wallet_upgrade.records import IndyItem
+from acapy_wallet_upgrade.strategies import DbpwStrategy, split_wallet_keys
+
+KEY_NAMES = ("type", "name", "value", "tag_name", "tag_value")
+
+
+def _reference_encrypt(message: bytes, key: bytes) -> bytes:
+    nonce = os.urandom(crypto.CHACHAPOLY_NONCE_LEN)
+    return nonce + nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt(
+        message, None, nonce, key
+    )
+
+
+def _indy_row(keys: dict):
+    value_key = os.urandom(32)
+    tags_enc = ":".join(
+        (
+            _reference_encrypt(b"state", keys["tag_name"]).hex(),
+            _reference_encrypt(b"active", keys["tag_value"]).hex(),
+        )
+    )
+    tags_plain = ":".join(
+        (_reference_encrypt(b"~role", keys["tag_name"]).hex(), "6f6b")
+    )
+    return (
+        1,
+        _reference_encrypt(b"connection", keys["type"]),
+        _reference_encrypt(b"conn-1", keys["name"]),
+        _reference_encrypt(b'{"a": 1}', value_key),
+        _reference_encrypt(value_key, keys["value"]),
+        tags_enc,
+        tags_plain,
+    )
+
+
+@pytest.fixture
+def strategy():
+    return DbpwStrategy(None, "test", "test", 10)
+
+
+def test_backends_agree():
+    key = os.urandom(32)
+    jobs = [(os.urandom(12), os.urandom(size), key) for size in (0, 1, 100)]
+    enc = crypto._encrypt_batch_nacl(jobs, {})
+    if crypto.ChaCha20Poly1305 is not None:
+        assert crypto._encrypt_batch_native(jobs, {}) == enc
+    dec = crypto.decrypt_batch(
+        (nonce, ciphertext, key) for (nonce, _, key), ciphertext in zip(jobs, enc)
+    )
+    assert dec == [message for _, message, _ in jobs]
+
+
+def test_decrypt_failure_raises_crypto_error():
+    key = os.urandom(32)
+    with pytest.raises(CryptoError):
+        crypto.decrypt_merged_batch(
+            [(_reference_encrypt(b"data", key), os.urandom(32))]
+        )
+
+
+def test_merged_round_trip():
+    key = os.urandom(32)
+    enc = crypto.encrypt_merged(b"data", key)
+    assert enc != crypto.encrypt_merged(b"data", key)
+    assert crypto.decrypt_merged(enc, key) == b"data"
+    assert crypto.decrypt_merged(_reference_encrypt(b"data", key), key) == b"data"
+
+
+def test_decrypt_item(strategy):
+    keys = {name: os.urandom(32) for name in KEY_NAMES}
+    item = strategy.decrypt_item(_indy_row(keys), crypto.CryptoContext(keys))
+    assert item.category == b"connection"
+    assert item.name == b"conn-1"
+    assert item.value == b'{"a": 1}'
+    assert item.tags == [(0, b"state", b"active"), (1, b"~role", b"ok")]
+
+
+def test_update_item(strategy):
+    key = {name: os.urandom(32) for name in ("ick", "ink", "ihk", "tnk", "tvk", "thk")}
+    item = IndyItem(
+        1,
+        b"connection",
+        b"conn-1",
+        b"{}",
+        [(0, b"state", b"active"), (1, b"~role", b"ok")],
+    )
+    context = crypto.CryptoContext(key)
+    first = strategy.update_item(item, context)
+    second = strategy.update_item(item, context)
+
+    # Searchable fields are deterministic, values are not
+    assert first.category == second.category
+    assert first.name == second.name
+    assert first.tags == second.tags
+    assert first.value != second.value
+
+    value_key = context.value_key(b"connection", b"conn-1", "ihk")
+    assert strategy.decrypt_merged(first.value, value_key) == b"{}"
+    assert strategy.decrypt_merged(first.category, key["ick"]) == b"connection"
+    plain, name, value = first.tags[1]
+    assert (plain, value) == (1, b"ok")
+    assert strategy.decrypt_merged(name, key["tnk"]) == b"~role"
+
+
+def test_context_hmac_state_is_reused():
+    context = crypto.CryptoContext({"ihk": os.urandom(32)})
+    first = context.nonce(b"connection", "ihk")
+    assert context.nonce(b"connection", "ihk") == first
+    assert context.nonce(b"other", "ihk") != first
+    assert len(context._hmacs) == 1
+
+
+def test_context_ciphers_not_grown():
+    key = os.urandom(32)
+    context = crypto.CryptoContext({"value": key})
+    value_key = os.urandom(32)
+    enc = context.encrypt([(os.urandom(12), b"data", value_key)])
+    assert context.decrypt([(enc[0], value_key)]) == [b"data"]
+    if crypto.ChaCha20Poly1305 is not None:
+        assert list(context._ciphers) == [key]
+
+
+def test_searchable_fields_cached(strategy):
+    key = {name: os.urandom(32) for name in ("ick", "ink", "ihk", "tnk", "tvk", "thk")}
+    uncached = crypto.CryptoContext(key)
+    context = crypto.CryptoContext(key, cache_size=2)
+    item = IndyItem(1, b"connection", b"conn-1", b"{}", [(0, b"state", b"active")])
+    first = strategy.update_item(item, context)
+    assert (context.cache_hits, context.cache_misses) == (0, 3)
+    second = strategy.update_item(item._replace(name=b"conn-2"), context)
+    # The least recently used category was evicted
+    assert (context.cache_hits, context.cache_misses) == (2, 4)
+    assert "33% hit rate" in context.cache_report()
+    assert second.category == first.category
+    assert second.tags == first.tags
+    assert second.name == uncached.encrypt_searchable([(b"conn-2", "ihk", "ink")])[0]
+    assert strategy.update_item(item, uncached).tags == first.tags
+    assert uncached.cache_report() is None
+
+
+def test_decrypt_item_cached(strategy):
+    keys = {name: os.urandom(32) for name in KEY_NAMES}
+    context = crypto.CryptoContext(keys, cache_size=10)
+    row = _indy_row(keys)
+    first = strategy.decrypt_item(row, context)
+    assert (context.cache_hits, context.cache_misses) == (0, 4)
+    # The same type and tag ciphertexts are neither decoded nor decrypted again
+    other_name = _reference_encrypt(b"conn-2", keys["name"])
+    second = strategy.decrypt_item(row[:2] + (other_name,) + row[3:], context)
+    assert (context.cache_hits, context.cache_misses) == (4, 4)
+    assert second == first._replace(name=b"conn-2")
+
+
+@pytest.mark.asyncio
+async def test_unlocked_keys_reused(strategy):
+    salt = os.urandom(16)
+    master = nacl.pwhash.argon2i.kdf(
+        32,
+        b"secret",
+        salt,
+        nacl.pwhash.argon2i.OPSLIMIT_MODERATE,
+        nacl.pwhash.argon2i.MEMLIMIT_MODERATE,
+    )
+    keys = [os.urandom(32) for _ in range(7)]
+    metadata = json.dumps(
+        {
+            "keys": list(_reference_encrypt(msgpack.packb(keys), master)),
+            "master_key_salt": list(salt),
+        }
+    ).encode()
+
+    unlocked = await strategy.unlock_indy_key(metadata, "secret")
+    assert unlocked["master"] == master
+    assert unlocked["tag_hmac"] == keys[6]
+    assert await strategy.unlock_indy_key(metadata, "secret") is unlocked
+    with pytest.raises(CryptoError):
+        await strategy.unlock_indy_key(metadata, "wrong")
+
+
+@pytest.mark.asyncio
+async def test_unlock_key_methods(strategy):
+    keys = [os.urandom(32) for _ in range(7)]
+    master = os.urandom(32)
+    raw_metadata = json.dumps(
+        {"keys": list(_reference_encrypt(msgpack.packb(keys), master))}
+    )
+    unlocked = await strategy.unlock_indy_key(
+        raw_metadata, base58.b58encode(master).decode(), "RAW"
+    )
+    assert unlocked["master"] == master
+    assert unlocked["store_key"] == "raw"
+    with pytest.raises(CryptoError):
+        await strategy.unlock_indy_key(raw_metadata, "not-a-raw-key", "RAW")
+
+    salt = os.urandom(16)
+    master = nacl.pwhash.argon2i.kdf(
+        32,
+        b"secret",
+        salt,
+        nacl.pwhash.argon2i.OPSLIMIT_INTERACTIVE,
+        nacl.pwhash.argon2i.MEMLIMIT_INTERACTIVE,
+    )
+    metadata = json.dumps(
+        {
+            "keys": list(_reference_encrypt(msgpack.packb(keys), master)),
+            "master_key_salt": list(salt),
+        }
+    )
+    unlocked = await strategy.unlock_indy_key(metadata, "secret", "ARGON2I_INT")
+    assert unlocked["tag_hmac"] == keys[6]
+    assert unlocked["store_key"] == f"kdf:argon2i:13:int?salt={salt.hex()}"
+    with pytest.raises(UpgradeError):
+        await strategy.unlock_indy_key(metadata, "secret", "ARGON2I_HIGH")
+
+
+def test_split_wallet_keys():
+    keys, methods = split_wallet_keys(
+        {"a": "key-a", "b": {"key": "key-b", "key_derivation_method": "RAW"}},
+        "ARGON2I_INT",
+    )
+    assert keys == {"a": "key-a", "b": "key-b"}
+    assert methods == {"a": "ARGON2I_INT", "b": "RAW"}
+    with pytest.raises(UpgradeError):
+        split_wallet_keys({"a": {"key_derivation_method": "RAW"}})
@@ -0,0 +1,45 @@
+import pytest
+
+from acapy_wallet_upgrade.estimate import (
+    SampleTiming,
+    format_bytes,
+    format_seconds,
+    makespan,
+    project_seconds,
+)
+from acapy_wallet_upgrade.records import WalletStats
+
+
+def wallet(wallet_id, items):
+    return WalletStats(wallet_id, items, items * 100, 0, 0, {})
+
+
+def test_makespan():
+    assert makespan([], 4) == 0
+    assert makespan([3, 3, 2, 2, 2], 1) == 12
+    assert makespan([3, 3, 2, 2, 2], 2) == 7
+    assert makespan([10, 1, 1], 8) == 10
+
+
+def test_project_seconds():
+    # 1 ms of crypto and 9 ms of database time per item, no key derivation
+    sample = SampleTiming(100, 0.0, 0.5, 0.1, 0.4, 100, 150, 0.0)
+    stats = [wallet("a", 1000), wallet("b", 1000)]
+    assert project_seconds(stats, sample, 1) == pytest.approx(20.0)
+    assert project_seconds(stats, sample, 2) == pytest.approx(10.0)
+    # Crypto time does not shrink with more concurrent wallets
+    cpu_bound = SampleTiming(100, 0.0, 0.0, 1.0, 0.0, 100, 150, 0.0)
+    assert project_seconds(stats, cpu_bound, 2) == pytest.approx(20.0)
+    assert sample.growth == 1.5
+
+
+def test_project_seconds_conversion_and_keys():
+    sample = SampleTiming(100, 0.5, 0.0, 0.1, 0.0, 100, 100, 0.5)
+    assert project_seconds([wallet(None, 1000)], sample, 1) == pytest.approx(2.5)
+
+
+def test_format():
+    assert format_bytes(512) == "512 B"
+    assert format_bytes(3 * 1024 * 1024) == "3.0 MiB"
+    assert format_seconds(12.34) == "12.3s"
+    assert format_seconds(3723) == "1h 02m 03s"
@@ -0,0 +1,38 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+DRIVERS = ("aiosqlite", "asyncpg")
+HEAVY = DRIVERS + ("aries_askar", "base58", "cbor2", "msgpack", "nacl")
+
+
+def imported(code: str) -> dict:
+    """Run code in a fresh interpreter and report the heavy modules it loaded."""
+    script = (
+        "import sys\n"
+        f"{code}\n"
+        "import json\n"
+        f"heavy = sorted(set({HEAVY!r}) & set(sys.modules))\n"
+        "print(json.dumps({'heavy': heavy}))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, check=True, text=True
+    )
+    return json.loads(result.stdout)
+
+
+@pytest.mark.parametrize(
+    "module", ["acapy_wallet_upgrade.__main__", "askar_tools.__main__"]
+)
+def test_entrypoint_imports_no_drivers(module):
+    assert imported(f"import {module}")["heavy"] == []
+
+
+def test_sqlite_backend_skips_asyncpg():
+    loaded = imported(
+        "import acapy_wallet_upgrade.strategies, acapy_wallet_upgrade.sqlite_connection"
+    )["heavy"]
+    assert "asyncpg" not in loaded
+    assert "aries_askar" in loaded
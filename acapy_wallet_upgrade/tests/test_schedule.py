@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+import pytest
+
+from acapy_wallet_upgrade.records import WalletStats
+from acapy_wallet_upgrade.schedule import WalletRun, WalletScheduler, fit_durations
+
+
+def wallet(wallet_id, size):
+    return WalletStats(wallet_id, size // 100, size, 0, 0, {})
+
+
+@pytest.mark.asyncio
+async def test_largest_wallets_first(tmp_path):
+    sizes = {name: wallet(name, size) for name, size in (("a", 100), ("b", 900))}
+    scheduler = WalletScheduler(sizes, workers=2)
+    started = []
+
+    async def migrate(name, job):
+        started.append((name, job))
+        await asyncio.sleep(0)
+
+    for name in ("a", "unknown", "b"):
+        scheduler.add(name, f"key-{name}")
+    scheduler.close()
+    await asyncio.gather(scheduler.worker(0, migrate), scheduler.worker(1, migrate))
+
+    assert started == [("b", "key-b"), ("a", "key-a"), ("unknown", "key-unknown")]
+    assert {run.wallet: run.cost for run in scheduler.runs} == {
+        "a": 100,
+        "b": 900,
+        "unknown": 0,
+    }
+    scheduler.report(str(tmp_path / "report.json"))
+    with open(tmp_path / "report.json") as report:
+        assert len(json.load(report)["wallets"]) == 3
+
+
+def test_fit_durations():
+    runs = [
+        WalletRun(str(cost), 0, cost, 0, 0.0, 1 + cost / 100) for cost in (100, 300)
+    ]
+    assert fit_durations(runs) == pytest.approx((1.0, 0.01))
+    # A single size cannot separate the fixed cost
+    assert fit_durations(runs[:1]) == pytest.approx((0.0, 0.02))
+    assert fit_durations([]) == (0.0, 0.0)
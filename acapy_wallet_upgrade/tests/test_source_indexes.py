@@ -0,0 +1,22 @@
+from acapy_wallet_upgrade.source_indexes import SupportingIndex, plan_summary
+
+
+def test_leading_columns_support_index():
+    index = SupportingIndex("items", ("wallet_id",), "reading")
+    assert index.name == "ix_upgrade_items_wallet_id"
+    assert index.supported_by(["wallet_id", "type", "name"])
+    assert not index.supported_by(["id", "wallet_id"])
+
+
+def test_plan_summary():
+    plan = {
+        "Node Type": "ModifyTable",
+        "Relation Name": "items",
+        "Total Cost": 8.29,
+        "Plans": [
+            {"Node Type": "Index Scan", "Index Name": "ix_upgrade_items_id"},
+        ],
+    }
+    assert plan_summary(plan) == (
+        "ModifyTable on items > Index Scan using ix_upgrade_items_id (cost 8)"
+    )
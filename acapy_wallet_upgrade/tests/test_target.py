@@ -0,0 +1,151 @@
+import sqlite3
+
+import pytest
+
+from acapy_wallet_upgrade import sqlite_connection
+from acapy_wallet_upgrade.__main__ import main
+from acapy_wallet_upgrade.batching import BatchSizer
+from acapy_wallet_upgrade.db_connection import OutOfPlaceWallet
+from acapy_wallet_upgrade.records import AskarItem
+from acapy_wallet_upgrade.sqlite_connection import (
+    SqliteConnection,
+    SqliteStoreConnection,
+)
+
+
+def indy_database(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE metadata (id INTEGER NOT NULL, value NOT NULL, PRIMARY KEY(id));
+        CREATE TABLE items (id INTEGER NOT NULL, type NOT NULL, name NOT NULL,
+            value NOT NULL, key NOT NULL, PRIMARY KEY(id));
+        CREATE TABLE tags_encrypted (name NOT NULL, value NOT NULL,
+            item_id INTEGER NOT NULL, PRIMARY KEY(name, item_id));
+        CREATE TABLE tags_plaintext (name NOT NULL, value NOT NULL,
+            item_id INTEGER NOT NULL, PRIMARY KEY(name, item_id));
+        INSERT INTO metadata VALUES (1, X'00');
+        INSERT INTO items VALUES (1, X'01', X'02', X'03', X'04');
+        INSERT INTO items VALUES (2, X'11', X'12', X'13', X'14');
+        INSERT INTO tags_plaintext VALUES (X'21', X'22', 2);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_out_of_place_wallet_leaves_source(tmp_path):
+    indy_database(tmp_path / "indy.db")
+    source = SqliteConnection(f"sqlite://{tmp_path / 'indy.db'}", read_only=True)
+    target = SqliteStoreConnection(f"sqlite://{tmp_path / 'askar.db'}")
+    await source.connect()
+    await target.connect()
+    await target.pre_upgrade()
+    wallet = OutOfPlaceWallet(source.get_wallet("items"), target.get_store_wallet())
+
+    assert await wallet.get_metadata() == b"\x00"
+    await wallet.insert_profile("wallet", b"key")
+    rows = [
+        row
+        async for batch in wallet.fetch_pending_items(BatchSizer(1))
+        for row in batch
+    ]
+    assert [row[0] for row in rows] == [1, 2]
+    assert rows[1][6] == "21:22"
+    await wallet.update_items(
+        [AskarItem(row[0], row[1], row[2], row[3], []) for row in rows]
+    )
+    await target.finish_upgrade()
+
+    assert not await source.find_table("config")
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        await source._conn.execute("DELETE FROM items")
+    await source.close()
+    await target.close()
+
+    askar = sqlite3.connect(tmp_path / "askar.db")
+    assert askar.execute("SELECT COUNT(*) FROM items").fetchone() == (2,)
+    assert askar.execute("SELECT value FROM config WHERE name = 'version'").fetchone()
+    indy = sqlite3.connect(tmp_path / "indy.db")
+    assert indy.execute("SELECT COUNT(*) FROM items").fetchone() == (2,)
+
+
+@pytest.mark.asyncio
+async def test_changes_recorded_and_replaced(tmp_path):
+    indy_database(tmp_path / "indy.db")
+    source = SqliteConnection(f"sqlite://{tmp_path / 'indy.db'}")
+    target = SqliteStoreConnection(f"sqlite://{tmp_path / 'askar.db'}")
+    await source.connect()
+    await target.connect()
+    await target.pre_upgrade()
+    await source.capture_changes()
+    wallet = OutOfPlaceWallet(
+        source.get_wallet("items"), target.get_store_wallet(replace=True)
+    )
+    await wallet.insert_items(
+        [AskarItem(1, b"c", b"one", b"v", []), AskarItem(2, b"c", b"two", b"v", [])]
+    )
+
+    indy = sqlite3.connect(tmp_path / "indy.db")
+    indy.executescript(
+        """
+        DELETE FROM items WHERE id = 1;
+        INSERT INTO items VALUES (3, X'01', X'02', X'03', X'04');
+        DELETE FROM tags_plaintext WHERE item_id = 2;
+        """
+    )
+    indy.close()
+    assert await source.changed_item_ids(0, 10) == [1, 2, 3]
+    assert await source.changed_item_ids(1, 1) == [2]
+    assert [row[0] for row in await wallet.fetch_items([1, 2, 3])] == [2, 3]
+
+    # An item re-created under a new id replaces its stale copy
+    await wallet.insert_items([AskarItem(3, b"c", b"one", b"w", [(1, b"t", b"v")])])
+    await wallet.remove_items([2])
+    await source.drop_change_capture()
+    assert not await source.find_table("upgrade_changes")
+    await source.close()
+    await target.close()
+
+    askar = sqlite3.connect(tmp_path / "askar.db")
+    assert askar.execute("SELECT id, name, value FROM items").fetchall() == [
+        (3, b"one", b"w")
+    ]
+    assert askar.execute("SELECT item_id FROM items_tags").fetchall() == [(3,)]
+
+
+@pytest.mark.asyncio
+async def test_ids_bound_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_connection, "MAX_VARIABLES", 2)
+    indy_database(tmp_path / "indy.db")
+    source = SqliteConnection(f"sqlite://{tmp_path / 'indy.db'}")
+    target = SqliteStoreConnection(f"sqlite://{tmp_path / 'askar.db'}")
+    await source.connect()
+    await target.connect()
+    await target.pre_upgrade()
+    wallet = OutOfPlaceWallet(source.get_wallet("items"), target.get_store_wallet())
+    await wallet.insert_items(
+        [AskarItem(i, b"c", f"item-{i}".encode(), b"v", []) for i in range(1, 6)]
+    )
+
+    assert [row[0] for row in await wallet.fetch_items([5, 2, 4, 1, 3])] == [1, 2]
+    await wallet.remove_items([5, 1, 3, 4, 6])
+    await source.close()
+    await target.close()
+
+    askar = sqlite3.connect(tmp_path / "askar.db")
+    assert askar.execute("SELECT name FROM items").fetchall() == [(b"item-2",)]
+
+
+@pytest.mark.asyncio
+async def test_unlogged_requires_untouched_source(tmp_path):
+    # An in-place upgrade deletes each source item once it is loaded
+    with pytest.raises(ValueError, match="--unlogged"):
+        await main(
+            "dbpw",
+            f"postgres://localhost/{tmp_path.name}",
+            wallet_name="wallet",
+            wallet_key="key",
+            unlogged=True,
+        )
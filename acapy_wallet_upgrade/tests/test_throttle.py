@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import pytest
+
+from acapy_wallet_upgrade.batching import BatchSizer
+from acapy_wallet_upgrade.strategies import DbpwStrategy
+from acapy_wallet_upgrade.throttle import Throttle, TokenBucket
+
+
+@pytest.mark.asyncio
+async def test_bucket_waits_out_debt():
+    bucket = TokenBucket(1000)
+    await bucket.take(1000)
+    assert bucket.waited == 0
+    await bucket.take(100)
+    assert bucket.waited == pytest.approx(0.1, abs=0.02)
+    # No rate, no limit
+    await TokenBucket().take(10**9)
+
+
+@pytest.mark.asyncio
+async def test_statement_limit():
+    throttle = Throttle(statements=2)
+    running = []
+
+    async def statement():
+        async with throttle.statement():
+            running.append(throttle._active)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(statement() for _ in range(5)))
+    assert max(running) == 2
+    assert throttle.statements_waited > 0
+
+
+@pytest.mark.asyncio
+async def test_control_file(tmp_path):
+    control = tmp_path / "throttle.json"
+    control.write_text(json.dumps({"rows_per_second": 10, "statements": 1}))
+    throttle = Throttle(bytes_per_second=500, control_file=str(control))
+    batcher = BatchSizer(5, throttle=throttle).fork()
+    rows = [(b"x" * 10,)] * 5
+
+    async def fetch(n):
+        return rows[:n]
+
+    assert await batcher.collect(fetch) == rows
+    assert throttle.limits() == {
+        "rows_per_second": 10,
+        "bytes_per_second": 500,
+        "statements": 1,
+    }
+
+    control.write_text(json.dumps({"rows_per_second": 0}))
+    throttle.request_reload()
+    await throttle.pace(1000, 0)
+    assert throttle.rows.rate == 0
+    assert "Throttle waits" in throttle.report()
+    assert BatchSizer(5).throttle.report() is None
+
+
+@pytest.mark.asyncio
+async def test_items_charged_once():
+    throttle = Throttle(rows_per_second=6)
+    strategy = DbpwStrategy(None, "wallet", "key", BatchSizer(5, throttle=throttle))
+    rows = [(b"x" * 10,)] * 5
+    written = []
+
+    async def fetch(n):
+        return rows[:n]
+
+    async def write(items):
+        written.extend(items)
+
+    await strategy.write_items(write, await strategy.batcher.collect(fetch))
+    assert written == rows
+    assert throttle.rows.waited == 0
@@ -0,0 +1,65 @@
+from acapy_wallet_upgrade.records import IndyItem
+from acapy_wallet_upgrade.strategies import DbpwStrategy
+from acapy_wallet_upgrade.verify import (
+    add_record,
+    askar_record,
+    digest_askar_entries,
+    indy_record,
+    merge_digests,
+)
+
+
+def test_unconverted_records_match():
+    item = IndyItem(
+        1,
+        b"connection",
+        b"conn-1",
+        b"{}",
+        [(0, b"state", b"active"), (1, b"role", b"x")],
+    )
+    assert indy_record(item) == askar_record(
+        "connection", "conn-1", b"{}", {"~role": "x", "state": "active"}
+    )
+    assert indy_record(item) != askar_record(
+        "connection", "conn-1", b"{}", {"role": "x", "state": "active"}
+    )
+
+
+def test_converted_records_match():
+    schema = IndyItem(1, b"Indy::Schema", b"S:2:n:1", b"{}", [])
+    assert indy_record(schema) == askar_record("schema", "S:2:n:1", b"{}", {})
+    # DIDs are rewritten by the conversion pass, so only names are compared
+    did = IndyItem(2, b"Indy::Did", b"did1", b'{"did": "did1"}', [])
+    assert indy_record(did) == askar_record(
+        "did", "did1", b'{"metadata": null}', {"verkey": "abc"}
+    )
+    assert indy_record(IndyItem(3, b"Indy::DidMetadata", b"did1", b"{}", [])) is None
+
+
+def test_digests_are_order_independent():
+    entries = [("connection", f"conn-{i}", b"v", {}) for i in range(10)]
+    forward = digest_askar_entries(entries)
+    backward = digest_askar_entries(entries[::-1])
+    assert forward == backward
+    assert forward["connection"][0] == 10
+
+    merged = digest_askar_entries(entries[:4])
+    merge_digests(merged, digest_askar_entries(entries[4:]))
+    assert merged == forward
+
+    # A duplicated record does not cancel out
+    duplicated = {}
+    add_record(duplicated, *askar_record(*entries[0]))
+    add_record(duplicated, *askar_record(*entries[0]))
+    assert duplicated["connection"][1] != 0
+
+
+def test_passthrough_items_renamed_as_verified():
+    strategy = DbpwStrategy(None, "wallet", "key", 50)
+    state = IndyItem(1, b"Indy::RevocationRegistry", b"rr-1", b"{}", [(1, b"t", b"v")])
+    renamed = strategy.rename_item(state)
+    assert renamed == IndyItem(1, b"revocation_reg", b"rr-1", b"{}", [])
+    assert indy_record(state) == askar_record("revocation_reg", "rr-1", b"{}", {})
+
+    cred = IndyItem(2, b"Indy::Credential", b"cred-1", b"{}", [])
+    assert strategy.rename_item(cred) is cred
@@ -0,0 +1,171 @@
+"""Limits on the load a migration puts on the databases it reads and writes.
+
+Rows and bytes are paced with token buckets, charged once for each item as it
+is read, and statements run concurrently by the migration workers are capped.
+Limits can be changed while the migration runs by editing a control file,
+which is read again when it changes or when the process receives SIGHUP:
+
+    {"rows_per_second": 2000, "bytes_per_second": 4194304, "statements": 2}
+
+A limit of 0 disables it.
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import time
+from typing import AsyncIterator, Dict, Optional
+
+# Seconds between checks of the control file for changes
+CONTROL_CHECK_INTERVAL = 1.0
+
+LIMITS = ("rows_per_second", "bytes_per_second", "statements")
+
+
+class TokenBucket:
+    """Tokens refilled at a steady rate, with up to one second of burst.
+
+    Taking more tokens than are available goes into debt, which the taker
+    waits out, so requests of any size are paced to the rate.
+    """
+
+    def __init__(self, rate: float = 0):
+        """Initialize a TokenBucket instance."""
+        self.rate = rate
+        self.waited = 0.0
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        """Change the rate, keeping any debt already taken."""
+        self._refill()
+        self.rate = rate
+        self._tokens = min(self._tokens, rate)
+
+    async def take(self, amount: float):
+        """Take tokens, waiting until they are refilled if the bucket is short."""
+        if not self.rate:
+            return
+        self._refill()
+        self._tokens -= amount
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+
+class Throttle:
+    """Rows per second, bytes per second and concurrent statement limits."""
+
+    def __init__(
+        self,
+        rows_per_second: float = 0,
+        bytes_per_second: float = 0,
+        statements: int = 0,
+        control_file: Optional[str] = None,
+    ):
+        """Initialize a Throttle instance."""
+        self.rows = TokenBucket(rows_per_second)
+        self.bytes = TokenBucket(bytes_per_second)
+        self.statements = statements
+        self.statements_waited = 0.0
+        self.control_file = control_file
+        self._active = 0
+        self._released = asyncio.Condition()
+        self._control_mtime: Optional[float] = None
+        self._control_checked = 0.0
+        self._reload = control_file is not None
+
+    @property
+    def limited(self) -> bool:
+        return bool(
+            self.rows.rate or self.bytes.rate or self.statements or self.control_file
+        )
+
+    def limits(self) -> Dict[str, float]:
+        return dict(zip(LIMITS, (self.rows.rate, self.bytes.rate, self.statements)))
+
+    def watch_signal(self):
+        """Read the control file again when the process receives SIGHUP."""
+        if self.control_file and hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP, self.request_reload
+            )
+
+    def request_reload(self):
+        """Read the control file again before the next paced operation."""
+        self._reload = True
+
+    async def _check_control(self):
+        if not self.control_file:
+            return
+        now = time.monotonic()
+        if not self._reload and now - self._control_checked < CONTROL_CHECK_INTERVAL:
+            return
+        self._control_checked = now
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+        except FileNotFoundError:
+            self._reload = False
+            return
+        if not self._reload and mtime == self._control_mtime:
+            return
+        self._reload = False
+        self._control_mtime = mtime
+        try:
+            with open(self.control_file) as control:
+                limits = json.load(control)
+            rows_per_second, bytes_per_second, statements = (
+                float(limits.get(name, current))
+                for name, current in self.limits().items()
+            )
+        except (OSError, ValueError, AttributeError) as err:
+            print(f"Ignoring throttle control file {self.control_file}: {err}")
+            return
+        self.rows.set_rate(rows_per_second)
+        self.bytes.set_rate(bytes_per_second)
+        self.statements = int(statements)
+        print(f"Throttle limits: {self.limits()}")
+        async with self._released:
+            self._released.notify_all()
+
+    async def pace(self, rows: int, nbytes: int):
+        """Wait until `rows` rows of `nbytes` bytes fit within the rate limits."""
+        await self._check_control()
+        await self.rows.take(rows)
+        await self.bytes.take(nbytes)
+
+    @contextlib.asynccontextmanager
+    async def statement(self) -> AsyncIterator[None]:
+        """Hold one of the concurrent statement slots."""
+        await self._check_control()
+        start = time.monotonic()
+        async with self._released:
+            await self._released.wait_for(
+                lambda: not self.statements or self._active < self.statements
+            )
+            self._active += 1
+        self.statements_waited += time.monotonic() - start
+        try:
+            yield
+        finally:
+            async with self._released:
+                self._active -= 1
+                self._released.notify()
+
+    def report(self) -> Optional[str]:
+        """Summarize the time spent waiting on each limit."""
+        if not self.limited:
+            return None
+        return (
+            f"Throttle waits: {self.rows.waited:.1f}s for rows, "
+            f"{self.bytes.waited:.1f}s for bytes, "
+            f"{self.statements_waited:.1f}s for statements"
+        )
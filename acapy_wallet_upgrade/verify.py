@@ -0,0 +1,344 @@
+"""Post-migration verification of Askar stores against their Indy source.
+
+Each side is reduced to per-category digests: the record count and the sum,
+modulo 2**256, of the SHA-256 hashes of the canonical records. Sums do not
+depend on the order records are read in, so batches are hashed in worker
+processes as they are read and the partial digests are added up.
+
+Records in categories rewritten by the Askar conversion pass are compared on
+the fields the pass preserves. The source must be a snapshot of the Indy
+database taken before the migration, since the upgrade consumes its items.
+"""
+
+import asyncio
+import hashlib
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlparse
+
+from aries_askar import Store
+
+from .batching import BatchSizer
+from .crypto import DEFAULT_CACHE_SIZE, CryptoContext
+from .db_connection import DbConnection, Wallet
+from .error import UpgradeError
+from .records import IndyItem
+from .strategies import DEFAULT_KEY_METHOD, Strategy, split_wallet_keys
+
+# category -> [count, sum of record hashes]
+Digests = Dict[str, List[int]]
+
+DIGEST_MODULUS = 2**256
+
+NAME = ("name",)
+NAME_VALUE = ("name", "value")
+ALL_FIELDS = ("name", "value", "tags")
+
+# Label for Askar keys, which are not items and have no category
+KEYS_CATEGORY = "<keys>"
+
+# Categories rewritten by the Askar conversion pass, with the target category
+# and the fields the pass carries over unchanged
+CONVERTED_CATEGORIES = {
+    "Indy::Key": (KEYS_CATEGORY, NAME),
+    "Indy::MasterSecret": ("master_secret", ("value",)),
+    "Indy::Did": ("did", NAME),
+    "Indy::Schema": ("schema", NAME_VALUE),
+    "Indy::CredentialDefinition": ("credential_def", NAME_VALUE),
+    "Indy::CredentialDefinitionPrivateKey": ("credential_def_private", NAME_VALUE),
+    "Indy::CredentialDefinitionCorrectnessProof": ("credential_def_key_proof", NAME),
+    "Indy::RevocationRegistryDefinition": ("revocation_reg_def", NAME_VALUE),
+    "Indy::RevocationRegistryDefinitionPrivate": (
+        "revocation_reg_def_private",
+        NAME_VALUE,
+    ),
+    "Indy::RevocationRegistry": ("revocation_reg", NAME_VALUE),
+    "Indy::RevocationRegistryInfo": ("revocation_reg_info", NAME_VALUE),
+    "Indy::Credential": ("credential", NAME_VALUE),
+}
+
+# Categories merged into other records by the conversion pass
+METADATA_CATEGORIES = {"Indy::KeyMetadata", "Indy::DidMetadata"}
+
+TARGET_FIELDS = dict(CONVERTED_CATEGORIES.values())
+
+
+class VerifyTarget(NamedTuple):
+    """A source wallet and the Askar store or profile it was migrated to."""
+
+    wallet_id: Optional[str]
+    wallet_key: str
+    uri: str
+    store_key: str
+    profile: Optional[str] = None
+    key_method: str = DEFAULT_KEY_METHOD
+
+
+def canonical(
+    category: str,
+    name: bytes,
+    value: bytes,
+    tags: Iterable[Tuple[bytes, bytes]],
+    fields: Sequence[str],
+) -> bytes:
+    """Length-prefixed encoding of the compared fields of a record."""
+    parts = [category.encode()]
+    if "name" in fields:
+        parts.append(name)
+    if "value" in fields:
+        parts.append(value)
+    if "tags" in fields:
+        for tag_name, tag_value in sorted(tags):
+            parts.extend((tag_name, tag_value))
+    return b"".join(len(part).to_bytes(4, "big") + part for part in parts)
+
+
+def add_record(digests: Digests, category: str, record: bytes):
+    digest = digests.setdefault(category, [0, 0])
+    digest[0] += 1
+    digest[1] = (
+        digest[1] + int.from_bytes(hashlib.sha256(record).digest(), "big")
+    ) % DIGEST_MODULUS
+
+
+def merge_digests(digests: Digests, other: Digests):
+    for category, (count, total) in other.items():
+        digest = digests.setdefault(category, [0, 0])
+        digest[0] += count
+        digest[1] = (digest[1] + total) % DIGEST_MODULUS
+
+
+def indy_record(item: IndyItem) -> Optional[Tuple[str, bytes]]:
+    """The target category and canonical record for a decrypted Indy item."""
+    category = item.category.decode()
+    if category in METADATA_CATEGORIES:
+        return None
+    category, fields = CONVERTED_CATEGORIES.get(category, (category, ALL_FIELDS))
+    # Askar reports plaintext tag names with a ~ prefix
+    tags = [(b"~" + name if plain else name, value) for plain, name, value in item.tags]
+    return category, canonical(category, item.name, item.value or b"", tags, fields)
+
+
+def askar_record(
+    category: str, name: str, value: bytes, tags: Dict[str, str]
+) -> Tuple[str, bytes]:
+    """The canonical record for an Askar entry."""
+    fields = TARGET_FIELDS.get(category, ALL_FIELDS)
+    tags = [
+        (tag_name.encode(), tag_value.encode()) for tag_name, tag_value in tags.items()
+    ]
+    return category, canonical(category, name.encode(), value, tags, fields)
+
+
+def digest_indy_rows(rows: Sequence[Tuple], keys: dict, b64: bool) -> Digests:
+    """Decrypt a batch of Indy rows and digest them; run in a worker process."""
+    ctx = CryptoContext(keys, DEFAULT_CACHE_SIZE)
+    digests: Digests = {}
+    for row in rows:
+        record = indy_record(ctx.decrypt_item(row, b64))
+        if record:
+            add_record(digests, *record)
+    return digests
+
+
+def digest_askar_entries(entries: Sequence[Tuple]) -> Digests:
+    """Digest a batch of Askar entries; run in a worker process."""
+    digests: Digests = {}
+    for entry in entries:
+        add_record(digests, *askar_record(*entry))
+    return digests
+
+
+class Verifier(Strategy):
+    """Verify migrated Askar stores against a snapshot of the Indy database."""
+
+    def __init__(
+        self,
+        source: DbConnection,
+        strategy: str,
+        uri: str,
+        batch_size: Union[int, BatchSizer],
+        wallet_key: Optional[str] = None,
+        base_wallet_name: Optional[str] = None,
+        base_wallet_key: Optional[str] = None,
+        wallet_keys: Optional[Dict[str, Union[str, dict]]] = None,
+        workers: Optional[int] = None,
+        key_method: str = DEFAULT_KEY_METHOD,
+        base_key_method: str = DEFAULT_KEY_METHOD,
+    ):
+        super().__init__(batch_size)
+        self.source = source
+        self.strategy = strategy
+        self.uri = uri
+        self.wallet_key = wallet_key
+        self.base_wallet_name = base_wallet_name
+        self.base_wallet_key = base_wallet_key
+        self.wallet_keys, self.key_methods = split_wallet_keys(
+            wallet_keys or {}, key_method
+        )
+        self.key_method = key_method
+        self.base_key_method = base_key_method
+        self.workers = workers or os.cpu_count() or 1
+
+    def store_uri(self, name: str) -> str:
+        parsed = urlparse(self.uri)
+        return f"{parsed.scheme}://{parsed.netloc}/{name}"
+
+    async def targets(self) -> AsyncIterator[VerifyTarget]:
+        """The wallets to verify, with the stores they were migrated to."""
+        if self.strategy == "dbpw":
+            yield VerifyTarget(
+                None, self.wallet_key, self.uri, self.wallet_key, None, self.key_method
+            )
+        elif self.strategy == "mwst-as-stores":
+            for name, key in self.wallet_keys.items():
+                yield VerifyTarget(
+                    name, key, self.store_uri(name), key, None, self.key_methods[name]
+                )
+        elif self.strategy == "mwst-as-profiles":
+            base_uri = self.store_uri(self.base_wallet_name)
+            yield VerifyTarget(
+                self.base_wallet_name,
+                self.base_wallet_key,
+                base_uri,
+                self.base_wallet_key,
+                None,
+                self.base_key_method,
+            )
+            # Sub-wallets are profiles named by their wallet record id
+            store = await Store.open(base_uri, pass_key=self.base_wallet_key)
+            try:
+                records = [record async for record in store.scan("wallet_record")]
+            finally:
+                await store.close()
+            for record in records:
+                settings = record.value_json["settings"]
+                yield VerifyTarget(
+                    settings["wallet.name"],
+                    settings["wallet.key"],
+                    self.store_uri("multitenant_sub_wallet"),
+                    self.base_wallet_key,
+                    record.name,
+                    settings.get("wallet.key_derivation_method") or DEFAULT_KEY_METHOD,
+                )
+        else:
+            raise UpgradeError(f"Verification not supported for {self.strategy}")
+
+    async def digest(
+        self,
+        pool: Executor,
+        batches: AsyncIterator[Sequence[Tuple]],
+        func: Callable[..., Digests],
+        *args,
+    ) -> Digests:
+        """Hash batches in the pool as they are read, bounding those in flight."""
+        loop = asyncio.get_running_loop()
+        digests: Digests = {}
+        pending = set()
+        async for batch in batches:
+            if len(pending) >= 2 * self.workers:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    merge_digests(digests, future.result())
+            pending.add(loop.run_in_executor(pool, func, batch, *args))
+        for result in await asyncio.gather(*pending):
+            merge_digests(digests, result)
+        return digests
+
+    async def source_batches(self, wallet: Wallet) -> AsyncIterator[List[Tuple]]:
+        async for rows in wallet.scan_items(self.batcher):
+            yield [tuple(row) for row in rows]
+
+    async def target_batches(
+        self, store: Store, profile: Optional[str]
+    ) -> AsyncIterator[List[Tuple]]:
+        batch = []
+        async for entry in store.scan(None, profile=profile):
+            batch.append((entry.category, entry.name, entry.value, entry.tags))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        async with store.session(profile) as session:
+            for key in await session.fetch_all_keys():
+                batch.append((KEYS_CATEGORY, key.name, b"", {}))
+        if batch:
+            yield batch
+
+    async def source_digests(self, pool: Executor, target: VerifyTarget) -> Digests:
+        if self.source.DB_TYPE == "sqlite":
+            wallet = self.source.get_wallet("items")
+        else:
+            wallet = self.source.get_wallet("items", target.wallet_id)
+        indy_key = await self.fetch_indy_key(
+            wallet, target.wallet_key, target.key_method
+        )
+        return await self.digest(
+            pool,
+            self.source_batches(wallet),
+            digest_indy_rows,
+            indy_key,
+            wallet.NAMES_B64,
+        )
+
+    async def target_digests(self, pool: Executor, target: VerifyTarget) -> Digests:
+        store = await Store.open(target.uri, pass_key=target.store_key)
+        try:
+            return await self.digest(
+                pool, self.target_batches(store, target.profile), digest_askar_entries
+            )
+        finally:
+            await store.close()
+
+    def compare(self, name: str, source: Digests, target: Digests) -> bool:
+        mismatched = [
+            category
+            for category in sorted(set(source) | set(target))
+            if source.get(category) != target.get(category)
+        ]
+        records = sum(count for count, _ in source.values())
+        if not mismatched:
+            print(f"{name}: {records} records in {len(source)} categories match")
+            return True
+        print(f"{name}: {len(mismatched)} of {len(source)} categories differ")
+        for category in mismatched:
+            source_count = source.get(category, (0, 0))[0]
+            target_count = target.get(category, (0, 0))[0]
+            problem = "count" if source_count != target_count else "digest"
+            print(
+                f"  {category}: {problem} mismatch, {source_count} source, "
+                f"{target_count} target records"
+            )
+        return False
+
+    async def run(self):
+        """Verify every migrated wallet, raising if any differ."""
+        await self.source.connect()
+        failed = []
+        try:
+            with ProcessPoolExecutor(self.workers) as pool:
+                async for target in self.targets():
+                    source, migrated = await asyncio.gather(
+                        self.source_digests(pool, target),
+                        self.target_digests(pool, target),
+                    )
+                    name = target.wallet_id or "wallet"
+                    if not self.compare(name, source, migrated):
+                        failed.append(name)
+        finally:
+            await self.source.close()
+        if failed:
+            raise UpgradeError(f"Verification failed for: {', '.join(failed)}")
@@ -4,14 +4,10 @@ import argparse
 import asyncio
 import logging
 import sys
-from urllib.parse import urlparse
 
+from askar_tools.db_connection import open_db
 from askar_tools.error import InvalidArgumentsError
-from askar_tools.exporter import Exporter
-from askar_tools.multi_wallet_converter import MultiWalletConverter
-from askar_tools.pg_connection import PgConnection
-from askar_tools.sqlite_connection import SqliteConnection
-from askar_tools.tenant_importer import TenantImporter, TenantImportObject
+from askar_tools.pg_pool import POOLS
 
 
 def config():
@@ -60,6 +56,16 @@ def config():
         default="ARGON2I_MOD",
     )
 
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help=(
+            "Specify the maximum number of connections pooled per Postgres "
+            "database. Default is 10."
+        ),
+        default=10,
+    )
+
     # Export
     parser.add_argument(
         "--export-filename",
@@ -156,18 +162,15 @@ def config():
 async def main(args):
     """Run the main function."""
     logging.basicConfig(level=logging.WARN)
-    parsed = urlparse(args.uri)
+    POOLS.configure(args.pool_size)
 
     # Connection setup
-    if parsed.scheme == "sqlite":
-        conn = SqliteConnection(args.uri)
-    elif parsed.scheme == "postgres":
-        conn = PgConnection(args.uri)
-    else:
-        raise ValueError("Unexpected DB URI scheme")
+    conn = open_db(args.uri)
 
     # Strategy setup
     if args.strategy == "export":
+        from askar_tools.exporter import Exporter
+
         print(args)
         await conn.connect()
         method = Exporter(
@@ -178,6 +181,8 @@ async def main(args):
             export_filename=args.export_filename,
         )
     elif args.strategy == "mt-convert-to-mw":
+        from askar_tools.multi_wallet_converter import MultiWalletConverter
+
         await conn.connect()
         method = MultiWalletConverter(
             conn=conn,
@@ -187,13 +192,12 @@ async def main(args):
             sub_wallet_name=args.multitenant_sub_wallet_name,
         )
     elif args.strategy == "tenant-import":
-        tenant_parsed = urlparse(args.tenant_uri)
-        if tenant_parsed.scheme == "sqlite":
-            tenant_conn = SqliteConnection(args.tenant_uri)
-        elif tenant_parsed.scheme == "postgres":
-            tenant_conn = PgConnection(args.tenant_uri)
-        else:
-            raise ValueError("Unexpected tenant DB URI scheme")
+        from askar_tools.tenant_importer import TenantImporter, TenantImportObject
+
+        try:
+            tenant_conn = open_db(args.tenant_uri)
+        except ValueError:
+            raise ValueError("Unexpected tenant DB URI scheme") from None
 
         await conn.connect()
         await tenant_conn.connect()
@@ -218,7 +222,10 @@ async def main(args):
     else:
         raise InvalidArgumentsError("Invalid strategy")
 
-    await method.run()
+    try:
+        await method.run()
+    finally:
+        await POOLS.close_all()
 
 
 def entrypoint():
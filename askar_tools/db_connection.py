@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from urllib.parse import urlparse
 
 
 class DbConnection(ABC):
@@ -33,3 +34,17 @@ class DbConnection(ABC):
     @abstractmethod
     async def remove_database(self, admin_wallet_name, sub_wallet_name):
         """Remove the database."""
+
+
+def open_db(uri: str) -> DbConnection:
+    """Create the connection for a database URI, importing only its driver."""
+    scheme = urlparse(uri).scheme
+    if scheme == "sqlite":
+        from .sqlite_connection import SqliteConnection
+
+        return SqliteConnection(uri)
+    elif scheme == "postgres":
+        from .pg_connection import PgConnection
+
+        return PgConnection(uri)
+    raise ValueError("Unexpected DB URI scheme")
@@ -2,12 +2,11 @@
 
 import json
 from json import JSONDecodeError
+from typing import Optional
 
-from aries_askar import Store
-
+from .db_connection import DbConnection
 from .key_methods import KEY_METHODS
-from .pg_connection import PgConnection
-from .sqlite_connection import SqliteConnection
+from .stores import StoreOpener
 
 
 class Exporter:
@@ -15,11 +14,12 @@ class Exporter:
 
     def __init__(
         self,
-        conn: SqliteConnection | PgConnection,
+        conn: DbConnection,
         wallet_name: str,
         wallet_key: str,
         wallet_key_derivation_method: str = "ARGON2I_MOD",
         export_filename: str = "wallet_export.json",
+        stores: Optional[StoreOpener] = None,
     ):
         """Initialize the Exporter object.
 
@@ -29,12 +29,14 @@ class Exporter:
             wallet_key: The key for the wallet.
             wallet_key_derivation_method: The key derivation method for the wallet.
             export_filename: The name of the export file.
+            stores: Opens the wallet store; a `StoreCache` keeps it open.
         """
         self.conn = conn
         self.wallet_name = wallet_name
         self.wallet_key = wallet_key
         self.wallet_key_derivation_method = wallet_key_derivation_method
         self.export_filename = export_filename
+        self.stores = stores or StoreOpener()
 
     async def _get_decoded_items_and_tags(self, store):
         scan = store.scan()
@@ -61,7 +63,7 @@ class Exporter:
         print(f"Exporting wallet to {self.export_filename}...")
 
         tables = {"config": {}, "items": {}, "profiles": {}}
-        store = await Store.open(
+        store = await self.stores.open(
             self.conn.uri,
             pass_key=self.wallet_key,
             key_method=KEY_METHODS.get(self.wallet_key_derivation_method),
@@ -76,7 +78,7 @@ class Exporter:
         with open(self.export_filename, "w") as json_file:
             json.dump(tables, json_file, indent=4)
 
-        await store.close()
+        await self.stores.release(store)
         await self.conn.close()
 
     async def run(self):
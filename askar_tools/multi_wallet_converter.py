@@ -1,11 +1,13 @@
 """Module for converting multi-tenant wallets between single wallet and multi wallet."""
 
+from typing import Optional
+
 from aries_askar import Store
 
+from .db_connection import DbConnection
 from .error import ConversionError
 from .key_methods import KEY_METHODS
-from .pg_connection import PgConnection
-from .sqlite_connection import SqliteConnection
+from .stores import StoreOpener
 
 
 class MultiWalletConverter:
@@ -13,11 +15,12 @@ class MultiWalletConverter:
 
     def __init__(
         self,
-        conn: SqliteConnection | PgConnection,
+        conn: DbConnection,
         wallet_name: str,
         wallet_key: str,
         wallet_key_derivation_method: str,
         sub_wallet_name: str,
+        stores: Optional[StoreOpener] = None,
     ):
         """Initialize the MultiWalletConverter instance.
 
@@ -27,12 +30,14 @@ class MultiWalletConverter:
             wallet_key (str): The key for the wallet.
             wallet_key_derivation_method (str): The key derivation method for the wallet.
             sub_wallet_name (str): The name of the sub wallet.
+            stores (StoreOpener): Opens the admin store; a `StoreCache` keeps it open.
         """
         self.conn = conn
         self.admin_wallet_name = wallet_name
         self.admin_wallet_key = wallet_key
         self.wallet_key_derivation_method = wallet_key_derivation_method
         self.sub_wallet_name = sub_wallet_name
+        self.stores = stores or StoreOpener()
 
     def get_wallet_records(self, entries):
         """Get the wallet records from the given entries.
@@ -60,7 +65,9 @@ class MultiWalletConverter:
         if f"{self.admin_wallet_name}" not in self.conn.uri:
             raise ConversionError("The wallet name must be included in the URI.")
 
-        admin_store = await Store.open(self.conn.uri, pass_key=self.admin_wallet_key)
+        admin_store = await self.stores.open(
+            self.conn.uri, pass_key=self.admin_wallet_key
+        )
 
         try:
             sub_wallet_store = await Store.open(
@@ -143,7 +150,7 @@ class MultiWalletConverter:
             await sub_wallet_store.close()
             await self.conn.remove_database(self.admin_wallet_name, self.sub_wallet_name)
 
-        await admin_store.close()
+        await self.stores.release(admin_store)
         await self.conn.close()
 
     async def run(self):
@@ -3,6 +3,7 @@ from urllib.parse import urlparse
 import asyncpg
 
 from .db_connection import DbConnection
+from .pg_pool import POOLS
 
 
 class PgConnection(DbConnection):
@@ -22,14 +23,7 @@ class PgConnection(DbConnection):
     async def connect(self):
         """Accessor for the connection pool instance."""
         if not self._conn:
-            parts = self.parsed_url
-            self._conn = await asyncpg.connect(
-                host=parts.hostname,
-                port=parts.port or 5432,
-                user=parts.username,
-                password=parts.password,
-                database=parts.path[1:],
-            )
+            self._conn = await POOLS.acquire(self.uri)
 
     async def find_table(self, name: str) -> bool:
         """Check for existence of a table."""
@@ -48,7 +42,7 @@ class PgConnection(DbConnection):
     async def close(self):
         """Release the connection."""
         if self._conn:
-            await self._conn.close()
+            await POOLS.release(self._conn)
             self._conn = None
 
     async def get_root_config(self):
@@ -0,0 +1,150 @@
+"""Shared asyncpg connection pools for the Postgres connection classes.
+
+asyncpg is imported when the first pool is created, so the entrypoints can
+hold the pool manager without loading the driver for sqlite runs.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+if TYPE_CHECKING:
+    import asyncpg
+
+# Database used for CREATE/DROP DATABASE statements
+ADMIN_DATABASE = "template1"
+
+
+def connect_args(uri: str, database: Optional[str] = None) -> dict:
+    """Get the asyncpg connection arguments for a postgres URI."""
+    parts = urlparse(uri)
+    return {
+        "host": parts.hostname,
+        "port": parts.port or 5432,
+        "user": parts.username,
+        "password": parts.password,
+        "database": database or parts.path[1:],
+    }
+
+
+class PgPoolManager:
+    """Connection pools keyed by DSN, shared by every Postgres connection.
+
+    Pools start empty and close connections left idle for
+    `max_inactive_lifetime` seconds, so holding a pool for each of many
+    wallet databases does not hold a connection to each of them.
+    """
+
+    def __init__(self, max_size: int = 10, max_inactive_lifetime: float = 60.0):
+        """Initialize a PgPoolManager instance."""
+        self.max_size = max_size
+        self.max_inactive_lifetime = max_inactive_lifetime
+        self._pools: Dict[Tuple, "asyncpg.Pool"] = {}
+        self._acquired: Dict["asyncpg.Connection", "asyncpg.Pool"] = {}
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def configure(self, max_size: int):
+        """Set the maximum size of pools created from now on."""
+        self.max_size = max_size
+
+    def _key(self, args: dict) -> Tuple:
+        return tuple(args[name] for name in ("host", "port", "user", "database"))
+
+    def _check_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Pools cannot outlive the event loop they were created on
+            self._pools.clear()
+            self._acquired.clear()
+            self._lock = asyncio.Lock()
+            self._loop = loop
+
+    async def get_pool(
+        self, uri: str, database: Optional[str] = None
+    ) -> "asyncpg.Pool":
+        """Get the pool for a postgres URI, creating it if needed."""
+        import asyncpg
+
+        self._check_loop()
+        args = connect_args(uri, database)
+        key = self._key(args)
+        pool = self._pools.get(key)
+        if pool is None:
+            async with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = await asyncpg.create_pool(
+                        **args,
+                        min_size=0,
+                        max_size=self.max_size,
+                        max_inactive_connection_lifetime=self.max_inactive_lifetime,
+                    )
+                    self._pools[key] = pool
+        return pool
+
+    async def acquire(self, uri: str, database: Optional[str] = None):
+        """Acquire a connection; it must be handed back with `release`."""
+        pool = await self.get_pool(uri, database)
+        conn = await pool.acquire()
+        self._acquired[conn] = pool
+        return conn
+
+    async def release(self, conn):
+        """Return a connection obtained from `acquire` to its pool."""
+        pool = self._acquired.pop(conn, None)
+        if pool is not None:
+            await pool.release(conn)
+
+    @asynccontextmanager
+    async def connection(
+        self, uri: str, database: Optional[str] = None
+    ) -> AsyncIterator["asyncpg.Connection"]:
+        """Acquire a connection for the duration of the context."""
+        conn = await self.acquire(uri, database)
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    @asynccontextmanager
+    async def admin_connection(self, uri: str) -> AsyncIterator["asyncpg.Connection"]:
+        """Open a connection to the admin database of the server.
+
+        The connection is not pooled but closed as soon as the context exits,
+        because CREATE DATABASE fails while any session, including those of
+        other processes, is connected to its template database.
+        """
+        import asyncpg
+
+        conn = await asyncpg.connect(**connect_args(uri, ADMIN_DATABASE))
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    async def close(self, uri: str, database: Optional[str] = None):
+        """Close the pool for a URI, such as before dropping its database."""
+        self._check_loop()
+        pool = self._pools.pop(self._key(connect_args(uri, database)), None)
+        if pool is not None:
+            for conn, owner in list(self._acquired.items()):
+                if owner is pool:
+                    await self.release(conn)
+            await pool.close()
+
+    async def close_all(self):
+        """Close every pool."""
+        if self._loop is not asyncio.get_running_loop():
+            return
+        # Connections still checked out would otherwise block pool.close()
+        for conn in list(self._acquired):
+            await self.release(conn)
+        pools = list(self._pools.values())
+        self._pools.clear()
+        for pool in pools:
+            await pool.close()
+
+
+POOLS = PgPoolManager()
@@ -0,0 +1,132 @@
+"""Async API for running many wallet operations in one process.
+
+Each CLI invocation starts a process, connects to the database and derives
+the store keys it needs, which dominates the cost of small operations such as
+importing a single tenant. A `ToolSession` keeps the Postgres connection pools
+and the opened admin stores between operations:
+
+    async with ToolSession() as tools:
+        for tenant in tenants:
+            await tools.import_tenant(
+                admin_uri, "admin", admin_key,
+                tenant.uri, tenant.name, tenant.key,
+            )
+
+Indy wallet upgrades from `acapy_wallet_upgrade` run through the same pools
+with `upgrade`.
+"""
+
+from .db_connection import DbConnection, open_db
+from .exporter import Exporter
+from .multi_wallet_converter import MultiWalletConverter
+from .pg_pool import POOLS
+from .stores import StoreCache
+from .tenant_importer import TenantImporter, TenantImportObject
+
+
+class ToolSession:
+    """Shared connection pools and stores for a sequence of operations."""
+
+    def __init__(self, pool_size: int = 10):
+        """Initialize a ToolSession instance.
+
+        Args:
+            pool_size: Maximum connections in each Postgres connection pool.
+        """
+        POOLS.configure(pool_size)
+        self.stores = StoreCache()
+
+    async def __aenter__(self) -> "ToolSession":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connection(self, uri: str) -> DbConnection:
+        """Connect to the database of a URI."""
+        conn = open_db(uri)
+        await conn.connect()
+        return conn
+
+    async def export(
+        self,
+        uri: str,
+        wallet_name: str,
+        wallet_key: str,
+        wallet_key_derivation_method: str = "ARGON2I_MOD",
+        export_filename: str = "wallet_export.json",
+    ):
+        """Export a wallet to a json file, as with the `export` strategy."""
+        await Exporter(
+            conn=await self.connection(uri),
+            wallet_name=wallet_name,
+            wallet_key=wallet_key,
+            wallet_key_derivation_method=wallet_key_derivation_method,
+            export_filename=export_filename,
+            stores=self.stores,
+        ).run()
+
+    async def convert_to_multi_wallet(
+        self,
+        uri: str,
+        wallet_name: str,
+        wallet_key: str,
+        wallet_key_derivation_method: str = "ARGON2I_MOD",
+        sub_wallet_name: str = "multitenant_sub_wallet",
+    ):
+        """Split a multitenant sub-wallet, as with the `mt-convert-to-mw` strategy."""
+        await MultiWalletConverter(
+            conn=await self.connection(uri),
+            wallet_name=wallet_name,
+            wallet_key=wallet_key,
+            wallet_key_derivation_method=wallet_key_derivation_method,
+            sub_wallet_name=sub_wallet_name,
+            stores=self.stores,
+        ).run()
+
+    async def import_tenant(
+        self,
+        uri: str,
+        wallet_name: str,
+        wallet_key: str,
+        tenant_uri: str,
+        tenant_wallet_name: str,
+        tenant_wallet_key: str,
+        wallet_key_derivation_method: str = "ARGON2I_MOD",
+        **tenant_options,
+    ):
+        """Import a tenant wallet, as with the `tenant-import` strategy.
+
+        Args:
+            tenant_options: Other `TenantImportObject` arguments, such as
+                `tenant_label` or `tenant_wallet_key_derivation_method`.
+        """
+        await TenantImporter(
+            admin_conn=await self.connection(uri),
+            admin_wallet_name=wallet_name,
+            admin_wallet_key=wallet_key,
+            admin_wallet_key_derivation_method=wallet_key_derivation_method,
+            tenant_import_object=TenantImportObject(
+                tenant_conn=await self.connection(tenant_uri),
+                tenant_wallet_name=tenant_wallet_name,
+                tenant_wallet_key=tenant_wallet_key,
+                **tenant_options,
+            ),
+            stores=self.stores,
+        ).run()
+
+    async def upgrade(self, strategy: str, uri: str, **options):
+        """Upgrade Indy wallets, as with the `askar-upgrade` command.
+
+        Takes the other command line options as keyword arguments, except
+        `pool_size`. The strategy connects through the pools of the session,
+        which are left open for the next operation.
+        """
+        from acapy_wallet_upgrade.__main__ import build_strategy
+
+        await build_strategy(strategy, uri, **options).run()
+
+    async def close(self):
+        """Close the cached stores and the connection pools."""
+        await self.stores.close()
+        await POOLS.close_all()
@@ -0,0 +1,72 @@
+"""Opening Askar stores for the tools, optionally keeping them open."""
+
+import asyncio
+import hashlib
+from typing import Dict, Optional, Tuple
+
+from aries_askar import Store
+
+
+class StoreOpener:
+    """Open a store for each use and close it when it is released."""
+
+    async def open(
+        self,
+        uri: str,
+        pass_key: str,
+        key_method: Optional[str] = None,
+        profile: Optional[str] = None,
+    ) -> Store:
+        """Open a store."""
+        return await Store.open(
+            uri, key_method=key_method, pass_key=pass_key, profile=profile
+        )
+
+    async def release(self, store: Store):
+        """Hand back a store obtained from `open`."""
+        await store.close()
+
+
+class StoreCache(StoreOpener):
+    """Keep stores open between uses.
+
+    Opening a store derives its key from the pass key, which for the Argon2
+    key methods takes most of a second. Cached stores are keyed by URI, key
+    method, profile and a hash of the pass key, and stay open until `close`.
+    """
+
+    def __init__(self):
+        """Initialize a StoreCache instance."""
+        self._stores: Dict[Tuple, Store] = {}
+        self._lock = asyncio.Lock()
+
+    def _key(
+        self, uri: str, pass_key: str, key_method: Optional[str], profile: Optional[str]
+    ) -> Tuple:
+        return (uri, key_method, profile, hashlib.sha256(pass_key.encode()).digest())
+
+    async def open(
+        self,
+        uri: str,
+        pass_key: str,
+        key_method: Optional[str] = None,
+        profile: Optional[str] = None,
+    ) -> Store:
+        """Get an open store, opening it on first use."""
+        key = self._key(uri, pass_key, key_method, profile)
+        async with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                store = await super().open(uri, pass_key, key_method, profile)
+                self._stores[key] = store
+        return store
+
+    async def release(self, store: Store):
+        """Keep the store open for the next use."""
+
+    async def close(self):
+        """Close every cached store."""
+        stores = list(self._stores.values())
+        self._stores.clear()
+        for store in stores:
+            await store.close()
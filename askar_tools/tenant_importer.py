@@ -2,12 +2,13 @@
 
 import time
 import uuid
+from typing import Optional
 
 from aries_askar import Store
 
+from .db_connection import DbConnection
 from .key_methods import KEY_METHODS
-from .pg_connection import PgConnection
-from .sqlite_connection import SqliteConnection
+from .stores import StoreOpener
 
 
 class TenantImportObject:
@@ -15,7 +16,7 @@ class TenantImportObject:
 
     def __init__(
         self,
-        tenant_conn: SqliteConnection | PgConnection,
+        tenant_conn: DbConnection,
         tenant_wallet_name: str,
         tenant_wallet_key: str,
         tenant_wallet_type: str = "askar",
@@ -43,11 +44,12 @@ class TenantImporter:
 
     def __init__(
         self,
-        admin_conn: SqliteConnection | PgConnection,
+        admin_conn: DbConnection,
         admin_wallet_name: str,
         admin_wallet_key: str,
         admin_wallet_key_derivation_method: str,
         tenant_import_object: TenantImportObject,
+        stores: Optional[StoreOpener] = None,
     ):
         """Initialize the Tenant Importer object.
 
@@ -58,12 +60,14 @@ class TenantImporter:
             admin_wallet_key_derivation_method: The key derivation method for the
                 admin wallet.
             tenant_import_object: The tenant import object.
+            stores: Opens the admin store; a `StoreCache` keeps it open.
         """
         self.admin_conn = admin_conn
         self.admin_wallet_name = admin_wallet_name
         self.admin_wallet_key = admin_wallet_key
         self.admin_wallet_key_derivation_method = admin_wallet_key_derivation_method
         self.tenant_import_obj = tenant_import_object
+        self.stores = stores or StoreOpener()
 
     async def _create_tenant(self, wallet_id: str, admin_txn, current_time: str):
         # Create wallet record in admin wallet
@@ -210,7 +214,7 @@ class TenantImporter:
             )
 
             # Import the tenant wallet into the admin wallet
-            admin_store = await Store.open(
+            admin_store = await self.stores.open(
                 uri=self.admin_conn.uri,
                 pass_key=self.admin_wallet_key,
                 key_method=KEY_METHODS.get(self.admin_wallet_key_derivation_method),
@@ -230,6 +234,7 @@ class TenantImporter:
                     current_time=str(current_time),
                 )
                 await admin_txn.commit()
+            await self.stores.release(admin_store)
         except Exception as e:
             success = False
             print(f"Error importing tenant wallet: {e}")
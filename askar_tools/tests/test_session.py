@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from aries_askar import AskarError, Store
+
+from askar_tools.session import ToolSession
+
+
+@pytest.mark.asyncio
+async def test_session_reuses_open_stores(tmp_path):
+    uri = f"sqlite://{tmp_path / 'wallet.db'}"
+    store = await Store.provision(
+        uri, "kdf:argon2i:int", "insecure", profile="default", recreate=True
+    )
+    async with store.session() as session:
+        await session.insert("connection", "conn-1", b'{"state": "active"}')
+    await store.close()
+
+    async with ToolSession() as tools:
+        opened = await tools.stores.open(uri, "insecure", "kdf:argon2i:int")
+        for name in ("first.json", "second.json"):
+            await tools.export(
+                uri,
+                "wallet",
+                "insecure",
+                "ARGON2I_INT",
+                str(tmp_path / name),
+            )
+        assert await tools.stores.open(uri, "insecure", "kdf:argon2i:int") is opened
+        other = await tools.stores.open(uri, "insecure", "kdf:argon2i:int", "default")
+        assert other is not opened
+
+    # Closing the session closes the stores it kept open
+    with pytest.raises(AskarError):
+        async with opened.session():
+            pass
+    with open(tmp_path / "second.json") as exported:
+        items = json.load(exported)["items"]
+    assert items["connection"][0]["name"] == "conn-1"
+
+
+@pytest.mark.asyncio
+async def test_session_upgrade_takes_command_line_options(tmp_path):
+    async with ToolSession() as tools:
+        with pytest.raises(ValueError, match="--unlogged"):
+            await tools.upgrade(
+                "dbpw",
+                f"sqlite://{tmp_path / 'wallet.db'}",
+                wallet_name="wallet",
+                wallet_key="insecure",
+                unlogged=True,
+            )